@@ -0,0 +1,492 @@
+# =============================================================================
+# COLAB NODE BENCHMARK - ローカルのスタンドインノードでマジックコマンドを計測
+# =============================================================================
+#
+# Colab サーバーと同じ API (/health, /info, /resources, /train, /job/<id>/status,
+# /job/<id>/range, /jobs, /blobs/*) を実装したスタンドインノードを N 台ローカルに起動し、
+# AIDevMagics のメソッドを実際に呼び出して次のシナリオを計測する:
+#
+#   connect   %colab_connect           (ノード1台ずつ)
+#   status    %colab_status            (全ノードへの /resources fan-out)
+#   dispatch  %%colab_train --nodes N  (配置 + blob 同期 + /train fan-out)
+#   poll      %colab_job_status <id>   (全ノードへの /job/<id>/status fan-out)
+#   tasks     %%colab_train --tasks N  (タスクキューモード。ストラグラーは1件の処理も slow-factor 倍遅い)
+#
+#   python PlotType/bench_colab_nodes.py
+#   python PlotType/bench_colab_nodes.py --nodes 1,8,64 --latency-ms 30 --jitter-ms 10 \
+#          --failure-rate 0.01 --output bench.json
+#   python PlotType/bench_colab_nodes.py --baseline bench.json --tolerance 0.2  (悪化したら終了コード 1)
+#   python PlotType/bench_colab_nodes.py --nodes 8 --dead-fraction 0.25  (接続後に2台が応答しなくなる)
+#   python PlotType/bench_colab_nodes.py --nodes 8 --slow-fraction 0.25 --tasks 4000 --item-ms 2
+#
+# 結果は p50/p99/平均レイテンシ (ms)、スループット (操作/秒, ノードリクエスト/秒)、
+# エラー数を JSON で出力する。tasks は全ノードの処理速度の合計で割った理想時間 (ideal_ms) と、
+# 均等に静的分割した場合の時間 (static_ms = 最も遅いノードの担当分) に加えて、ノード1台あたり1件で
+# 計測した配布・回収の固定コスト (overhead_ms) も出力する (p50 - overhead_ms を static_ms と比べる)。
+
+import io
+import os
+import math
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import types
+import threading
+import contextlib
+import subprocess
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Any
+
+EXTENSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'magic-commands-colab.py')
+
+TRAIN_CODE = '''
+for epoch in range(config['epochs']):
+    update_progress(epoch + 1, loss=1.0 / (epoch + 1))
+'''
+
+# スタンドインは work() を実行せず、範囲の件数 × item_ms 待って同じ形の結果を返す
+TASK_CODE = '''
+def work(start, end):
+    return list(range(start, end))
+'''
+
+
+# =============================================================================
+# STAND-IN NODE - Colab サーバーの API を模したローカル HTTP サーバー
+# =============================================================================
+
+class StandInNode:
+    """
+    Colab サーバーのスタンドイン
+    すべてのリクエストに latency_ms ± jitter_ms の遅延を入れ、failure_rate の確率で 503 を返す。
+    slow=True のノードは slow_ms の遅延 (ストラグラー) になる
+    /job/<id>/range は範囲の件数 × item_ms かけて1範囲ずつ処理する (ワーカー1つ分)
+    hang() 後は接続を受け付けたまま応答しない (ランタイムが再割り当てされたノード)
+    """
+
+    def __init__(self, index: int, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 failure_rate: float = 0.0, slow_ms: Optional[float] = None,
+                 epoch_seconds: float = 0.5, seed: int = 0, item_ms: float = 1.0):
+        self.index = index
+        self.latency_ms = slow_ms if slow_ms is not None else latency_ms
+        self.item_ms = item_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.epoch_seconds = epoch_seconds
+        self.random = random.Random(seed * 1000 + index)
+        self.jobs: Dict[str, Dict] = {}
+        self.blobs: set = set()
+        self.requests = 0
+        self.injected_failures = 0
+        self.hung = False
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._worker = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.server.handle_error = lambda request, address: None  # 重複実行の打ち切りなどでの切断は無視
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> 'StandInNode':
+        self._thread.start()
+        return self
+
+    def hang(self) -> None:
+        self.hung = True
+
+    def stop(self) -> None:
+        self._stopped.set()  # 応答を止めているハンドラーを解放
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _inject(self) -> bool:
+        """遅延を入れ、失敗させるなら True"""
+        with self._lock:
+            self.requests += 1
+            delay = max(self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms), 0.0)
+            fail = self.random.random() < self.failure_rate
+            if fail:
+                self.injected_failures += 1
+        if delay:
+            time.sleep(delay / 1000)
+        return fail
+
+    def _job_status(self, job_id: str) -> Dict[str, Any]:
+        """サーバーの summarize_job と同じ形 (updated_at はエポックが進んだ・終了した時刻)"""
+        job = self.jobs[job_id]
+        now = job.get('cancelled_at') or time.time()
+        epoch = min(int((now - job['start_time']) / self.epoch_seconds), job['total_epochs'])
+        if job.get('cancelled_at'):
+            status = 'cancelled'
+        else:
+            status = 'completed' if epoch >= job['total_epochs'] else 'running'
+        return {
+            'job_id': job_id,
+            'status': status,
+            'current_epoch': epoch,
+            'total_epochs': job['total_epochs'],
+            'current_loss': 1.0 / (epoch + 1),
+            'start_time': job['start_time'],
+            'updated_at': job.get('cancelled_at') or job['start_time'] + epoch * self.epoch_seconds
+        }
+
+    def _handler(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive (クライアントの接続再利用を計測に含める)
+            disable_nagle_algorithm = True  # ヘッダと本文の分割送信で遅延 ACK 待ちにならないように
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def _send(self, status: int, payload: Any) -> None:
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _route(self, method: str) -> None:
+                body = self._body() if method in ('POST', 'PUT') else b''
+                if node.hung:
+                    node._stopped.wait()
+                    return
+                if node._inject():
+                    self._send(503, {'error': 'injected failure'})
+                    return
+                path, _, query = self.path.partition('?')
+                parts = path.strip('/').split('/')
+
+                if method == 'GET' and path == '/health':
+                    self._send(200, {'status': 'healthy', 'timestamp': time.time()})
+                elif method == 'GET' and path == '/info':
+                    self._send(200, {'gpu': 'Stand-in GPU', 'runtime': 'bench', 'python_version': platform.python_version()})
+                elif method == 'GET' and path == '/resources':
+                    self._send(200, {
+                        'cpu': {'usage': node.random.uniform(0, 50)},
+                        'memory': {'percent': node.random.uniform(10, 60)},
+                        'gpu': [{'name': 'Stand-in GPU', 'utilization': 0.0,
+                                 'memory_total': 16 * 1024 ** 3, 'memory_free': 15 * 1024 ** 3}]
+                    })
+                elif method == 'POST' and path == '/blobs/missing':
+                    hashes = json.loads(body or b'{}').get('hashes', [])
+                    self._send(200, {'missing': [digest for digest in hashes if digest not in node.blobs]})
+                elif method == 'PUT' and len(parts) == 2 and parts[0] == 'blobs':
+                    node.blobs.add(parts[1])
+                    self._send(200, {'stored': parts[1], 'size': len(body)})
+                elif method == 'POST' and path == '/train':
+                    config = json.loads(body)
+                    node.jobs[config['job_id']] = {'start_time': time.time(), 'total_epochs': config.get('epochs', 1)}
+                    self._send(200, {'job_id': config['job_id'], 'status': 'started'})
+                elif method == 'POST' and len(parts) == 3 and parts[0] == 'job' and parts[2] == 'range':
+                    item = json.loads(body)
+                    with node._worker:
+                        seconds = (item['end'] - item['start']) * node.item_ms / 1000
+                        time.sleep(seconds)
+                    self._send(200, {'range_id': item['range_id'], 'value': list(range(item['start'], item['end'])),
+                                     'seconds': seconds})
+                elif method == 'POST' and len(parts) == 3 and parts[0] == 'job' and parts[2] in ('drain', 'cancel'):
+                    if parts[1] not in node.jobs:
+                        self._send(404, {'error': 'Job not found'})
+                    else:
+                        if parts[2] == 'cancel' and node._job_status(parts[1])['status'] == 'running':
+                            node.jobs[parts[1]]['cancelled_at'] = time.time()
+                        self._send(200, {'job_id': parts[1], 'status': node._job_status(parts[1])['status']})
+                elif method == 'GET' and len(parts) == 3 and parts[0] == 'job' and parts[2] == 'status':
+                    if parts[1] in node.jobs:
+                        self._send(200, node._job_status(parts[1]))
+                    else:
+                        self._send(404, {'error': 'Job not found'})
+                elif method == 'GET' and path == '/jobs':
+                    # サーバーの /jobs と同じ ?ids= / ?active= / ?since= と timestamp
+                    now = time.time()
+                    params = dict(item.partition('=')[::2] for item in query.split('&') if item)
+                    ids = [job_id for job_id in params.get('ids', '').split(',') if job_id] or list(node.jobs)
+                    since = float(params.get('since') or 0)
+                    jobs = {}
+                    for job_id in ids:
+                        if job_id not in node.jobs:
+                            continue
+                        summary = node._job_status(job_id)
+                        if params.get('active') not in (None, '', '0') and summary['status'] != 'running':
+                            continue
+                        if summary['updated_at'] > since:
+                            jobs[job_id] = summary
+                    self._send(200, {'jobs': jobs, 'timestamp': now})
+                else:
+                    self._send(404, {'error': 'not found'})
+
+            def do_GET(self):
+                self._route('GET')
+
+            def do_POST(self):
+                self._route('POST')
+
+            def do_PUT(self):
+                self._route('PUT')
+
+        return Handler
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def load_magics():
+    """拡張モジュールを読み込み、シェルなしの AIDevMagics を返す (結果の変数は user_ns の代わりの dict へ)"""
+    spec = importlib.util.spec_from_file_location('ai_dev_extension.magics', EXTENSION_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    magics = module.AIDevMagics(shell=None)
+    magics.shell = types.SimpleNamespace(user_ns={})
+    return magics
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """線形補間のパーセンタイル"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+class ErrorCounter:
+    """node_client の応答を監視して失敗数を数える"""
+
+    def __init__(self, client):
+        self.errors = 0
+        self.requests = 0
+        original = client.batch
+
+        def batch(calls, timeout=None, adaptive=True):
+            responses = original(calls, timeout, adaptive)
+            self.requests += len(responses)
+            self.errors += sum(1 for res in responses if not res.ok)
+            return responses
+
+        client.batch = batch
+
+
+def run_scenario(name: str, node_count: int, iterations: int, operation, setup=None) -> Dict[str, Any]:
+    """
+    operation を iterations 回実行してレイテンシを集計 (マジックの出力は捨てる)
+    setup は毎回 operation の前に計測の外で実行する (前回のジョブの後始末など)
+    """
+    samples = []
+    wall = 0.0
+    for _ in range(iterations):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            operation()
+            samples.append((time.perf_counter() - start) * 1000)
+        wall += samples[-1] / 1000
+    return {
+        'scenario': name,
+        'nodes': node_count,
+        'iterations': iterations,
+        'p50_ms': percentile(samples, 0.50),
+        'p99_ms': percentile(samples, 0.99),
+        'mean_ms': sum(samples) / len(samples),
+        'max_ms': max(samples),
+        'ops_per_sec': iterations / wall,
+        'node_requests_per_sec': iterations * node_count / wall
+    }
+
+
+def bench_cluster(node_count: int, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """N 台のスタンドインノードに対して全シナリオを実行"""
+    slow_nodes = int(round(node_count * args.slow_fraction))
+    nodes = [
+        StandInNode(index, args.latency_ms, args.jitter_ms, args.failure_rate,
+                    slow_ms=args.slow_ms if index < slow_nodes else None,
+                    epoch_seconds=args.epoch_seconds, seed=args.seed,
+                    item_ms=args.item_ms * (args.slow_factor if index < slow_nodes else 1)).start()
+        for index in range(node_count)
+    ]
+    magics = load_magics()
+    counter = ErrorCounter(magics.node_client)
+    results = []
+
+    def record(result: Dict[str, Any], errors_before: int, requests_before: int) -> None:
+        result['client_requests'] = counter.requests - requests_before
+        result['client_errors'] = counter.errors - errors_before
+        results.append(result)
+
+    try:
+        # connect: ノードを1台ずつ追加
+        urls = iter(node.url for node in nodes)
+        before = (counter.errors, counter.requests)
+        record(run_scenario('connect', node_count, node_count, lambda: magics.colab_connect(next(urls))), *before)
+        connected = len(magics.colab_nodes)
+        if connected < node_count:
+            # 失敗注入で接続できなかったノードは残りのシナリオから外れる
+            print(f"⚠️  {node_count} 台中 {connected} 台のみ接続", file=sys.stderr)
+        for node in nodes[node_count - int(round(node_count * args.dead_fraction)):]:
+            node.hang()
+
+        before = (counter.errors, counter.requests)
+        record(run_scenario('status', connected, args.iterations, lambda: magics.colab_status('')), *before)
+
+        # dispatch: 毎回クラスタ全体に投入 (前のジョブは %colab_job_cancel で止めてノードを空ける)
+        def release_nodes() -> None:
+            # /resources の失敗で全台を確保できずキューに入ったジョブも取り下げる
+            for job_id, info in list(magics.active_jobs.items()):
+                if info['status'] in ('running', 'queued'):
+                    magics.colab_job_cancel(job_id)
+
+        def dispatch() -> None:
+            magics.scheduler.refresh_resources(force=True)  # 毎回 /resources から配置を決める
+            available = sum(1 for node_id in magics.colab_nodes if magics.node_client.available(node_id))
+            magics.colab_train(f"--nodes {max(available, 1)} --epochs {args.epochs}", TRAIN_CODE)
+
+        before = (counter.errors, counter.requests)
+        record(run_scenario('dispatch', connected, args.dispatch_iterations, dispatch, setup=release_nodes), *before)
+
+        dispatched = [job_id for job_id, info in magics.active_jobs.items() if info['status'] == 'running']
+        if dispatched:
+            job_id = dispatched[-1]
+            before = (counter.errors, counter.requests)
+            record(run_scenario('poll', connected, args.iterations, lambda: magics.colab_job_status(job_id)), *before)
+        else:
+            print("⚠️  全ノードで開始できたジョブがないため poll を省略", file=sys.stderr)
+
+        # tasks: 応答するノード全体で [0, tasks) を処理 (結果が揃うまでの時間)
+        if args.tasks:
+            def run_tasks(count: int) -> None:
+                magics.colab_train(f"--tasks {count} --range-seconds {args.range_seconds}", TASK_CODE)
+                if magics.shell.user_ns['task_results'] != list(range(count)):
+                    raise RuntimeError('タスクキューの結果が欠けています')
+
+            alive = [node for node in nodes if not node.hung]
+            overhead = run_scenario('tasks', connected, args.tasks_iterations, lambda: run_tasks(len(alive)))
+            before = (counter.errors, counter.requests)
+            result = run_scenario('tasks', connected, args.tasks_iterations, lambda: run_tasks(args.tasks))
+            result['overhead_ms'] = overhead['p50_ms']
+            result['ideal_ms'] = args.tasks / sum(1 / node.item_ms for node in alive)
+            result['static_ms'] = max(node.item_ms for node in alive) * math.ceil(args.tasks / len(alive))
+            record(result, *before)
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for job_id in list(magics.active_jobs):
+                magics.scheduler.cancel(job_id)
+            magics.node_client.close()
+        for node in nodes:
+            node.stop()
+
+    injected = sum(node.injected_failures for node in nodes)
+    for result in results:
+        result['injected_failures_total'] = injected
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(EXTENSION_PATH), timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, tolerance: float) -> List[str]:
+    """ベースラインより p50/p99 が tolerance を超えて悪化したシナリオを返す"""
+    with open(baseline_path) as f:
+        baseline = {(r['scenario'], r['nodes']): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        base = baseline.get((result['scenario'], result['nodes']))
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            if base[metric] > 0 and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['scenario']}@{result['nodes']} {metric}: "
+                    f"{base[metric]:.1f} → {result[metric]:.1f} ms (+{(result[metric] / base[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='スタンドイン Colab ノードでマジックコマンドを計測')
+    parser.add_argument('--nodes', default='1,8,64', help='ノード数 (カンマ区切り)')
+    parser.add_argument('--iterations', type=int, default=50, help='status / poll の反復回数')
+    parser.add_argument('--dispatch-iterations', type=int, default=10, help='dispatch の反復回数')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='各リクエストに入れる遅延')
+    parser.add_argument('--jitter-ms', type=float, default=5.0, help='遅延のばらつき (±)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='503 を返す確率')
+    parser.add_argument('--slow-fraction', type=float, default=0.0, help='ストラグラーにするノードの割合')
+    parser.add_argument('--slow-ms', type=float, default=500.0, help='ストラグラーの遅延')
+    parser.add_argument('--dead-fraction', type=float, default=0.0, help='接続後に応答しなくなるノードの割合')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--epoch-seconds', type=float, default=0.5, help='スタンドインの1エポックの長さ')
+    parser.add_argument('--tasks', type=int, default=2000, help='tasks シナリオのインデックス数 (0 で省略)')
+    parser.add_argument('--tasks-iterations', type=int, default=3, help='tasks の反復回数')
+    parser.add_argument('--item-ms', type=float, default=1.0, help='スタンドインが1件の処理にかける時間')
+    parser.add_argument('--slow-factor', type=float, default=10.0, help='ストラグラーの1件の処理時間の倍率')
+    parser.add_argument('--range-seconds', type=float, default=0.5, help='tasks で1範囲にかける目標時間')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='結果の JSON を書き出すパス')
+    parser.add_argument('--json', action='store_true', help='表ではなく JSON を標準出力に出す')
+    parser.add_argument('--baseline', help='比較するベースラインの JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='許容する悪化率 (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    results = []
+    for node_count in (int(n) for n in args.nodes.split(',')):
+        print(f"⏱  {node_count} ノードで計測中...", file=sys.stderr)
+        results.extend(bench_cluster(node_count, args))
+
+    report = {
+        'benchmark': 'colab_nodes',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'json', 'baseline')},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'scenario':<10}{'nodes':>6}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'ops/s':>9}{'req/s':>10}{'errors':>8}")
+        for r in results:
+            print(f"{r['scenario']:<10}{r['nodes']:>6}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['mean_ms']:>10.1f}"
+                  f"{r['ops_per_sec']:>9.1f}{r['node_requests_per_sec']:>10.1f}{r['client_errors']:>8}")
+        for r in results:
+            if r['scenario'] == 'tasks':
+                work = max(r['p50_ms'] - r['overhead_ms'], 1e-3)
+                print(f"tasks@{r['nodes']}: p50 {r['p50_ms']:.0f} ms (固定コスト {r['overhead_ms']:.0f} ms を除き {work:.0f} ms) / "
+                      f"理想 {r['ideal_ms']:.0f} ms (効率 {r['ideal_ms'] / work:.0%}) / 静的分割 {r['static_ms']:.0f} ms")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"❌ 悪化: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"✅ ベースラインから {args.tolerance * 100:.0f}% 以上の悪化なし", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+# =============================================================================
+# IMPORT TIME BUDGET - マジックコマンド拡張の読み込み時間チェック
+# =============================================================================
+#
+# カーネル起動時に走る「モジュール読み込み + load_ipython_extension」の時間を計測し、
+# 予算を超えるか、重い依存 (requests / aiohttp / transformers など) を起動時に
+# 読み込んでいたら終了コード 1 を返す。CI やコミット前の回帰チェック用。
+#
+#   python PlotType/check_import_time.py
+#   python PlotType/check_import_time.py --budget-ms 20 --repeat 9 --json
+#
+# 計測は別プロセスで行い、IPython 本体 (カーネルでは既に読み込み済み) の読み込みは含めない。
+# 拡張が新たに読み込んだモジュールは -X importtime の出力から集計して表示する。
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+EXTENSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'magic-commands-colab.py')
+
+# 起動時に読み込んではいけないモジュール (該当マジックの初回実行時に読み込む)
+DEFERRED_MODULES = (
+    'requests', 'aiohttp', 'huggingface_hub', 'transformers',
+    'torch', 'safetensors', 'accelerate', 'concurrent.futures'
+)
+
+MARKER = '--- labflow extension ---'
+
+# 子プロセスで実行するコード: IPython を読み込んだ後 (= カーネルの状態) から計測する
+CHILD_SOURCE = f'''
+import sys, time, json, importlib.util
+import IPython.core.magic
+
+class Shell:
+    """load_ipython_extension が使う最小限のシェル"""
+    def __init__(self):
+        self.configurables = []
+        self.user_ns = {{}}
+        self.magics = []
+    def register_magics(self, *classes):
+        self.magics.extend(cls(shell=self) for cls in classes)
+
+shell = Shell()
+before = set(sys.modules)
+sys.stderr.write({MARKER!r} + '\\n')
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('ai_dev_extension.magics', {EXTENSION_PATH!r})
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+module.load_ipython_extension(shell)
+registered = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - start) * 1000,
+    'register_ms': (registered - imported) * 1000,
+    'modules': sorted(set(sys.modules) - before - {{spec.name}})
+}}))
+'''
+
+
+def measure() -> dict:
+    """1回分の計測 (バイトコードキャッシュを使う通常の起動条件で実行)"""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD_SOURCE],
+        capture_output=True, text=True, env=env
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"拡張の読み込みに失敗しました:\n{result.stderr[-2000:]}")
+
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    # マーカー以降の importtime 出力 = 拡張が新たに読み込んだモジュール
+    lines = result.stderr.split(MARKER, 1)[-1].splitlines()
+    stats['importtime'] = []
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace('import time:', '|').split('|')]
+        stats['importtime'].append({'module': name, 'self_us': int(self_us), 'cumulative_us': int(cumulative_us)})
+    return stats
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='マジックコマンド拡張の読み込み時間チェック')
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('LABFLOW_IMPORT_BUDGET_MS', 30)),
+                        help='読み込み + 登録の中央値の上限 (ms)')
+    parser.add_argument('--repeat', type=int, default=5, help='計測回数 (中央値で判定)')
+    parser.add_argument('--json', action='store_true', help='結果を JSON で出力')
+    args = parser.parse_args()
+
+    measure()  # バイトコードキャッシュを作るためのウォームアップ
+    runs = [measure() for _ in range(args.repeat)]
+    total_ms = statistics.median(run['import_ms'] + run['register_ms'] for run in runs)
+    import_ms = statistics.median(run['import_ms'] for run in runs)
+    register_ms = statistics.median(run['register_ms'] for run in runs)
+    loaded = sorted({
+        module for run in runs for module in run['modules']
+        if any(module == name or module.startswith(name + '.') for name in DEFERRED_MODULES)
+    })
+    slowest = sorted(runs[-1]['importtime'], key=lambda item: -item['self_us'])[:10]
+    ok = total_ms <= args.budget_ms and not loaded
+
+    if args.json:
+        print(json.dumps({
+            'ok': ok,
+            'budget_ms': args.budget_ms,
+            'total_ms': total_ms,
+            'import_ms': import_ms,
+            'register_ms': register_ms,
+            'deferred_modules_loaded': loaded,
+            'slowest_imports': slowest
+        }, indent=2))
+    else:
+        print(f"{'✅' if ok else '❌'} 拡張の読み込み: {total_ms:.1f} ms (予算 {args.budget_ms:.1f} ms)")
+        print(f"   モジュール読み込み: {import_ms:.1f} ms / 登録: {register_ms:.1f} ms (中央値, {args.repeat} 回)")
+        if loaded:
+            print(f"   ⚠️  起動時に読み込まれた重い依存: {', '.join(loaded)}")
+        if slowest:
+            print("   新たに読み込まれたモジュール (self 時間の上位):")
+            for item in slowest:
+                print(f"     {item['self_us'] / 1000:6.2f} ms  {item['module']}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
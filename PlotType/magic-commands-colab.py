@@ -2,16 +2,2576 @@
 # MAGIC COMMANDS - JupyterLab ノートブック内で使用可能なマジックコマンド
 # =============================================================================
 
+# 起動を速くするため、requests / aiohttp / asyncio / IPython.display などの重い依存は
+# それを使うマジックの初回実行時に読み込む (PlotType/check_import_time.py で計測)
 from IPython.core.magic import Magics, magics_class, line_magic, cell_magic
-from IPython.core.display import display, HTML, JSON
-import requests
 import json
 import os
 import time
-from typing import Dict, List, Optional, Any
-import subprocess
-import asyncio
-import aiohttp
+import gc
+import re
+import html
+import random
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+import queue
+import heapq
+import math
+import functools
+import itertools
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any, Tuple, Iterator
+from collections import OrderedDict, deque
+
+
+# =============================================================================
+# INSTRUMENTATION - 外部呼び出しとマジック実行の計測 (%aidev_stats)
+# =============================================================================
+
+class LatencyHistogram:
+    """
+    対数バケットのレイテンシ・ヒストグラム (秒)
+    境界は 0.1ms から 2^(1/4) 倍ずつ増えるので、パーセンタイルの誤差は約 ±9% で
+    件数に関係なくメモリは一定
+    """
+
+    BASE = 1e-4
+    GROWTH = 2 ** 0.25
+    BUCKETS = 96  # 上限 0.1ms * 2^24 ≈ 28分
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        if seconds <= self.BASE:
+            index = 0
+        else:
+            index = min(int(math.log(seconds / self.BASE, self.GROWTH)) + 1, self.BUCKETS)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """バケット上端で近似したパーセンタイル (秒)"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if count and running >= target:
+                return min(self.BASE * self.GROWTH ** index, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        """ミリ秒単位の要約"""
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(0.50) * 1000,
+            'p90_ms': self.percentile(0.90) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'max_ms': self.max * 1000
+        }
+
+
+@dataclass
+class CallStats:
+    """1つのノード×エンドポイント (またはマジック) の集計"""
+    total: LatencyHistogram = field(default_factory=LatencyHistogram)
+    connect: LatencyHistogram = field(default_factory=LatencyHistogram)
+    ttfb: LatencyHistogram = field(default_factory=LatencyHistogram)
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    outcomes: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def errors(self) -> int:
+        return sum(count for outcome, count in self.outcomes.items() if outcome != 'ok')
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'total': self.total.summary(),
+            'connect': self.connect.summary(),
+            'ttfb': self.ttfb.summary(),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'outcomes': dict(self.outcomes)
+        }
+
+
+class Instrumentation:
+    """
+    外部呼び出し (ノード×エンドポイント) とマジック実行ごとの計測値
+    パスの job_id や blob ハッシュはテンプレートに置き換えるので、キー数は呼び出し回数に比例しない
+    """
+
+    MAX_KEYS = 1024  # 想定外にキーが増えても '(other)' にまとめてメモリを抑える
+    PATH_PATTERNS = [
+        (re.compile(r'/job/[^/]+'), '/job/<id>'),
+        (re.compile(r'/artifacts/.+'), '/artifacts/<path>'),
+        (re.compile(r'/blobs/[0-9a-f]{64}'), '/blobs/<digest>')
+    ]
+
+    def __init__(self):
+        self.calls: Dict[Tuple[str, str], CallStats] = {}
+        self.magics: Dict[str, CallStats] = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def endpoint(cls, path: str) -> str:
+        path = path.split('?', 1)[0]
+        for pattern, template in cls.PATH_PATTERNS:
+            path = pattern.sub(template, path)
+        return path
+
+    def _stats(self, table: Dict, key: Any) -> CallStats:
+        stats = table.get(key)
+        if stats is None:
+            if len(table) >= self.MAX_KEYS:
+                key = ('(other)', '(other)') if isinstance(key, tuple) else '(other)'
+            stats = table.setdefault(key, CallStats())
+        return stats
+
+    def record_call(self, node: str, path: str, total: float, connect: Optional[float] = None,
+                    ttfb: Optional[float] = None, sent: int = 0, received: int = 0, outcome: str = 'ok') -> None:
+        with self._lock:
+            stats = self._stats(self.calls, (node, self.endpoint(path)))
+            stats.total.add(total)
+            if connect is not None:
+                stats.connect.add(connect)
+            if ttfb is not None:
+                stats.ttfb.add(ttfb)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+
+    def record_magic(self, name: str, total: float, outcome: str = 'ok') -> None:
+        with self._lock:
+            stats = self._stats(self.magics, name)
+            stats.total.add(total)
+            stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.magics.clear()
+            self.started_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'exported_at': time.time(),
+                'calls': [
+                    dict(node=node, endpoint=endpoint, **stats.to_dict())
+                    for (node, endpoint), stats in sorted(self.calls.items())
+                ],
+                'magics': [dict(magic=name, **stats.to_dict()) for name, stats in sorted(self.magics.items())]
+            }
+
+
+# =============================================================================
+# COLAB NODE CLIENT - 複数ノードへの並列リクエスト
+# =============================================================================
+
+@dataclass
+class NodeResponse:
+    """ノード単位のレスポンス"""
+    node_id: str
+    url: str
+    data: Any = None
+    status: Optional[int] = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+    timings: Dict[str, float] = field(default_factory=dict)  # connect / ttfb (秒)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class LatencyEstimate:
+    """
+    1エンドポイントの応答時間の推定 (TCP の再送タイムアウトと同じ平滑化)
+    タイムアウトは srtt + 4 * rttvar を MIN_TIMEOUT 以上・呼び出し元の指定以下に収めた値で、
+    適応タイムアウトで打ち切るたびに倍にする (応答があれば元に戻る)
+    """
+    srtt: float = 0.0
+    rttvar: float = 0.0
+    samples: int = 0
+    backoff: int = 1
+
+    MIN_SAMPLES = 3     # これより少ない間は呼び出し元のタイムアウトをそのまま使う
+    MIN_TIMEOUT = 1.0   # 秒
+    MAX_BACKOFF = 16
+
+    def add(self, seconds: float) -> None:
+        if self.samples == 0:
+            self.srtt, self.rttvar = seconds, seconds / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - seconds)
+            self.srtt = 0.875 * self.srtt + 0.125 * seconds
+        self.samples += 1
+        self.backoff = 1
+
+    def timeout(self, limit: float) -> float:
+        if self.samples < self.MIN_SAMPLES:
+            return limit
+        return min(max(self.srtt + 4 * self.rttvar, self.MIN_TIMEOUT) * self.backoff, limit)
+
+
+@dataclass
+class NodeHealth:
+    """ノードの健全性 (エンドポイントごとの応答時間推定とサーキットブレーカー)"""
+    latency: Dict[str, LatencyEstimate] = field(default_factory=dict)
+    state: str = 'closed'   # 'closed': 通常 / 'open': 呼び出しをスキップし、バックグラウンドで再確認
+    failures: int = 0       # 連続失敗回数
+    last_error: Optional[str] = None
+    backoff: float = 0.0    # 次の再確認までの基準間隔 (秒)
+    retry_at: float = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.state != 'open'
+
+    def estimate(self, endpoint: str) -> LatencyEstimate:
+        return self.latency.setdefault(endpoint, LatencyEstimate())
+
+
+class ColabNodeClient:
+    """
+    Colab ノード用の非同期 HTTP クライアント
+    ノードごとに keep-alive セッションを1つ保持し、専用スレッドのイベントループ上で
+    全ノードへのリクエストを並列に実行する (カーネルのイベントループはブロックしない)
+    タイムアウトはノード×エンドポイントの応答時間から決め、FAILURE_THRESHOLD 回続けて
+    応答しないノードはサーキットを開いて即座にスキップする (復帰はバックグラウンドで確認)
+    """
+
+    FAILURE_THRESHOLD = 3
+    PROBE_BACKOFF = (1.0, 60.0)  # /health 再確認の間隔 (初回, 上限) 秒
+
+    def __init__(self, max_concurrency: int = 16, default_timeout: float = 10.0,
+                 stats: Optional[Instrumentation] = None):
+        self.max_concurrency = max_concurrency
+        self.default_timeout = default_timeout
+        self.stats = stats
+        self.health: Dict[str, NodeHealth] = {}
+        self._probes: Dict[str, 'asyncio.Task'] = {}
+        self._loop: Optional['asyncio.AbstractEventLoop'] = None
+        self._semaphore: Optional['asyncio.Semaphore'] = None
+        self._sessions: Dict[str, 'aiohttp.ClientSession'] = {}
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> 'asyncio.AbstractEventLoop':
+        """バックグラウンドのイベントループを起動 (初回のみ)"""
+        import asyncio
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='colab-node-client', daemon=True)
+                thread.start()
+                self._loop = loop
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._sessions = {}
+            return self._loop
+
+    def _session(self, url: str) -> 'aiohttp.ClientSession':
+        """ノードごとの keep-alive セッションを取得 (ループスレッド内で呼ぶ)"""
+        import aiohttp
+        session = self._sessions.get(url)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.max_concurrency, keepalive_timeout=60)
+            session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+            self._sessions[url] = session
+        return session
+
+    @staticmethod
+    def _trace_config() -> 'aiohttp.TraceConfig':
+        """新規接続 (DNS + TCP + TLS) にかかった時間を trace_request_ctx に記録"""
+        import aiohttp
+
+        async def on_connection_create_start(session, context, params):
+            context.trace_request_ctx['connect_start'] = time.perf_counter()
+
+        async def on_connection_create_end(session, context, params):
+            timing = context.trace_request_ctx
+            timing['connect'] = time.perf_counter() - timing.pop('connect_start')
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_start.append(on_connection_create_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        return trace
+
+    async def _request(self, node_id: str, url: str, method: str, path: str, body: Any,
+                       timeout: float, bounded: bool = True, adaptive: bool = True,
+                       probe: bool = False) -> NodeResponse:
+        """
+        1リクエストを実行してノードの健全性を更新
+        adaptive=False (ロングポーリング) と bytes ボディ (転送時間が読めない) は指定タイムアウトのまま
+        probe=True はサーキットが開いていても送る (バックグラウンドの再確認用)
+        """
+        import asyncio
+        import aiohttp
+        start = time.perf_counter()
+        result = NodeResponse(node_id=node_id, url=url)
+        outcome, sent, received = 'ok', 0, 0
+        health = self.health.setdefault(node_id, NodeHealth())
+        estimate = health.estimate(Instrumentation.endpoint(path))
+        if not health.available and not probe:
+            # 停止中のノードにはネットワークに出ずに即座に失敗を返す
+            result.error = (f"応答のないノードのためスキップ (連続失敗 {health.failures} 回, "
+                            f"{max(health.retry_at - time.time(), 0):.0f}s 後に再確認): {health.last_error}")
+            self._record(result, path, 'circuit_open', 0, 0)
+            return result
+        if adaptive and not isinstance(body, (bytes, bytearray)):
+            limit, timeout = timeout, estimate.timeout(timeout)
+        else:
+            limit = timeout
+        request_start = None
+        if bounded:
+            await self._semaphore.acquire()
+        try:
+            session = self._session(url)
+            # bytes はそのまま送信 (blob アップロード用)、それ以外は JSON
+            if body is None:
+                data, headers = b'', None
+            elif isinstance(body, (bytes, bytearray)):
+                data, headers = body, None
+            else:
+                data, headers = json.dumps(body).encode(), {'Content-Type': 'application/json'}
+            sent = len(data)
+            request_start = time.perf_counter()
+            async with session.request(
+                method, f"{url}{path}", data=data, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout), trace_request_ctx=result.timings
+            ) as response:
+                result.timings['ttfb'] = time.perf_counter() - request_start
+                result.status = response.status
+                raw = await response.read()
+                received = len(raw)
+                result.data = json.loads(raw) if raw else None
+                if response.status >= 400:
+                    message = result.data.get('error') if isinstance(result.data, dict) else None
+                    result.error = message or f"HTTP {response.status}"
+                    outcome = f"http_{response.status}"
+        except asyncio.TimeoutError:
+            result.error = f"タイムアウト ({timeout:.0f}s)"
+            outcome = 'timeout'
+        except Exception as e:
+            result.error = str(e) or type(e).__name__
+            outcome = type(e).__name__
+        finally:
+            if bounded:
+                self._semaphore.release()
+        result.elapsed = time.perf_counter() - start
+        self._record(result, path, outcome, sent, received)
+        
+        if self._is_node_failure(result, outcome):
+            health.failures += 1
+            health.last_error = result.error
+            if outcome == 'timeout' and timeout < limit:
+                estimate.backoff = min(estimate.backoff * 2, estimate.MAX_BACKOFF)
+            if health.available and health.failures >= self.FAILURE_THRESHOLD:
+                health.state = 'open'
+                health.backoff = self.PROBE_BACKOFF[0]
+                health.retry_at = time.time() + health.backoff
+                print(f"⚠️  {node_id} が {health.failures} 回続けて応答しないため、復帰するまで除外します")
+                self._probes[node_id] = asyncio.ensure_future(self._probe(node_id, url))
+        else:
+            if request_start is not None:
+                estimate.add(time.perf_counter() - request_start)
+            health.failures = 0
+            if not health.available:
+                health.state = 'closed'
+                print(f"✅ {node_id} が復帰しました")
+        return result
+
+    def _record(self, result: NodeResponse, path: str, outcome: str, sent: int, received: int) -> None:
+        if self.stats is not None:
+            self.stats.record_call(
+                result.node_id, path, result.elapsed, result.timings.get('connect'), result.timings.get('ttfb'),
+                sent, received, outcome
+            )
+
+    @staticmethod
+    def _is_node_failure(result: NodeResponse, outcome: str) -> bool:
+        """
+        ノード自体の不調とみなす失敗か (タイムアウト・接続エラー・ゲートウェイエラー)
+        4xx/500 はノードが応答しているので含めない。ngrok のエラーページなど JSON でない応答は含める
+        """
+        if outcome == 'ok':
+            return False
+        if outcome.startswith('http_'):
+            return result.status in (502, 503, 504)
+        return True
+
+    async def _probe(self, node_id: str, url: str) -> None:
+        """サーキットが開いたノードの /health をジッター付き指数バックオフで再確認 (応答すれば閉じる)"""
+        import asyncio
+        health = self.health[node_id]
+        while not health.available:
+            await asyncio.sleep(max(health.retry_at - time.time(), 0))
+            await self._request(node_id, url, 'GET', '/health', None, self.default_timeout,
+                                bounded=False, adaptive=False, probe=True)
+            health.backoff = min(health.backoff * 2, self.PROBE_BACKOFF[1])
+            health.retry_at = time.time() + health.backoff * random.uniform(0.5, 1.0)
+
+    def available(self, node_id: str) -> bool:
+        """サーキットが開いていない (ジョブの配置先にしてよい) ノードか"""
+        health = self.health.get(node_id)
+        return health is None or health.available
+
+    def fan_out(self, nodes: List[Tuple[str, str]], method: str, path: str,
+                bodies: Optional[Dict[str, Any]] = None,
+                timeout: Optional[float] = None, adaptive: bool = True) -> List[NodeResponse]:
+        """
+        複数ノードに同じエンドポイントのリクエストを並列送信
+        nodes: (node_id, url) のリスト / bodies: node_id ごとの JSON ボディ
+        結果は nodes と同じ順序で返す (例外は NodeResponse.error に格納)
+        """
+        bodies = bodies or {}
+        return self.batch(
+            [(node_id, url, method, path, bodies.get(node_id)) for node_id, url in nodes],
+            timeout, adaptive
+        )
+
+    def batch(self, calls: List[Tuple[str, str, str, str, Any]],
+              timeout: Optional[float] = None, adaptive: bool = True) -> List[NodeResponse]:
+        """
+        任意のリクエスト群を並列送信
+        calls: (node_id, url, method, path, body) のリスト (結果は同じ順序)
+        adaptive=False は応答時間が毎回大きく変わるエンドポイントと、/train や /job/<id>/cancel のような
+        状態を変える POST 用 (指定タイムアウトをそのまま使う。短いタイムアウトで打ち切ると実際には
+        ノード側で処理されたのに失敗扱いになる)
+        """
+        import asyncio
+        if not calls:
+            return []
+        timeout = timeout or self.default_timeout
+        loop = self._ensure_loop()
+
+        async def gather() -> List[NodeResponse]:
+            return await asyncio.gather(*(
+                self._request(node_id, url, method, path, body, timeout, adaptive=adaptive)
+                for node_id, url, method, path, body in calls
+            ))
+
+        return asyncio.run_coroutine_threadsafe(gather(), loop).result()
+
+    def request(self, node_id: str, url: str, method: str, path: str,
+                body: Any = None, timeout: Optional[float] = None, adaptive: bool = True) -> NodeResponse:
+        """単一ノードへのリクエスト"""
+        return self.fan_out([(node_id, url)], method, path, {node_id: body}, timeout, adaptive)[0]
+
+    def submit(self, node_id: str, url: str, method: str, path: str, body: Any = None,
+               timeout: Optional[float] = None, adaptive: bool = False) -> 'concurrent.futures.Future':
+        """
+        単一ノードへのリクエストを投入し、完了を待たずに Future (結果は NodeResponse) を返す
+        結果を長く待つ呼び出し用なので、同時実行数の上限に含めない
+        """
+        import asyncio
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(
+            self._request(node_id, url, method, path, body, timeout or self.default_timeout,
+                          bounded=False, adaptive=adaptive),
+            loop
+        )
+
+    def follow(self, nodes: List[Tuple[str, str]], path: str, wait: float = 25.0,
+               max_failures: int = 5) -> Iterator[NodeResponse]:
+        """
+        各ノードのロングポーリング・エンドポイントを並列に追跡するジェネレータ
+        サーバーは {'events': [...], 'cursor': n, 'done': bool} を返す前提で、
+        イベントが届いたノードから順に NodeResponse を返す (全ノード done で終了)
+        ロングポーリングは同時実行数の上限に含めない
+        """
+        import asyncio
+        loop = self._ensure_loop()
+        results: queue.Queue = queue.Queue()
+        separator = '&' if '?' in path else '?'
+
+        async def poll(node_id: str, url: str) -> None:
+            cursor, failures = 0, 0
+            try:
+                while True:
+                    res = await self._request(
+                        node_id, url, 'GET', f"{path}{separator}cursor={cursor}&wait={wait}",
+                        None, wait + 10, bounded=False, adaptive=False
+                    )
+                    if res.ok:
+                        failures = 0
+                        cursor = res.data.get('cursor', cursor)
+                        if res.data.get('events'):
+                            results.put(res)
+                        if res.data.get('done'):
+                            break
+                    else:
+                        failures += 1
+                        results.put(res)
+                        if failures >= max_failures:
+                            break
+                        await asyncio.sleep(min(2 ** failures, 10))
+            finally:
+                results.put(None)  # ノード終了マーカー
+
+        tasks = [asyncio.run_coroutine_threadsafe(poll(node_id, url), loop) for node_id, url in nodes]
+        remaining = len(tasks)
+        try:
+            while remaining:
+                item = results.get()
+                if item is None:
+                    remaining -= 1
+                    continue
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def close(self) -> None:
+        """全セッションを閉じてイベントループを停止"""
+        import asyncio
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None or loop.is_closed():
+            return
+
+        async def close_sessions():
+            for task in self._probes.values():
+                task.cancel()
+            self._probes = {}
+            for session in self._sessions.values():
+                await session.close()
+            self._sessions = {}
+
+        asyncio.run_coroutine_threadsafe(close_sessions(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+# =============================================================================
+# JOB SCHEDULER - リソース状況に基づくジョブ配置とキューイング
+# =============================================================================
+
+@dataclass(order=True)
+class QueuedJob:
+    """配置待ちジョブ (priority の高い順 → 投入順に並ぶ)"""
+    sort_key: Tuple[int, int]
+    job_id: str = field(compare=False)
+    node_count: int = field(compare=False)
+    epochs: int = field(compare=False)
+    code: str = field(compare=False)
+    min_gpu_mem: float = field(compare=False, default=0.0)  # GB
+    priority: int = field(compare=False, default=0)
+    files: Dict[str, str] = field(compare=False, default_factory=dict)    # 相対パス -> sha256
+    blobs: Dict[str, bytes] = field(compare=False, default_factory=dict)  # sha256 -> 内容
+    data: Optional['DatasetShards'] = field(compare=False, default=None)  # --data のシャード
+    tasks: Optional[int] = field(compare=False, default=None)  # --tasks の範囲 [0, tasks)
+    submitted_at: float = field(compare=False, default_factory=time.time)
+
+
+class JobScheduler:
+    """
+    /resources の直近値と各ノードの実行中ジョブ数からジョブの配置先を決める
+    すぐに配置できないジョブはローカルキューで待機し、空きが出たら自動で投入する
+    """
+
+    def __init__(self, client: ColabNodeClient, nodes: Dict[str, str], jobs: Dict[str, Dict],
+                 max_jobs_per_node: int = 1, resource_ttl: float = 10.0, poll_interval: float = 5.0):
+        self.client = client
+        self.nodes = nodes  # AIDevMagics.colab_nodes を共有
+        self.jobs = jobs    # AIDevMagics.active_jobs を共有
+        self.max_jobs_per_node = max_jobs_per_node
+        self.resource_ttl = resource_ttl
+        self.poll_interval = poll_interval
+        self.resources: Dict[str, Dict] = {}
+        self.dispatch = None  # Callable[[QueuedJob, List[Tuple[str, str]]], bool]
+        self._resources_at = 0.0
+        self._queue: List[QueuedJob] = []
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+        self._thread: Optional[threading.Thread] = None
+
+    def new_job(self, job_id: str, node_count: int, epochs: int, code: str,
+                min_gpu_mem: float = 0.0, priority: int = 0,
+                files: Optional[Dict[str, str]] = None,
+                blobs: Optional[Dict[str, bytes]] = None,
+                data: Optional['DatasetShards'] = None,
+                tasks: Optional[int] = None) -> QueuedJob:
+        return QueuedJob(
+            sort_key=(-priority, next(self._seq)), job_id=job_id, node_count=node_count,
+            epochs=epochs, code=code, min_gpu_mem=min_gpu_mem, priority=priority,
+            files=files or {}, blobs=blobs or {}, data=data, tasks=tasks
+        )
+
+    def refresh_resources(self, force: bool = False) -> None:
+        """全ノードの /resources を並列取得 (TTL 内はキャッシュを使用)"""
+        if not force and time.time() - self._resources_at < self.resource_ttl:
+            return
+        responses = self.client.fan_out(list(self.nodes.items()), 'GET', '/resources', timeout=5)
+        self.resources = {res.node_id: res.data for res in responses if res.ok}
+        self._resources_at = time.time()
+
+    def refresh_job_status(self) -> None:
+        """実行中ジョブの完了を検知して active_jobs に反映 (ノードごとに /jobs を1回)"""
+        running = {job_id: info for job_id, info in list(self.jobs.items()) if info.get('status') == 'running'}
+        by_node: Dict[str, List[str]] = {}
+        urls: Dict[str, str] = {}
+        for job_id, info in running.items():
+            for node_id, url in info['nodes']:
+                by_node.setdefault(node_id, []).append(job_id)
+                urls[node_id] = url
+        
+        calls = [
+            (node_id, urls[node_id], 'GET', f"/jobs?ids={','.join(job_ids)}", None)
+            for node_id, job_ids in by_node.items()
+        ]
+        reported: Dict[str, Dict[str, str]] = {}  # job_id -> {node_id: status}
+        answered = set()
+        for res in self.client.batch(calls, timeout=5):
+            if res.ok:
+                answered.add(res.node_id)
+                for job_id, summary in res.data.get('jobs', {}).items():
+                    reported.setdefault(job_id, {})[res.node_id] = summary.get('status')
+        
+        for job_id, info in running.items():
+            statuses = reported.setdefault(job_id, {})
+            for node_id, _ in info['nodes']:
+                if node_id in answered and node_id not in statuses:
+                    statuses[node_id] = 'error'  # 応答したのにジョブを知らない (再起動などで失われた)
+            if len(statuses) < len(info['nodes']):
+                continue  # 応答のないノードがある間は実行中とみなす
+            states = set(statuses.values())
+            if states <= {'completed', 'error', 'cancelled'}:
+                if 'error' in states:
+                    info['status'] = 'error'
+                elif 'cancelled' in states:
+                    info['status'] = 'cancelled'
+                else:
+                    info['status'] = 'completed'
+
+    def running_jobs(self, node_id: str) -> int:
+        return sum(
+            1 for info in list(self.jobs.values())
+            if info.get('status') == 'running' and any(n == node_id for n, _ in info['nodes'])
+        )
+
+    @staticmethod
+    def free_gpu_memory(resources: Dict) -> int:
+        return max((gpu.get('memory_free', 0) for gpu in resources.get('gpu') or []), default=0)
+
+    def place(self, job: QueuedJob) -> Optional[List[Tuple[str, str]]]:
+        """
+        条件を満たすノードを空いている順に選ぶ (足りなければ None)
+        優先順: 実行中ジョブ数が少ない → 空き GPU メモリが多い → CPU 使用率が低い
+        """
+        self.refresh_resources()
+        candidates = []
+        for node_id, url in self.nodes.items():
+            resources = self.resources.get(node_id)
+            if resources is None or not self.client.available(node_id):
+                continue  # /resources に応答しない・サーキットが開いているノードは除外
+            running = self.running_jobs(node_id)
+            if running >= self.max_jobs_per_node:
+                continue
+            free_gpu = self.free_gpu_memory(resources)
+            if free_gpu < job.min_gpu_mem * 1024 ** 3:
+                continue
+            cpu_usage = resources.get('cpu', {}).get('usage', 0)
+            candidates.append(((running, -free_gpu, cpu_usage), node_id, url))
+
+        if len(candidates) < job.node_count:
+            return None
+        candidates.sort()
+        return [(node_id, url) for _, node_id, url in candidates[:job.node_count]]
+
+    def submit(self, job: QueuedJob) -> bool:
+        """ジョブをキューに入れて即時配置を試みる (配置できたら True)"""
+        with self._lock:
+            heapq.heappush(self._queue, job)
+        # 終了済みのジョブを反映してから配置する (poll_interval 待たずに空いたノードを使う)
+        self.refresh_job_status()
+        self.drain()
+        if self.queue_position(job.job_id) is None:
+            return True
+        self._ensure_worker()
+        return False
+
+    def drain(self) -> None:
+        """
+        キュー先頭から配置できる限り投入 (優先度を守るため先頭が詰まったら止める)
+        配置 (/resources の取得を含む) はロックの外で行い、取り出す前に先頭が変わっていないか確かめる
+        """
+        while True:
+            with self._lock:
+                if not self._queue:
+                    return
+                job = self._queue[0]
+            nodes = self.place(job)
+            with self._lock:
+                if not self._queue or self._queue[0] is not job:
+                    continue  # 配置中にキャンセルされた・優先度の高いジョブが入った
+                if nodes is None:
+                    return
+                heapq.heappop(self._queue)
+            self.dispatch(job, nodes)
+
+    def cancel(self, job_id: str) -> bool:
+        """ローカルキューで待機中のジョブを取り除く (待機中でなければ False)"""
+        with self._lock:
+            for idx, job in enumerate(self._queue):
+                if job.job_id == job_id:
+                    self._queue.pop(idx)
+                    heapq.heapify(self._queue)
+                    return True
+        return False
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        with self._lock:
+            ordered = sorted(self._queue)
+        for position, job in enumerate(ordered, 1):
+            if job.job_id == job_id:
+                return position
+        return None
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='colab-job-scheduler', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        """キューが空になるまで定期的に空き状況を確認して投入"""
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                if not self._queue:
+                    return
+            try:
+                self.refresh_job_status()
+                self.refresh_resources(force=True)
+                self.drain()
+            except Exception as e:
+                print(f"⚠️  スケジューラエラー: {str(e)}")
+
+
+# =============================================================================
+# TASK QUEUE - 処理速度の違うノードへの範囲の動的配布 (%%colab_train --tasks)
+# =============================================================================
+
+@dataclass
+class TaskRange:
+    """ノードに渡すインデックス範囲 [start, end)"""
+    range_id: int
+    start: int
+    end: int
+    attempts: int = 0  # ノードの不調で返らなかった回数
+    leases: Dict[str, float] = field(default_factory=dict)  # 実行中のノード -> 実行開始の見込み時刻
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+
+@dataclass
+class NodeThroughput:
+    """ノードの処理速度 (ワーカーが報告する work() の実行時間から推定)"""
+    rate: float = 0.0  # 件/秒 (指数移動平均, 0 は未計測)
+    items: int = 0     # 採用された結果の件数
+    ranges: int = 0    # 実行した範囲の数 (採用されなかった重複実行を含む)
+    busy: float = 0.0  # work() の実行時間の合計 (秒)
+    failures: int = 0
+
+    def add(self, size: int, seconds: float) -> None:
+        sample = size / max(seconds, 1e-6)
+        self.rate = sample if self.rate == 0 else 0.5 * self.rate + 0.5 * sample
+        self.ranges += 1
+        self.busy += seconds
+
+
+class WorkQueue:
+    """
+    インデックス [0, total) を範囲に切り出し、手の空いたノードから順に配る
+    範囲の大きさは残り / (2 × ノード数) から始めてキューが減るほど小さくする (guided self-scheduling)
+    計測済みのノードは「処理速度 × target_seconds」を上限、MIN_SECONDS 分を下限にするので、
+    遅いノードに大きな範囲が残って全体が待たされることも、終盤の往復時間で止まることもない
+    返らなかった範囲は他のノードに回し、未配布の範囲がなくなったら、遅いノードが実行中の範囲を
+    空いたノードでも実行する (先に返った結果を採用)
+    """
+
+    MAX_LEASES = 2  # 1つの範囲を同時に実行するノード数の上限
+    SPLIT = 2           # 残りをノード数 × SPLIT 等分した大きさで切り出す
+    MIN_SECONDS = 0.05  # 1範囲の処理時間の下限 (範囲が小さすぎると往復時間で処理が止まる)
+
+    def __init__(self, total: int, min_size: int = 1, target_seconds: float = 2.0, max_attempts: int = 3):
+        self.total = total
+        self.min_size = max(min_size, 1)
+        self.target_seconds = target_seconds
+        self.max_attempts = max_attempts
+        self.throughput: Dict[str, NodeThroughput] = {}
+        self.in_flight: Dict[int, TaskRange] = {}  # 配布済みで結果が未採用の範囲
+        self.completed = 0   # 採用した結果の件数
+        self.duplicates = 0  # 採用されなかった重複実行の範囲数
+        self.retries = 0
+        self._cursor = 0     # 未配布の先頭
+        self._retry: 'deque[TaskRange]' = deque()
+        self._ready_at: Dict[str, float] = {}  # ノードが受け取り済みの範囲を終える見込み時刻
+        self._ids = itertools.count()
+
+    @property
+    def done(self) -> bool:
+        return self.completed >= self.total
+
+    def take(self, node_id: str, active_nodes: int) -> Optional[TaskRange]:
+        """node_id に次の範囲を割り当てる (渡せる範囲がなければ None)"""
+        speed = self.throughput.setdefault(node_id, NodeThroughput())
+        if self._retry:
+            task = self._retry.popleft()
+        elif self._cursor < self.total:
+            remaining = self.total - self._cursor
+            size = -(-remaining // (self.SPLIT * max(active_nodes, 1)))
+            if speed.rate:
+                size = min(size, int(speed.rate * self.target_seconds))
+                size = max(size, int(speed.rate * self.MIN_SECONDS))
+            size = min(max(size, self.min_size), remaining)
+            task = TaskRange(next(self._ids), self._cursor, self._cursor + size)
+            self.in_flight[task.range_id] = task
+            self._cursor += size
+        else:
+            task = self._straggler(node_id)
+            if task is None:
+                return None
+        # ノードは届いた順に1範囲ずつ実行するので、先に渡した範囲が終わってから始まる
+        start = max(time.time(), self._ready_at.get(node_id, 0.0))
+        task.leases[node_id] = start
+        self._ready_at[node_id] = start + (task.size / speed.rate if speed.rate else 0.0)
+        return task
+
+    def _straggler(self, node_id: str) -> Optional[TaskRange]:
+        """実行中の範囲のうち、node_id が今から実行した方が最も早く終わるもの"""
+        rate = self.throughput[node_id].rate
+        if rate == 0:
+            return None
+        now = time.time()
+        ready = max(now, self._ready_at.get(node_id, 0.0))
+        best, best_gain = None, 0.0
+        for task in self.in_flight.values():
+            if not task.leases or node_id in task.leases or len(task.leases) >= self.MAX_LEASES:
+                continue
+            gain = min(self._eta(owner, started, task.size) for owner, started in task.leases.items())
+            gain -= ready + task.size / rate
+            if gain > best_gain:
+                best, best_gain = task, gain
+        return best
+
+    def _eta(self, node_id: str, started: float, size: int) -> float:
+        """node_id が実行中の範囲の終了見込み時刻 (未計測のノードは target_seconds を過ぎたら遅れとみなす)"""
+        rate = self.throughput[node_id].rate
+        if rate:
+            return started + size / rate
+        return math.inf if time.time() - started > self.target_seconds else started
+
+    def _update_ready_at(self, node_id: str) -> None:
+        """範囲が返ったら、まだ結果待ちの範囲から終了見込み時刻を計算し直す"""
+        rate = self.throughput[node_id].rate
+        queued = sum(task.size for task in self.in_flight.values() if node_id in task.leases)
+        self._ready_at[node_id] = time.time() + (queued / rate if rate else 0.0)
+
+    def complete(self, task: TaskRange, node_id: str, seconds: float) -> bool:
+        """結果を記録 (最初に返った結果なら True、重複実行の遅れた方なら False)"""
+        speed = self.throughput.setdefault(node_id, NodeThroughput())
+        speed.add(task.size, seconds)
+        task.leases.pop(node_id, None)
+        adopted = self.in_flight.pop(task.range_id, None) is not None
+        self._update_ready_at(node_id)
+        if not adopted:
+            self.duplicates += 1
+            return False
+        speed.items += task.size
+        self.completed += task.size
+        return True
+
+    def release(self, task: TaskRange, node_id: str, failed: bool = True) -> None:
+        """
+        node_id から結果が返らなかった範囲を配布待ちに戻す (他のノードが実行中ならそちらに任せる)
+        failed=False はノードがまだ受け付けられないだけなので失敗回数に数えない
+        """
+        task.leases.pop(node_id, None)
+        self.throughput.setdefault(node_id, NodeThroughput())
+        self._update_ready_at(node_id)
+        if failed:
+            self.throughput[node_id].failures += 1
+        if task.range_id not in self.in_flight or task.leases:
+            return
+        if failed:
+            task.attempts += 1
+            if task.attempts >= self.max_attempts:
+                raise RuntimeError(f"範囲 [{task.start}, {task.end}) が {task.attempts} 回続けて返りませんでした")
+            self.retries += 1
+        self._retry.appendleft(task)
+
+
+class TaskCoordinator:
+    """
+    各ノードのタスクキューモードのジョブに WorkQueue の範囲を配り、結果を集める
+    ノードごとに depth 個の範囲を送っておき (実行中 + 次の1つ)、1つ返るたびに次を送るので
+    速いノードほど多くの範囲を処理し、全体の所要時間はクラスタ全体の処理速度で決まる
+    """
+
+    QUEUED_RETRY = 2.0       # ノード側でジョブが実行待ちの間の再送間隔 (秒)
+    MIN_RANGE_TIMEOUT = 30.0
+
+    def __init__(self, client: ColabNodeClient, job_id: str, nodes: List[Tuple[str, str]],
+                 work: WorkQueue, depth: int = 2, range_timeout: float = 600.0):
+        self.client = client
+        self.job_id = job_id
+        self.nodes = dict(nodes)
+        self.work = work
+        self.depth = depth
+        self.range_timeout = range_timeout
+        self.retired: Dict[str, str] = {}  # ジョブが動いていないノード -> 理由
+
+    def _timeout(self, node_id: str, task: TaskRange) -> float:
+        """範囲のタイムアウト (未計測のノードはセル本体の初期化を含むので range_timeout)"""
+        rate = self.work.throughput[node_id].rate
+        if rate == 0:
+            return self.range_timeout
+        return min(max(4 * self.depth * task.size / rate, self.MIN_RANGE_TIMEOUT), self.range_timeout)
+
+    def run(self, on_result=None) -> None:
+        """
+        全範囲の結果が揃うまで配布を続ける
+        on_result(task, value): 採用した範囲の結果ごとに呼ぶ (届いた順)
+        work() の例外・全ノードの離脱・同じ範囲の失敗の繰り返しは RuntimeError
+        """
+        import concurrent.futures
+        pending: Dict[Any, Tuple[str, TaskRange]] = {}
+        outstanding = {node_id: 0 for node_id in self.nodes}
+        paused_until: Dict[str, float] = {}
+        try:
+            while not self.work.done:
+                now = time.time()
+                active = [
+                    node_id for node_id in self.nodes
+                    if node_id not in self.retired and self.client.available(node_id)
+                ]
+                if not active and not pending:
+                    reasons = ', '.join(f"{node_id}: {reason}" for node_id, reason in self.retired.items())
+                    raise RuntimeError(f"範囲を実行できるノードがありません ({reasons or '全ノードが応答しません'})")
+                
+                for node_id in active:
+                    while outstanding[node_id] < self.depth and paused_until.get(node_id, 0) <= now:
+                        task = self.work.take(node_id, len(active))
+                        if task is None:
+                            break
+                        # ノード側も同じ時間だけ待つ (返らない範囲でリクエストを占有し続けない)
+                        timeout = self._timeout(node_id, task)
+                        future = self.client.submit(
+                            node_id, self.nodes[node_id], 'POST', f"/job/{self.job_id}/range",
+                            {'range_id': task.range_id, 'start': task.start, 'end': task.end, 'timeout': timeout},
+                            timeout=timeout
+                        )
+                        pending[future] = (node_id, task)
+                        outstanding[node_id] += 1
+                
+                if not pending:
+                    time.sleep(0.2)
+                    continue
+                finished, _ = concurrent.futures.wait(
+                    list(pending), timeout=1.0, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    node_id, task = pending.pop(future)
+                    outstanding[node_id] -= 1
+                    self._handle(node_id, task, future.result(), on_result, paused_until)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _handle(self, node_id: str, task: TaskRange, res: NodeResponse, on_result, paused_until: Dict[str, float]) -> None:
+        if res.ok:
+            if self.work.complete(task, node_id, res.data.get('seconds', res.elapsed)) and on_result:
+                on_result(task, res.data.get('value'))
+        elif res.status == 422:
+            raise RuntimeError(f"Node {node_id}: work({task.start}, {task.end}) が失敗しました - {res.error}")
+        elif res.status == 409:
+            # ノード側で他のジョブが終わるのを待っている
+            self.work.release(task, node_id, failed=False)
+            paused_until[node_id] = time.time() + self.QUEUED_RETRY
+        else:
+            if res.status in (404, 410) and node_id not in self.retired:
+                self.retired[node_id] = res.error
+                print(f"⚠️  Node {node_id}: ジョブが動いていないため以降の範囲は他のノードに回します - {res.error}")
+            self.work.release(task, node_id)
+
+
+# =============================================================================
+# DATASET SHARDING - %%colab_train --data 用のノード別シャード
+# =============================================================================
+
+@dataclass
+class DataChunk:
+    """データセットの1チャンク (内容は送信時に path から読み直すのでメモリに保持しない)"""
+    digest: str
+    path: str
+    offset: int
+    length: int
+    records: int = 0
+    header: bytes = b''  # NPY チャンクの先頭に付ける .npy ヘッダー
+
+    @property
+    def size(self) -> int:
+        return len(self.header) + self.length
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return self.header + f.read(self.length)
+
+
+class DatasetShards:
+    """
+    --data のデータセットを node_index ごとのシャードに分け、チャンク (blob) の一覧として保持
+    - ディレクトリ: ファイル単位で合計サイズが均等になるよう割り当て (大きいファイルは複数チャンク)
+    - .jsonl: 行の区切りでチャンクに分け、チャンク番号 % ノード数 のシャードに割り当て
+    - .npy: 先頭軸の行でチャンクに分け、同様に割り当て (各チャンクは単独で読める .npy)
+    チャンクは内容の sha256 で識別するので、ノードが既に持っているチャンクは再送しない
+    """
+
+    CHUNK_BYTES = 4 * 1024 ** 2
+    MIN_CHUNK_BYTES = 64 * 1024
+    CHUNKS_PER_NODE = 4  # 小さなデータでも各ノードに数チャンクずつ行き渡るようにする
+
+    def __init__(self, path: str, node_count: int):
+        self.path = os.path.abspath(path)
+        self.node_count = node_count
+        self.chunks: List[List[DataChunk]] = [[] for _ in range(node_count)]
+        self.files: List[List[Tuple[str, int, List[DataChunk]]]] = [[] for _ in range(node_count)]
+        if os.path.isdir(self.path):
+            self.format = 'files'
+            self._split_files()
+        elif self.path.endswith(('.jsonl', '.ndjson')):
+            self.format = 'jsonl'
+            self._split_records(self._jsonl_chunks(self._chunk_bytes()))
+        elif self.path.endswith('.npy'):
+            self.format = 'npy'
+            self._split_records(self._npy_chunks(self._chunk_bytes()))
+        else:
+            raise ValueError(f"未対応の形式です (ディレクトリ / .jsonl / .npy): {path}")
+
+    @staticmethod
+    def signature(path: str) -> Tuple:
+        """再分割が必要かの判定用 (ファイルの相対パス・サイズ・更新時刻)"""
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            stat = os.stat(path)
+            return (path, stat.st_size, stat.st_mtime_ns)
+        entries = []
+        for root, _, names in os.walk(path):
+            for name in names:
+                stat = os.stat(os.path.join(root, name))
+                entries.append((os.path.relpath(os.path.join(root, name), path), stat.st_size, stat.st_mtime_ns))
+        return (path, tuple(sorted(entries)))
+
+    @staticmethod
+    def _digest(path: str, offset: int, length: int, header: bytes = b'') -> str:
+        """ファイルの一部 (+ ヘッダー) の sha256 を 1MB ずつ読んで計算"""
+        digest = hashlib.sha256(header)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining:
+                data = f.read(min(remaining, 1024 * 1024))
+                if not data:
+                    raise OSError(f"読み込み中にファイルが短くなりました: {path}")
+                digest.update(data)
+                remaining -= len(data)
+        return digest.hexdigest()
+
+    def _chunk_bytes(self) -> int:
+        target = os.path.getsize(self.path) // (self.node_count * self.CHUNKS_PER_NODE)
+        return min(max(target, self.MIN_CHUNK_BYTES), self.CHUNK_BYTES)
+
+    def _split_files(self) -> None:
+        """ファイルを大きい順に、その時点で合計サイズが最も小さいシャードへ割り当てる"""
+        entries = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                full = os.path.join(root, name)
+                entries.append((os.path.getsize(full), os.path.relpath(full, self.path).replace(os.sep, '/'), full))
+        
+        loads = [(0, index) for index in range(self.node_count)]
+        for size, relative, full in sorted(entries, key=lambda entry: (-entry[0], entry[1])):
+            load, index = heapq.heappop(loads)
+            chunks = []
+            for offset in range(0, size, self.CHUNK_BYTES):
+                length = min(self.CHUNK_BYTES, size - offset)
+                chunks.append(DataChunk(self._digest(full, offset, length), full, offset, length))
+            self.files[index].append((relative, size, chunks))
+            heapq.heappush(loads, (load + size, index))
+        
+        for index in range(self.node_count):
+            self.files[index].sort()
+            self.chunks[index] = [chunk for _, _, chunks in self.files[index] for chunk in chunks]
+
+    def _split_records(self, chunks: Iterator[DataChunk]) -> None:
+        for position, chunk in enumerate(chunks):
+            self.chunks[position % self.node_count].append(chunk)
+
+    def _jsonl_chunks(self, chunk_bytes: int) -> Iterator[DataChunk]:
+        """行の区切りで chunk_bytes 前後のチャンクに分ける (1回の読み込みで sha256 も計算)"""
+        with open(self.path, 'rb') as f:
+            offset, length, records, digest = 0, 0, 0, hashlib.sha256()
+            for line in f:
+                digest.update(line)
+                length += len(line)
+                records += bool(line.strip())
+                if length >= chunk_bytes:
+                    yield DataChunk(digest.hexdigest(), self.path, offset, length, records)
+                    offset, length, records, digest = offset + length, 0, 0, hashlib.sha256()
+            if length:
+                yield DataChunk(digest.hexdigest(), self.path, offset, length, records)
+
+    def _npy_chunks(self, chunk_bytes: int) -> Iterator[DataChunk]:
+        """先頭軸の行範囲ごとに、元ファイルの該当バイト列に .npy ヘッダーを付けたチャンクを作る"""
+        import io
+        import numpy as np
+        from numpy.lib import format as npy_format
+        with open(self.path, 'rb') as f:
+            version = npy_format.read_magic(f)
+            read_header = npy_format.read_array_header_1_0 if version == (1, 0) else npy_format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            data_offset = f.tell()
+        if fortran_order or dtype.hasobject or not shape:
+            raise ValueError("NPY は C 順・数値型・1次元以上の配列のみ対応しています")
+        
+        row_bytes = dtype.itemsize * int(np.prod(shape[1:], dtype=np.int64))
+        rows_per_chunk = max(chunk_bytes // max(row_bytes, 1), 1)
+        for start in range(0, shape[0], rows_per_chunk):
+            rows = min(rows_per_chunk, shape[0] - start)
+            header = io.BytesIO()
+            fields = {'descr': npy_format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows, *shape[1:])}
+            try:
+                npy_format.write_array_header_1_0(header, fields)
+            except ValueError:
+                header = io.BytesIO()
+                npy_format.write_array_header_2_0(header, fields)  # 次元の多い配列はヘッダーが 64KB を超える
+            offset, length = data_offset + start * row_bytes, rows * row_bytes
+            yield DataChunk(
+                self._digest(self.path, offset, length, header.getvalue()), self.path,
+                offset, length, rows, header.getvalue()
+            )
+
+    def shard_bytes(self, node_index: int) -> int:
+        return sum(chunk.size for chunk in self.chunks[node_index])
+
+    def manifest(self, node_index: int) -> Dict[str, Any]:
+        """ノードに渡すシャード情報 (チャンクは digest のみ)"""
+        manifest = {
+            'format': self.format,
+            'name': os.path.basename(self.path),
+            'node_index': node_index,
+            'total_nodes': self.node_count,
+            'bytes': self.shard_bytes(node_index)
+        }
+        if self.format == 'files':
+            manifest['files'] = [
+                {'path': relative, 'size': size, 'chunks': [chunk.digest for chunk in chunks]}
+                for relative, size, chunks in self.files[node_index]
+            ]
+            manifest['records'] = len(manifest['files'])
+        else:
+            manifest['chunks'] = [chunk.digest for chunk in self.chunks[node_index]]
+            manifest['records'] = sum(chunk.records for chunk in self.chunks[node_index])
+        return manifest
+
+
+# =============================================================================
+# ARTIFACT PULL - %colab_pull 用のチャンク分割・再開可能ダウンロード
+# =============================================================================
+
+class ArtifactPuller:
+    """
+    ジョブの成果物を Range リクエストで part_size ごとに並列ダウンロード
+    各 part は STREAM_CHUNK ずつ .part ファイルの該当位置に書き込むので、メモリ使用量はファイルサイズに依存しない。
+    完了した part は dest/.labflow_pull.json に記録し、中断後の再実行では残りの part だけを取得する。
+    全 part がそろったら sha256 を検証してから本来のファイル名に置き換える
+    """
+
+    STREAM_CHUNK = 1024 * 1024
+    MAX_RETRIES = 5
+    JOURNAL_NAME = '.labflow_pull.json'
+
+    def __init__(self, dest: str, part_size: int = 32 * 1024 ** 2, workers: int = 8,
+                 stats: Optional[Instrumentation] = None):
+        import requests
+        self.dest = os.path.abspath(dest)
+        self.part_size = part_size
+        self.workers = workers
+        self.instrumentation = stats
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(workers, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.journal_path = os.path.join(self.dest, self.JOURNAL_NAME)
+        self.journal: Dict[str, Dict] = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                self.journal = json.load(f)
+        self.bytes_downloaded = 0
+        self._lock = threading.Lock()
+
+    def _save_journal(self) -> None:
+        """ジャーナルを一時ファイル経由で置き換える (書き込み途中で中断しても壊れない)"""
+        os.makedirs(self.dest, exist_ok=True)
+        tmp = f"{self.journal_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.journal, f)
+        os.replace(tmp, self.journal_path)
+
+    def target(self, relative: str) -> str:
+        target = os.path.normpath(os.path.join(self.dest, relative))
+        if not target.startswith(self.dest + os.sep):
+            raise ValueError(f"不正なファイルパス: {relative}")
+        return target
+
+    def _prepare(self, entry: Dict, relative: str) -> Optional[List[int]]:
+        """
+        取得が必要な part 番号を返す (取得・検証済みなら None)
+        サーバー上のファイルが前回から変わっていたら (etag/sha256 の不一致) 最初から取り直す
+        """
+        target = self.target(relative)
+        record = self.journal.get(relative)
+        same = (
+            record is not None and record['etag'] == entry['etag']
+            and record['sha256'] == entry.get('sha256') and record['part_size'] == self.part_size
+        )
+        if same and record['complete'] and os.path.exists(target) and os.path.getsize(target) == entry['size']:
+            return None
+        
+        if not (same and os.path.exists(f"{target}.part")):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(f"{target}.part", 'wb') as f:
+                f.truncate(entry['size'])  # 各 part を該当位置に書けるよう先に確保
+            record = {
+                'size': entry['size'], 'etag': entry['etag'], 'sha256': entry.get('sha256'),
+                'part_size': self.part_size, 'done': [], 'complete': False
+            }
+            with self._lock:
+                self.journal[relative] = record
+                self._save_journal()
+        
+        done = set(record['done'])
+        return [index for index in range(math.ceil(entry['size'] / self.part_size)) if index not in done]
+
+    def _fetch_part(self, node_id: str, url: str, job_id: str, entry: Dict, relative: str, index: int) -> None:
+        """1 part を Range リクエストで取得 (接続エラー・5xx・途中切断は指数バックオフで再試行)"""
+        import requests
+        from urllib.parse import quote
+        start = index * self.part_size
+        end = min(start + self.part_size, entry['size']) - 1
+        path = f"/job/{job_id}/artifacts/{quote(entry['path'])}"
+        # If-Range: サーバー上のファイルが変わっていたら部分応答ではなく 200 が返る
+        headers = {'Range': f"bytes={start}-{end}", 'If-Range': f'"{entry["etag"]}"'}
+        
+        for attempt in range(self.MAX_RETRIES):
+            request_start = time.perf_counter()
+            ttfb, received, outcome = None, 0, 'ok'
+            try:
+                with self.session.get(f"{url}{path}", headers=headers, stream=True, timeout=(10, 60)) as response:
+                    ttfb = time.perf_counter() - request_start
+                    if response.status_code == 200:
+                        outcome = 'http_200'
+                        raise RuntimeError("ダウンロード中にサーバー上のファイルが更新されました")
+                    if response.status_code != 206:
+                        outcome = f"http_{response.status_code}"
+                        if response.status_code < 500:
+                            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+                    else:
+                        with open(f"{self.target(relative)}.part", 'r+b') as f:
+                            f.seek(start)
+                            for chunk in response.iter_content(self.STREAM_CHUNK):
+                                f.write(chunk)
+                                received += len(chunk)
+                        if received == end - start + 1:
+                            break
+                        outcome = 'short_read'
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                outcome = type(e).__name__
+                if attempt == self.MAX_RETRIES - 1:
+                    raise
+            finally:
+                self._record(node_id, path, request_start, ttfb, received, outcome)
+            time.sleep(min(2 ** attempt, 30))
+        else:
+            raise RuntimeError(f"part {index} の取得に {self.MAX_RETRIES} 回失敗しました ({outcome})")
+        
+        with self._lock:
+            self.journal[relative]['done'].append(index)
+            self.bytes_downloaded += received
+            self._save_journal()
+
+    def _record(self, node_id: str, path: str, start: float, ttfb: Optional[float],
+                received: int, outcome: str) -> None:
+        if self.instrumentation is not None:
+            self.instrumentation.record_call(
+                node_id, path, time.perf_counter() - start, ttfb=ttfb, received=received, outcome=outcome
+            )
+
+    def _finalize(self, entry: Dict, relative: str) -> None:
+        """sha256 を検証して .part を本来のファイル名に置き換える (不一致なら次回は最初から)"""
+        target = self.target(relative)
+        if entry.get('sha256') and _file_sha256(f"{target}.part") != entry['sha256']:
+            os.remove(f"{target}.part")
+            with self._lock:
+                self.journal.pop(relative, None)
+                self._save_journal()
+            raise RuntimeError("sha256 が一致しません")
+        os.replace(f"{target}.part", target)
+        with self._lock:
+            self.journal[relative]['complete'] = True
+            self._save_journal()
+
+    def pull(self, sources: List[Tuple[str, str, str, Dict, str]], on_done=None) -> Dict[str, Any]:
+        """
+        sources: (node_id, url, job_id, 成果物エントリ, 保存先の相対パス) のリスト
+        part はノードごとに交互に投入し、全ノードから同時に取得する
+        戻り値: {'completed': [...], 'skipped': [...], 'failed': {相対パス: エラー}}
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        result = {'completed': [], 'skipped': [], 'failed': {}}
+        remaining: Dict[str, int] = {}
+        entries: Dict[str, Dict] = {}
+        per_node: Dict[str, List[Tuple]] = {}
+        for node_id, url, job_id, entry, relative in sources:
+            try:
+                parts = self._prepare(entry, relative)
+            except (OSError, ValueError) as e:
+                result['failed'][relative] = str(e)
+                continue
+            if parts is None:
+                result['skipped'].append(relative)
+                continue
+            remaining[relative] = len(parts)
+            entries[relative] = entry
+            per_node.setdefault(node_id, []).extend(
+                (node_id, url, job_id, entry, relative, index) for index in parts
+            )
+        
+        def finish(relative: str) -> None:
+            try:
+                self._finalize(entries[relative], relative)
+            except (OSError, RuntimeError) as e:
+                result['failed'][relative] = str(e)
+                return
+            result['completed'].append(relative)
+            if on_done:
+                on_done(relative, entries[relative]['size'])
+        
+        for relative, count in remaining.items():
+            if count == 0:
+                finish(relative)  # 空ファイルと、前回 part はそろったが検証前に中断したファイル
+        
+        tasks = [task for group in itertools.zip_longest(*per_node.values()) for task in group if task]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self._fetch_part, *task): task[4] for task in tasks}
+            for future in as_completed(futures):
+                relative = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    result['failed'].setdefault(relative, str(e))
+                    continue
+                remaining[relative] -= 1
+                if remaining[relative] == 0 and relative not in result['failed']:
+                    finish(relative)
+        return result
+
+
+# =============================================================================
+# MODEL CACHE - %hf_download 用のローカルモデルキャッシュ
+# =============================================================================
+
+def _file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """ファイルの sha256 (チャンク単位で読み込むのでメモリは一定)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelCache:
+    """
+    容量上限付きのモデルキャッシュ
+    ファイルは内容の sha256 ごとに blobs/ に1度だけ保存し、snapshots/<repo>/<revision>/ からハードリンクする
+    (リビジョン間で同じファイルはディスクを共有)。index.json に repo・revision・ファイルハッシュ・
+    最終アクセス時刻を記録し、容量を超えたら pin されていないものを LRU で削除する
+    """
+
+    def __init__(self, root: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.root = root or os.environ.get('LABFLOW_MODEL_CACHE', os.path.expanduser('~/.labflow/models'))
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('LABFLOW_MODEL_CACHE_GB', 50)) * 1024 ** 3)
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.root, 'index.json')
+        self._index: Optional[Dict[str, Dict]] = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(repo: str, revision: str) -> str:
+        return f"{repo}@{revision}"
+
+    def snapshot_dir(self, repo: str, revision: str) -> str:
+        return os.path.join(self.root, 'snapshots', repo.replace('/', '--'), revision)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'blobs', digest)
+
+    @property
+    def index(self) -> Dict[str, Dict]:
+        if self._index is None:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def total_bytes(self) -> int:
+        """キャッシュ全体のサイズ (共有 blob は1回だけ数える)"""
+        sizes = {}
+        for entry in self.index.values():
+            for meta in entry['files'].values():
+                sizes[meta['sha256']] = meta['size']
+        return sum(sizes.values())
+
+    def lookup(self, repo: str, revision: str, verify: bool = False) -> Optional[str]:
+        """
+        キャッシュ済みならスナップショットのパスを返す (ネットワークアクセスなし)
+        サイズは毎回、verify=True なら sha256 も照合し、壊れていればエントリを破棄する
+        """
+        key = self.key(repo, revision)
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            path = self.snapshot_dir(repo, revision)
+            for name, meta in entry['files'].items():
+                file_path = os.path.join(path, name)
+                intact = os.path.isfile(file_path) and os.path.getsize(file_path) == meta['size']
+                if not intact or (verify and _file_sha256(file_path) != meta['sha256']):
+                    print(f"⚠️  キャッシュ破損を検出: {key} ({name})")
+                    self.remove(key)
+                    return None
+            entry['last_access'] = time.time()
+            self._save_index()
+            return path
+
+    def fetch(self, repo: str, revision: str = 'main', source: Optional[str] = None,
+              refresh: bool = False, verify: bool = False) -> Tuple[str, bool]:
+        """
+        モデルをキャッシュ経由で取得し (スナップショットのパス, キャッシュヒット) を返す
+        source を指定すると Hub の代わりにローカルディレクトリ (<source>/<repo>[/<revision>]) から取得
+        """
+        if not refresh:
+            path = self.lookup(repo, revision, verify)
+            if path:
+                return path, True
+
+        os.makedirs(os.path.join(self.root, 'blobs'), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        try:
+            self._download(repo, revision, staging, source)
+
+            # 内容ごとに blob 化 (既にある blob は再利用)
+            files = {}
+            for dirpath, _, names in os.walk(staging):
+                for name in names:
+                    file_path = os.path.join(dirpath, name)
+                    relative = os.path.relpath(file_path, staging).replace(os.sep, '/')
+                    if relative.startswith('.cache/'):
+                        continue  # huggingface_hub の local_dir メタデータ
+                    digest = _file_sha256(file_path)
+                    files[relative] = {'sha256': digest, 'size': os.path.getsize(file_path)}
+                    if not os.path.exists(self.blob_path(digest)):
+                        os.replace(file_path, self.blob_path(digest))
+
+            key = self.key(repo, revision)
+            with self._lock:
+                if key in self.index:
+                    self.remove(key)
+                path = self.snapshot_dir(repo, revision)
+                for relative, meta in files.items():
+                    target = os.path.join(path, relative)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    try:
+                        os.link(self.blob_path(meta['sha256']), target)
+                    except OSError:
+                        shutil.copyfile(self.blob_path(meta['sha256']), target)
+
+                now = time.time()
+                self.index[key] = {
+                    'repo': repo,
+                    'revision': revision,
+                    'files': files,
+                    'size': sum(meta['size'] for meta in files.values()),
+                    'created': now,
+                    'last_access': now,
+                    'pinned': False
+                }
+                self.prune(keep=key)
+                self._save_index()
+            return path, False
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _download(self, repo: str, revision: str, dest: str, source: Optional[str]) -> None:
+        if source:
+            src = os.path.join(source, repo)
+            if os.path.isdir(os.path.join(src, revision)):
+                src = os.path.join(src, revision)
+            if not os.path.isdir(src):
+                raise FileNotFoundError(f"{src} が見つかりません")
+            shutil.copytree(src, dest, dirs_exist_ok=True)
+        else:
+            from huggingface_hub import snapshot_download
+            snapshot_download(repo_id=repo, revision=revision, local_dir=dest)
+
+    def remove(self, key: str) -> None:
+        """エントリを削除し、どこからも参照されなくなった blob を消す"""
+        with self._lock:
+            entry = self.index.pop(key, None)
+            if entry is None:
+                return
+            shutil.rmtree(self.snapshot_dir(entry['repo'], entry['revision']), ignore_errors=True)
+            referenced = {meta['sha256'] for other in self.index.values() for meta in other['files'].values()}
+            for meta in entry['files'].values():
+                if meta['sha256'] not in referenced:
+                    try:
+                        os.remove(self.blob_path(meta['sha256']))
+                    except OSError:
+                        pass
+            self._save_index()
+
+    def prune(self, max_bytes: Optional[int] = None, keep: Optional[str] = None) -> List[str]:
+        """容量上限まで pin されていないエントリを最終アクセスの古い順に削除"""
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        with self._lock:
+            candidates = sorted(
+                (entry['last_access'], key) for key, entry in self.index.items()
+                if not entry.get('pinned') and key != keep
+            )
+            for _, key in candidates:
+                if self.total_bytes() <= limit:
+                    break
+                self.remove(key)
+                removed.append(key)
+        return removed
+
+    def pin(self, key: str, pinned: bool = True) -> bool:
+        with self._lock:
+            if key not in self.index:
+                return False
+            self.index[key]['pinned'] = pinned
+            self._save_index()
+            return True
+
+
+class HubUploader:
+    """
+    HuggingFace Hub へのフォルダアップロード (Hub の HTTP API を直接使用)
+    1. 各ファイルを1パスで sha256 / git blob sha1 を計算 (サイズと mtime が同じならジャーナルの値を再利用)
+    2. リモートのツリーと比較して同じ内容のファイルを除外
+    3. LFS ファイルは batch API の指示に従い、マルチパートならチャンクを並列 PUT
+    4. 完了したチャンクと LFS オブジェクトはジャーナルに記録し、中断しても続きから再開
+       (batch API はマルチパートごとに新しいアップロード ID を返すので、最初の計画を保存して使い回す)
+    5. 1つのコミットにまとめて反映
+    endpoint (既定は HF_ENDPOINT) をローカルのスタンドインに向ければ Hub なしで動作確認できる
+    """
+
+    HASH_CHUNK_SIZE = 8 * 1024 * 1024
+    SAMPLE_SIZE = 512
+    MAX_RETRIES = 4
+
+    def __init__(self, repo: str, revision: str = 'main', endpoint: Optional[str] = None,
+                 token: Optional[str] = None, workers: int = 8, journal_dir: Optional[str] = None,
+                 stats: Optional[Instrumentation] = None):
+        import requests
+        self.repo = repo
+        self.revision = revision
+        self.endpoint = (endpoint or os.environ.get('HF_ENDPOINT', 'https://huggingface.co')).rstrip('/')
+        self.instrumentation = stats
+        self.workers = workers
+        self.session = requests.Session()
+        token = token or self._find_token()
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+
+        journal_dir = journal_dir or os.path.expanduser('~/.labflow/uploads')
+        os.makedirs(journal_dir, exist_ok=True)
+        self.journal_path = os.path.join(journal_dir, f"{repo.replace('/', '--')}@{revision}.json")
+        try:
+            with open(self.journal_path) as f:
+                self.journal = json.load(f)
+        except (OSError, ValueError):
+            self.journal = {}
+        self.journal.setdefault('hashes', {})
+        self.journal.setdefault('uploaded', [])
+        self.journal.setdefault('parts', {})
+        self._lock = threading.Lock()
+        self.stats = {'hashed': 0, 'skipped': 0, 'uploaded_bytes': 0, 'resumed_parts': 0}
+
+    @staticmethod
+    def _find_token() -> Optional[str]:
+        if os.environ.get('HF_TOKEN'):
+            return os.environ['HF_TOKEN']
+        try:
+            from huggingface_hub import get_token
+            return get_token()
+        except ImportError:
+            return None
+
+    def _save_journal(self) -> None:
+        with self._lock:
+            tmp_path = f"{self.journal_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.journal, f)
+            os.replace(tmp_path, self.journal_path)
+
+    def _api(self, kind: str) -> str:
+        from urllib.parse import quote
+        return f"{self.endpoint}/api/models/{self.repo}/{kind}/{quote(self.revision, safe='')}"
+
+    def _request(self, method: str, url: str, label: str, **kwargs) -> 'requests.Response':
+        """接続エラーと 5xx/429 は指数バックオフで再試行 (label は計測用のエンドポイント名)"""
+        import requests
+        timeout = kwargs.pop('timeout', 300)
+        for attempt in range(self.MAX_RETRIES):
+            if hasattr(kwargs.get('data'), 'seek'):
+                kwargs['data'].seek(0)  # ファイル本体を送り直す
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+                self._record(label, start, kwargs, response)
+                if response.status_code < 500 and response.status_code != 429:
+                    return response
+            except requests.exceptions.ConnectionError as e:
+                self._record(label, start, kwargs, outcome=type(e).__name__)
+                if attempt == self.MAX_RETRIES - 1:
+                    raise
+            time.sleep(min(2 ** attempt, 30))
+        return response
+
+    def _record(self, label: str, start: float, kwargs: Dict[str, Any],
+                response: Any = None, outcome: Optional[str] = None) -> None:
+        """%aidev_stats 用に1リクエストを記録 (ノード名は Hub のホスト)"""
+        if self.instrumentation is None:
+            return
+        from urllib.parse import urlparse
+        data = kwargs.get('data')
+        if hasattr(data, 'fileno'):
+            sent = os.fstat(data.fileno()).st_size
+        elif data is not None:
+            sent = len(data)
+        else:
+            sent = len(json.dumps(kwargs['json'])) if 'json' in kwargs else 0
+        if response is not None:
+            outcome = 'ok' if response.status_code < 400 else f"http_{response.status_code}"
+        self.instrumentation.record_call(
+            urlparse(self.endpoint).netloc, label, time.perf_counter() - start,
+            ttfb=response.elapsed.total_seconds() if response is not None else None,
+            sent=sent, received=len(response.content) if response is not None else 0, outcome=outcome
+        )
+
+    def create_repo(self, private: bool = False) -> None:
+        organization, _, name = self.repo.rpartition('/')
+        payload = {'name': name, 'type': 'model', 'private': private}
+        if organization:
+            payload['organization'] = organization
+        response = self._request('POST', f"{self.endpoint}/api/repos/create", 'repos/create', json=payload)
+        if response.status_code not in (200, 201, 409):  # 409: 既に存在
+            raise RuntimeError(f"リポジトリ作成に失敗: HTTP {response.status_code} {response.text[:200]}")
+
+    def scan(self, folder: str) -> Dict[str, Dict]:
+        """フォルダ内の全ファイルのハッシュとサンプルを1回の読み込みで求める"""
+        files = {}
+        for dirpath, dirnames, names in os.walk(folder):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in names:
+                file_path = os.path.join(dirpath, name)
+                relative = os.path.relpath(file_path, folder).replace(os.sep, '/')
+                stat = os.stat(file_path)
+                cached = self.journal['hashes'].get(relative)
+                if not (cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime):
+                    cached = self._hash_file(file_path, stat)
+                    self.stats['hashed'] += 1
+                    self.journal['hashes'][relative] = cached
+                files[relative] = dict(cached, local_path=file_path)
+        self._save_journal()
+        return files
+
+    def _hash_file(self, path: str, stat: os.stat_result) -> Dict[str, Any]:
+        sha256 = hashlib.sha256()
+        sha1 = hashlib.sha1(f"blob {stat.st_size}\0".encode())  # git のオブジェクト ID
+        sample = b''
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.HASH_CHUNK_SIZE), b''):
+                if not sample:
+                    sample = chunk[:self.SAMPLE_SIZE]
+                sha256.update(chunk)
+                sha1.update(chunk)
+        return {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': sha256.hexdigest(),
+            'git_oid': sha1.hexdigest(),
+            'sample': base64.b64encode(sample).decode()
+        }
+
+    def remote_files(self) -> Dict[str, str]:
+        """リモートの path -> oid (LFS なら sha256、通常ファイルなら git blob sha1)"""
+        response = self._request('GET', f"{self._api('tree')}?recursive=true", 'tree')
+        if response.status_code != 200:
+            return {}
+        remote = {}
+        for item in response.json():
+            if item.get('type') == 'file':
+                remote[item['path']] = (item.get('lfs') or {}).get('oid') or item.get('oid')
+        return remote
+
+    def _upload_modes(self, files: Dict[str, Dict]) -> Dict[str, str]:
+        """preupload API で LFS にするか通常ファイルにするかを問い合わせる"""
+        modes = {}
+        paths = list(files)
+        for start in range(0, len(paths), 250):
+            payload = {'files': [
+                {'path': path, 'sample': files[path]['sample'], 'size': files[path]['size']}
+                for path in paths[start:start + 250]
+            ]}
+            response = self._request('POST', self._api('preupload'), 'preupload', json=payload)
+            response.raise_for_status()
+            for item in response.json()['files']:
+                if not item.get('shouldIgnore'):
+                    modes[item['path']] = item['uploadMode']
+        return modes
+
+    def _lfs_batch(self, objects: List[Dict]) -> List[Dict]:
+        response = self._request(
+            'POST', f"{self.endpoint}/{self.repo}.git/info/lfs/objects/batch", 'lfs/batch',
+            json={'operation': 'upload', 'transfers': ['basic', 'multipart'], 'hash_algo': 'sha256',
+                  'objects': [{'oid': obj['oid'], 'size': obj['size']} for obj in objects]},
+            headers={'Accept': 'application/vnd.git-lfs+json', 'Content-Type': 'application/vnd.git-lfs+json'}
+        )
+        response.raise_for_status()
+        return response.json()['objects']
+
+    def _put_part(self, path: str, url: str, offset: int, length: int) -> str:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        response = self._request('PUT', url, 'lfs/part', data=data)
+        response.raise_for_status()
+        with self._lock:
+            self.stats['uploaded_bytes'] += len(data)
+        return response.headers.get('ETag', '')
+
+    def _put_whole(self, path: str, action: Dict) -> None:
+        with open(path, 'rb') as f:
+            response = self._request('PUT', action['href'], 'lfs/upload', data=f, headers=action.get('header') or {})
+        response.raise_for_status()
+        with self._lock:
+            self.stats['uploaded_bytes'] += os.path.getsize(path)
+
+    def upload_lfs(self, lfs_files: List[Dict], on_done=None) -> None:
+        """LFS オブジェクトを並列アップロード (マルチパートはチャンク単位で並列化)"""
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        pending = [obj for obj in lfs_files if obj['oid'] not in self.journal['uploaded']]
+        if not pending:
+            return
+        by_oid = {obj['oid']: obj for obj in pending}
+        plans = self._lfs_batch(pending)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {}
+            multipart = {}
+            for plan in plans:
+                if plan.get('error'):
+                    raise RuntimeError(f"LFS batch エラー: {plan['error']}")
+                obj = by_oid[plan['oid']]
+                upload = (plan.get('actions') or {}).get('upload')
+                if upload is None:
+                    self._mark_uploaded(obj, plan, on_done)  # 既にリモートにある
+                    continue
+                header = upload.get('header') or {}
+                if 'chunk_size' not in header:
+                    futures[pool.submit(self._put_whole, obj['local_path'], upload)] = (plan, None)
+                    continue
+                # チャンクの完了状況は oid とチャンクサイズごとに、最初に受け取ったアップロードの計画と一緒に記録
+                chunk_size = int(header['chunk_size'])
+                key = f"{plan['oid']}:{chunk_size}"
+                saved = self.journal['parts'].get(key)
+                reused = bool(saved and saved.get('upload'))
+                if reused:
+                    upload, header = saved['upload'], saved['upload']['header']
+                else:
+                    saved = self.journal['parts'][key] = {'upload': upload, 'done': {}}
+                part_numbers = sorted(int(number) for number in header if number.isdigit())
+                multipart[plan['oid']] = {'key': key, 'upload': upload, 'parts': part_numbers,
+                                          'done': saved['done'], 'reused': reused}
+                self.stats['resumed_parts'] += len(saved['done'])
+                for number in part_numbers:
+                    if str(number) in saved['done']:
+                        continue
+                    future = pool.submit(self._put_part, obj['local_path'], header[str(number)],
+                                         (number - 1) * chunk_size, chunk_size)
+                    futures[future] = (plan, number)
+            self._save_journal()
+            # 失敗したチャンクがあっても、並行して送り終えたチャンクは記録してから中断する
+            failure = None
+            for future in as_completed(futures):
+                plan, number = futures[future]
+                obj = by_oid[plan['oid']]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    state = multipart.get(plan['oid'])
+                    if state is not None and state['reused'] and getattr(e, 'response', None) is not None \
+                            and e.response.status_code in (400, 403, 404):
+                        # 前回の署名付き URL が失効した: 計画を捨てて次回は最初から送る
+                        with self._lock:
+                            self.journal['parts'].pop(state['key'], None)
+                        self._save_journal()
+                        e = RuntimeError(f"{obj['path']}: 前回のアップロード URL が失効しました "
+                                         "(再実行すると最初のチャンクから送り直します)")
+                    failure = failure or e
+                    continue
+                if number is None:
+                    self._mark_uploaded(obj, plan, on_done)
+                    continue
+                state = multipart[plan['oid']]
+                state['done'][str(number)] = result
+                self._save_journal()
+                if len(state['done']) == len(state['parts']):
+                    self._complete_multipart(obj, plan, state, on_done)
+            if failure is not None:
+                raise failure
+            # 前回までに全パートを送り終えていたもの
+            for oid, state in multipart.items():
+                if oid not in self.journal['uploaded'] and len(state['done']) == len(state['parts']):
+                    self._complete_multipart(by_oid[oid], next(p for p in plans if p['oid'] == oid), state, on_done)
+
+    def _complete_multipart(self, obj: Dict, plan: Dict, state: Dict, on_done) -> None:
+        """送り終えたパートをまとめる (パートを送ったときと同じアップロード ID の完了 URL に送る)"""
+        payload = {'oid': obj['oid'], 'parts': [
+            {'partNumber': int(number), 'etag': etag}
+            for number, etag in sorted(state['done'].items(), key=lambda p: int(p[0]))
+        ]}
+        response = self._request('POST', state['upload']['href'], 'lfs/complete', json=payload)
+        response.raise_for_status()
+        self._mark_uploaded(obj, plan, on_done, key=state['key'])
+
+    def _mark_uploaded(self, obj: Dict, plan: Dict, on_done, key: Optional[str] = None) -> None:
+        verify = (plan.get('actions') or {}).get('verify')
+        if verify:
+            response = self._request('POST', verify['href'], 'lfs/verify', json={'oid': obj['oid'], 'size': obj['size']},
+                                     headers=verify.get('header') or {})
+            response.raise_for_status()
+        with self._lock:
+            self.journal['uploaded'].append(obj['oid'])
+            self.journal['parts'].pop(key, None)
+        self._save_journal()
+        if on_done:
+            on_done(obj)
+
+    def commit(self, files: Dict[str, Dict], modes: Dict[str, str], message: str) -> Dict:
+        lines = [{'key': 'header', 'value': {'summary': message, 'description': ''}}]
+        for path in sorted(modes):
+            meta = files[path]
+            if modes[path] == 'lfs':
+                lines.append({'key': 'lfsFile', 'value': {'path': path, 'algo': 'sha256', 'oid': meta['sha256']}})
+            else:
+                with open(meta['local_path'], 'rb') as f:
+                    content = base64.b64encode(f.read()).decode()
+                lines.append({'key': 'file', 'value': {'content': content, 'path': path, 'encoding': 'base64'}})
+        response = self._request(
+            'POST', self._api('commit'), 'commit', data='\n'.join(json.dumps(line) for line in lines).encode(),
+            headers={'Content-Type': 'application/x-ndjson'}
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def push(self, folder: str, message: str, private: bool = False, on_done=None) -> Dict[str, Any]:
+        """フォルダをアップロードしてコミットし、結果の概要を返す"""
+        self.create_repo(private)
+        files = self.scan(folder)
+        remote = self.remote_files()
+        changed = {
+            path: meta for path, meta in files.items()
+            if remote.get(path) not in (meta['sha256'], meta['git_oid'])
+        }
+        self.stats['skipped'] = len(files) - len(changed)
+        result = {'files': len(files), 'changed': len(changed), 'commit': None}
+        if not changed:
+            return result
+
+        modes = self._upload_modes(changed)
+        lfs_files = [
+            {'oid': changed[path]['sha256'], 'size': changed[path]['size'],
+             'local_path': changed[path]['local_path'], 'path': path}
+            for path, mode in modes.items() if mode == 'lfs'
+        ]
+        # 同じ内容のファイルは1回だけ送る
+        unique = list({obj['oid']: obj for obj in lfs_files}.values())
+        self.upload_lfs(unique, on_done)
+        result['commit'] = self.commit(changed, modes, message)
+
+        # コミット済みになったのでアップロード途中の状態は不要 (ハッシュは次回のために残す)
+        self.journal['uploaded'] = []
+        self.journal['parts'] = {}
+        self._save_journal()
+        return result
+
+
+class LazyModelLoader:
+    """
+    safetensors シャードをメモリマップし、モジュールの初回 forward 時にそのパラメータだけ読み込む
+    モデルは空の重み (meta) で構築するため、触れていない層はメモリを消費しない
+    layers を指定すると対象外のレイヤーをモデルから取り除き、その重みは一切読まない
+    """
+
+    DTYPES = {
+        'float16': 'float16', 'fp16': 'float16',
+        'bfloat16': 'bfloat16', 'bf16': 'bfloat16',
+        'float32': 'float32', 'fp32': 'float32'
+    }
+
+    def __init__(self, path: str, dtype: Optional[str] = None, layers: Optional[List[int]] = None):
+        import torch
+        if dtype is not None and dtype not in self.DTYPES:
+            raise ValueError(f"未対応の dtype: {dtype} ({', '.join(self.DTYPES)})")
+        self.path = path
+        self.dtype = getattr(torch, self.DTYPES[dtype]) if dtype else None
+        self.layers = layers
+        self.weight_map = self._read_weight_map()
+        self.loaded_bytes = 0
+        self._files: Dict[str, Any] = {}          # シャード名 -> safe_open ハンドル
+        self._source_names: Dict[int, str] = {}   # id(module) -> チェックポイント上の名前
+        self._hooks: Dict[int, Any] = {}
+        self._prefix = ''
+
+    @staticmethod
+    def parse_layers(spec: str) -> List[int]:
+        """'0-5' や '0,1,10-12' をレイヤー番号のリストに変換"""
+        layers = []
+        for part in spec.split(','):
+            if '-' in part:
+                start, end = part.split('-', 1)
+                layers.extend(range(int(start), int(end) + 1))
+            elif part:
+                layers.append(int(part))
+        return sorted(set(layers))
+
+    def _read_weight_map(self) -> Dict[str, str]:
+        """テンソル名 -> シャードファイル名 (ヘッダのみ読むので高速)"""
+        index_path = os.path.join(self.path, 'model.safetensors.index.json')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                return json.load(f)['weight_map']
+
+        from safetensors import safe_open
+        weight_map = {}
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.safetensors'):
+                with safe_open(os.path.join(self.path, name), framework='pt') as f:
+                    for key in f.keys():
+                        weight_map[key] = name
+        if not weight_map:
+            raise FileNotFoundError(f"safetensors 形式の重みが見つかりません: {self.path}")
+        return weight_map
+
+    def build(self, model_class: Any, lazy: bool = True) -> Any:
+        """空の重みでモデルを構築し、遅延読み込みフックを付ける (lazy=False なら即時に読み込む)"""
+        from transformers import AutoConfig
+        from accelerate import init_empty_weights
+
+        config = AutoConfig.from_pretrained(self.path)
+        with init_empty_weights(include_buffers=False):
+            if self.dtype is not None:
+                model = model_class.from_config(config, torch_dtype=self.dtype)
+            else:
+                model = model_class.from_config(config)
+
+        self._prefix = getattr(model, 'base_model_prefix', '') or ''
+        self._source_names = {id(module): name for name, module in model.named_modules()}
+        if self.layers is not None:
+            self._select_layers(model)
+        model.eval()
+
+        if lazy:
+            for module in model.modules():
+                if any(param.is_meta for param in module.parameters(recurse=False)):
+                    self._hooks[id(module)] = module.register_forward_pre_hook(self._on_forward)
+        else:
+            self.materialize(model)
+        return model
+
+    def materialize(self, model: Any) -> None:
+        """未読み込みのパラメータをすべて読み込む"""
+        for module in model.modules():
+            self._load_module(module)
+
+    def _select_layers(self, model: Any) -> None:
+        """num_hidden_layers 個の ModuleList を探し、指定レイヤーだけに差し替える"""
+        import torch
+        count = getattr(model.config, 'num_hidden_layers', None)
+        for name, module in model.named_modules():
+            if isinstance(module, torch.nn.ModuleList) and len(module) == count:
+                keep = [index for index in self.layers if index < count]
+                parent = model.get_submodule(name.rsplit('.', 1)[0]) if '.' in name else model
+                setattr(parent, name.rsplit('.', 1)[-1], torch.nn.ModuleList([module[i] for i in keep]))
+                model.config.num_hidden_layers = len(keep)
+                return
+        raise ValueError("レイヤー構造 (num_hidden_layers 個の ModuleList) が見つかりません")
+
+    def _on_forward(self, module: Any, inputs: Any) -> None:
+        self._load_module(module)
+
+    def _load_module(self, module: Any) -> None:
+        import torch
+        hook = self._hooks.pop(id(module), None)
+        if hook is not None:
+            hook.remove()
+        prefix = self._source_names.get(id(module), '')
+        for name, param in list(module._parameters.items()):
+            if param is not None and param.is_meta:
+                tensor = self._read(f"{prefix}.{name}" if prefix else name)
+                module._parameters[name] = torch.nn.Parameter(tensor, requires_grad=False)
+
+    def _read(self, name: str) -> Any:
+        """メモリマップしたシャードからテンソルを1つ読む (base_model_prefix の有無も吸収)"""
+        from safetensors import safe_open
+        candidates = [name, f"{self._prefix}.{name}"]
+        if self._prefix and name.startswith(self._prefix + '.'):
+            candidates.append(name[len(self._prefix) + 1:])
+
+        for candidate in candidates:
+            shard = self.weight_map.get(candidate)
+            if shard is None:
+                continue
+            if shard not in self._files:
+                self._files[shard] = safe_open(os.path.join(self.path, shard), framework='pt')
+            tensor = self._files[shard].get_tensor(candidate)
+            if self.dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(self.dtype)
+            self.loaded_bytes += tensor.numel() * tensor.element_size()
+            return tensor
+        raise KeyError(f"重み {name} がチェックポイントにありません")
+
+    def close(self) -> None:
+        """メモリマップしたシャードを閉じる (その後に未読み込みの層を実行すると開き直す)"""
+        files, self._files = self._files, {}
+        for handle in files.values():
+            handle.__exit__(None, None, None)
+
+
+@dataclass
+class LoadedModel:
+    """カーネル内に常駐しているモデル"""
+    key: str
+    model: Any
+    tokenizer: Any
+    loaded_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    aliases: List[str] = field(default_factory=list)
+    loader: Optional[LazyModelLoader] = None  # 遅延読み込み中のシャード (解放時に閉じる)
+
+    def close(self) -> None:
+        if self.loader is not None:
+            self.loader.close()
+
+    def memory_bytes(self) -> int:
+        """パラメータとバッファの実メモリ (遅延読み込み中の meta テンソルは含めない)"""
+        tensors = itertools.chain(self.model.parameters(), self.model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors if not getattr(t, 'is_meta', False))
+
+
+class ModelRegistry:
+    """
+    読み込み済みモデルの LRU レジストリ (キーはモデル名・リビジョン・読み込みオプション)
+    常駐モデルの合計メモリが上限を超えたら、最も長く使われていないものから解放する
+    プロセス RSS は解放後もすぐには下がらないため、上限判定にはテンソルの実サイズを使う
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            if 'LABFLOW_MODEL_MEMORY_GB' in os.environ:
+                max_bytes = int(float(os.environ['LABFLOW_MODEL_MEMORY_GB']) * 1024 ** 3)
+            else:
+                max_bytes = int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.75)
+        self.max_bytes = max_bytes
+        self.entries: 'OrderedDict[str, LoadedModel]' = OrderedDict()
+
+    @staticmethod
+    def key(name: str, revision: str, dtype: Optional[str] = None, layers: Optional[str] = None) -> str:
+        variant = ','.join(f"{k}={v}" for k, v in (('dtype', dtype), ('layers', layers)) if v)
+        return f"{name}@{revision}" + (f"[{variant}]" if variant else '')
+
+    def get(self, key: str) -> Optional[LoadedModel]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.last_used = time.time()
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, model: Any, tokenizer: Any, loader: Optional[LazyModelLoader] = None) -> LoadedModel:
+        entry = LoadedModel(key, model, tokenizer, loader=loader)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        return entry
+
+    def find(self, name: str) -> Optional[LoadedModel]:
+        """キーまたは別名で検索"""
+        if name in self.entries:
+            return self.entries[name]
+        return next((entry for entry in self.entries.values() if name in entry.aliases), None)
+
+    def total_bytes(self) -> int:
+        return sum(entry.memory_bytes() for entry in self.entries.values())
+
+    def remove(self, key: str) -> Optional[LoadedModel]:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry.close()
+        return entry
+
+    def enforce_budget(self, keep: Optional[str] = None) -> List[LoadedModel]:
+        """上限を超えている間 LRU で取り除く (keep は直前に使ったモデルなので残す)"""
+        evicted = []
+        sizes = {key: entry.memory_bytes() for key, entry in self.entries.items()}
+        total = sum(sizes.values())
+        for key in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            evicted.append(self.entries.pop(key))
+            evicted[-1].close()
+            total -= sizes[key]
+        return evicted
+
+
+class ResponseCache:
+    """
+    Claude 応答のキャッシュ (メモリ LRU + 容量上限付きディスク)
+    キーは正規化したプロンプト・モデル・パラメータの sha256。ノートブックを再実行しても
+    プロンプトが変わらなければ API を呼ばずに前回の応答を返す
+    """
+
+    def __init__(self, root: Optional[str] = None, max_entries: int = 256, max_bytes: Optional[int] = None):
+        self.root = root or os.environ.get('LABFLOW_CLAUDE_CACHE', os.path.expanduser('~/.labflow/claude_cache'))
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('LABFLOW_CLAUDE_CACHE_MB', 100)) * 1024 ** 2)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory: 'OrderedDict[str, str]' = OrderedDict()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0}
+        self._disk_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """改行コード・行末空白・前後の空行の違いは同じプロンプトとみなす"""
+        lines = prompt.replace('\r\n', '\n').split('\n')
+        return '\n'.join(line.rstrip() for line in lines).strip('\n')
+
+    def key(self, prompt: str, model: str, params: Dict[str, Any], backend: str = '') -> str:
+        """backend は応答を返したエンドポイント (モックサーバーと実 API の応答を混ぜない)"""
+        payload = json.dumps({'prompt': self.normalize(prompt), 'model': model, 'params': params, 'backend': backend},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def __contains__(self, key: str) -> bool:
+        """応答が保存されているか (stats や LRU の順序は変えない)"""
+        with self._lock:
+            if key in self.memory:
+                return True
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self.memory[key]
+        try:
+            with open(self._path(key)) as f:
+                response = json.load(f)['response']
+            os.utime(self._path(key))  # ディスク側の LRU 用
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        with self._lock:
+            self.stats['disk_hits'] += 1
+            self._remember(key, response)
+        return response
+
+    def put(self, key: str, response: str) -> None:
+        with self._lock:
+            self._remember(key, response)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'response': response, 'created': time.time()}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes = self.disk_bytes() + os.path.getsize(path)
+        if self._disk_bytes > self.max_bytes:
+            self.prune()
+
+    def _remember(self, key: str, response: str) -> None:
+        self.memory[key] = response
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _disk_entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.json'):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def disk_bytes(self) -> int:
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+        return self._disk_bytes
+
+    def prune(self) -> int:
+        """上限の 80% まで最終アクセスの古い順に削除"""
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.8:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._disk_bytes = total
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self.memory.clear()
+            self._disk_bytes = 0
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class TokenBucket:
+    """
+    トークン/分のレート制限 (トークンバケット)
+    acquire(n) はバケットに n トークン貯まるまで待つので、並列リクエストの合計が rate を超えない
+    """
+
+    def __init__(self, tokens_per_minute: int, capacity: Optional[int] = None):
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = capacity or tokens_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: int) -> None:
+        amount = min(amount, self.capacity)  # 1回で容量を超える要求も通す
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算 (ASCII は約4文字で1トークン、日本語などはほぼ1文字1トークン)"""
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+@dataclass
+class SessionTurn:
+    """会話履歴の1メッセージ (長い本文はディスクに置き、パスだけ保持)"""
+    role: str
+    tokens: int
+    preview: str
+    content: Optional[str] = None
+    path: Optional[str] = None
+
+    def text(self) -> str:
+        if self.content is not None:
+            return self.content
+        with open(self.path, encoding='utf-8') as f:
+            return f.read()
+
+
+class ClaudeSession:
+    """
+    トークン予算付きの Claude 会話履歴
+    直近のメッセージはそのまま保持し、予算を超えたら古いものから1往復ずつ要約に移す。
+    要約は各メッセージの冒頭行の抜粋で、追加の API 呼び出しはしない。要約自体も予算の
+    1/4 を超えたら古い行から捨てるので、1回のリクエストに載る履歴は常に予算以内に収まる
+    """
+
+    SUMMARY_LINE_CHARS = 160
+
+    def __init__(self, budget_tokens: Optional[int] = None, inline_chars: int = 2000, root: Optional[str] = None):
+        self.budget_tokens = budget_tokens or int(os.environ.get('LABFLOW_CLAUDE_SESSION_TOKENS', 8000))
+        self.inline_chars = inline_chars
+        session_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.root = root or os.path.expanduser(os.path.join('~/.labflow/claude_sessions', session_id))
+        self.turns: List[SessionTurn] = []
+        self.summary: List[str] = []
+        self.compacted = 0   # 要約に移したメッセージ数
+        self.dropped = 0     # 要約からも捨てた行数
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return self.compacted + len(self.turns)
+
+    def append(self, message: Dict[str, str]) -> None:
+        content = message['content']
+        turn = SessionTurn(message['role'], estimate_tokens(content), content[:80].replace('\n', ' '))
+        if len(content) > self.inline_chars:
+            os.makedirs(self.root, exist_ok=True)
+            turn.path = os.path.join(self.root, f"{next(self._counter):05d}-{turn.role}.txt")
+            with open(turn.path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        else:
+            turn.content = content
+        with self._lock:
+            self.turns.append(turn)
+            self._compact()
+
+    def summary_text(self) -> str:
+        omitted = [f"(さらに古い {self.dropped} 件は省略)"] if self.dropped else []
+        return '\n'.join(omitted + self.summary)
+
+    def tokens(self) -> int:
+        summary_tokens = estimate_tokens(self.summary_text()) if self.summary else 0
+        return summary_tokens + sum(turn.tokens for turn in self.turns)
+
+    def _compact(self, max_turns: Optional[int] = None) -> None:
+        """予算 (と max_turns) を超えている間、最古の1往復を要約に移す (最後の1往復は残す)"""
+        while len(self.turns) > 2 and (
+            self.tokens() > self.budget_tokens or (max_turns is not None and len(self.turns) > max_turns)
+        ):
+            for turn in self.turns[:2]:
+                first_line = next((line for line in turn.text().splitlines() if line.strip()), '')
+                speaker = 'ユーザー' if turn.role == 'user' else 'Claude'
+                self.summary.append(f"- {speaker}: {first_line.strip()[:self.SUMMARY_LINE_CHARS]}")
+                if turn.path:
+                    try:
+                        os.remove(turn.path)
+                    except OSError:
+                        pass
+            del self.turns[:2]
+            self.compacted += 2
+
+        while self.summary and estimate_tokens(self.summary_text()) > self.budget_tokens // 4:
+            self.summary.pop(0)
+            self.dropped += 1
+
+    def trim(self, keep: int) -> None:
+        """直近 keep メッセージ以外を要約に移す"""
+        with self._lock:
+            self._compact(max_turns=max(keep, 2))
+
+    def reset(self) -> None:
+        with self._lock:
+            self.turns.clear()
+            self.summary.clear()
+            self.compacted = self.dropped = 0
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def context(self) -> Dict[str, Any]:
+        """次のリクエストに載せる system (要約) と history (直近のメッセージ)"""
+        with self._lock:
+            if not self.turns and not self.summary:
+                return {}
+            context = {}
+            if self.summary:
+                context['system'] = f"これまでの会話の要約:\n{self.summary_text()}"
+            # 最後の1往復だけで予算を超える場合は本文を中略して収める
+            available = max(self.budget_tokens - self.tokens() + sum(t.tokens for t in self.turns), 0)
+            limits = self._shares([turn.tokens for turn in self.turns], available)
+            context['history'] = [
+                {'role': turn.role, 'content': self._clip(turn.text(), turn.tokens, limit)}
+                for turn, limit in zip(self.turns, limits)
+            ]
+            return context
+
+    @staticmethod
+    def _shares(sizes: List[int], budget: int) -> List[int]:
+        """合計が budget に収まる各メッセージの上限 (収まれば中略しない。短いメッセージの余りは長いものに回す)"""
+        limits = list(sizes)
+        if sum(sizes) <= budget:
+            return limits
+        left = budget
+        order = sorted(range(len(sizes)), key=sizes.__getitem__)
+        for position, index in enumerate(order):
+            limits[index] = min(sizes[index], left // (len(sizes) - position))
+            left -= limits[index]
+        return limits
+
+    @staticmethod
+    def _clip(text: str, tokens: int, max_tokens: int) -> str:
+        if tokens <= max_tokens:
+            return text
+        keep = max(int(len(text) * max_tokens / tokens) // 2, 1)
+        return f"{text[:keep]}\n...(中略)...\n{text[-keep:]}"
+
+
+class ClaudeStream:
+    """
+    ストリーミング中の Claude 応答
+    チャンクが届くたびに表示を更新する。start() でバックグラウンド実行した場合は
+    このオブジェクトがハンドルになり、text で途中経過、result() で完了後の全文を取得できる
+    """
+
+    RENDER_INTERVAL = 0.1  # 表示更新の最小間隔 (秒)
+
+    def __init__(self, chunks: Iterator[str], title: str, on_complete=None, render: bool = True):
+        self.chunks = chunks
+        self.title = title
+        self.on_complete = on_complete
+        self.render = render
+        self.parts: List[str] = []
+        self.error: Optional[Exception] = None
+        self.started_at = time.time()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._done = threading.Event()
+        self._cancelled = False
+        self._handle = None
+        self._shown = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        return self.first_token_at - self.started_at if self.first_token_at else None
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self) -> None:
+        self._cancelled = True
+
+    def result(self, timeout: Optional[float] = None) -> str:
+        """完了まで待って全文を返す (エラーならそのまま送出)"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.title}: {timeout}s 以内に完了しませんでした")
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+    def start(self) -> 'ClaudeStream':
+        # 表示は呼び出したセルで作る (スレッドから display すると、その時点で実行中の別のセルに付く)
+        self._show()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _show(self) -> None:
+        """表示領域を作る (1回だけ。以降はスレッドからも update() で書き換える)"""
+        if self.render and not self._shown:
+            from IPython.display import display, HTML
+            self._handle = display(HTML(self._render()), display_id=True)
+        self._shown = True
+
+    def run(self) -> str:
+        from IPython.display import HTML
+        self._show()
+        last_render = 0.0
+        try:
+            for chunk in self.chunks:
+                if self._cancelled:
+                    break
+                if self.first_token_at is None:
+                    self.first_token_at = time.time()
+                self.parts.append(chunk)
+                if self._handle is not None and time.time() - last_render >= self.RENDER_INTERVAL:
+                    self._handle.update(HTML(self._render()))
+                    last_render = time.time()
+            if not self._cancelled and self.on_complete:
+                self.on_complete(self.text)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished_at = time.time()
+            self._done.set()
+            if self._handle is not None:
+                self._handle.update(HTML(self._render()))
+        return self.text
+
+    def _render(self) -> str:
+        if self.error is not None:
+            footer = f"❌ {html.escape(str(self.error))}"
+        elif self.done():
+            ttft = f"初回トークン {self.time_to_first_token:.2f}s / " if self.time_to_first_token else ''
+            footer = f"{'⏹ 中断' if self._cancelled else '✅ 完了'} ({ttft}合計 {self.finished_at - self.started_at:.1f}s)"
+        else:
+            footer = "⏳ 受信中..."
+        return (
+            f"<b>{html.escape(self.title)}</b>"
+            f"<pre style='white-space: pre-wrap'>{html.escape(self.text)}</pre>"
+            f"<small>{footer}</small>"
+        )
+
+    def __repr__(self) -> str:
+        state = 'error' if self.error else 'done' if self.done() else 'streaming'
+        return f"<ClaudeStream {self.title!r} {state}, {len(self.text)} chars>"
+
 
 @magics_class
 class AIDevMagics(Magics):
@@ -19,9 +2579,23 @@ class AIDevMagics(Magics):
     
     def __init__(self, shell=None):
         super().__init__(shell)
+        self.stats = Instrumentation()
+        for kind, prefix in (('line', '%'), ('cell', '%%')):
+            for name, func in list(self.magics[kind].items()):
+                self.magics[kind][name] = self._timed_magic(prefix + name, func)
         self.colab_nodes: Dict[str, str] = {}
         self.active_jobs: Dict[str, Dict] = {}
-        self.claude_session: List[Dict] = []
+        self.claude_session = ClaudeSession()
+        self.node_client = ColabNodeClient(stats=self.stats)
+        self.model_cache = ModelCache()
+        self.model_registry = ModelRegistry()
+        self.claude_model = os.environ.get('LABFLOW_CLAUDE_MODEL', 'claude-3-5-sonnet-latest')
+        self.response_cache = ResponseCache()
+        self.dataset_cache: Dict[Tuple, DatasetShards] = {}  # (signature, node_count) -> 分割結果
+        self.cluster_jobs: Dict[str, Dict[str, Dict]] = {}  # node_id -> {job_id: /jobs の概要}
+        self._jobs_cursor: Dict[str, float] = {}             # node_id -> /jobs?since= に渡す時刻
+        self.scheduler = JobScheduler(self.node_client, self.colab_nodes, self.active_jobs)
+        self.scheduler.dispatch = self._dispatch_job
         
     # =========================================================================
     # COLAB MAGIC COMMANDS
@@ -38,16 +2612,20 @@ class AIDevMagics(Magics):
             print("❌ Usage: %colab_connect <ngrok_url>")
             return
             
+        node_id = f"colab_{int(time.time())}"
+        while node_id in self.colab_nodes:
+            node_id += "_"
+        
         try:
             # Health check
-            response = requests.get(f"{url}/health", timeout=10)
-            response.raise_for_status()
+            health = self.node_client.request(node_id, url, 'GET', '/health', timeout=10)
+            if not health.ok:
+                raise Exception(health.error)
             
-            # Node info 取得
-            info_response = requests.get(f"{url}/info", timeout=10)
-            node_info = info_response.json()
+            # Node info 取得 (同じ keep-alive セッションを再利用)
+            info = self.node_client.request(node_id, url, 'GET', '/info', timeout=10)
+            node_info = info.data if isinstance(info.data, dict) else {}
             
-            node_id = f"colab_{int(time.time())}"
             self.colab_nodes[node_id] = url
             
             print(f"✅ Colab接続成功!")
@@ -55,129 +2633,514 @@ class AIDevMagics(Magics):
             print(f"   GPU: {node_info.get('gpu', 'N/A')}")
             print(f"   Runtime: {node_info.get('runtime', 'N/A')}")
             
-            # JupyterLab Extension に通知
-            self._notify_extension('colab_connected', {
-                'node_id': node_id,
-                'url': url,
-                'info': node_info
-            })
+            # JupyterLab Extension に通知
+            self._notify_extension('colab_connected', {
+                'node_id': node_id,
+                'url': url,
+                'info': node_info
+            })
+            
+        except Exception as e:
+            print(f"❌ Colab接続失敗: {str(e)}")
+    
+    @line_magic
+    def colab_status(self, line: str) -> None:
+        """
+        接続中の Colab ノード状況を表示
+        使用例: %colab_status
+        """
+        if not self.colab_nodes:
+            print("📭 接続中のColabノードはありません")
+            return
+        
+        print(f"🖥️  接続中のColabノード ({len(self.colab_nodes)}個):")
+        print("-" * 60)
+        
+        # 全ノードに並列で問い合わせ (所要時間は最も遅いノード1台分)
+        responses = self.node_client.fan_out(
+            list(self.colab_nodes.items()), 'GET', '/resources', timeout=5
+        )
+        
+        for res in responses:
+            if not res.ok:
+                print(f"Node: {res.node_id} - ❌ エラー: {res.error}")
+                print()
+                continue
+            
+            resources = res.data
+            gpu = (resources.get('gpu') or [{}])[0]
+            memory = resources.get('memory', {})
+            
+            print(f"Node: {res.node_id}")
+            print(f"  URL: {res.url}")
+            print(f"  GPU: {gpu.get('name', 'N/A')} ({gpu.get('utilization', 0):.1f}%)")
+            print(f"  Memory: {memory.get('percent', 0):.1f}% used")
+            print()
+    
+    @cell_magic
+    def colab_train(self, line: str, cell: str) -> None:
+        """
+        Colab クラスタで分散学習実行
+        空きノードが足りない場合はキューで待機し、空き次第自動で投入
+        --include で指定したファイル/ディレクトリはジョブの作業ディレクトリに配置される
+        --data で指定したデータセット (ディレクトリ / .jsonl / .npy) はノードごとのシャードに分けて送り、
+        学習コードからは shard (このノードのシャードのイテレータ) で参照できる
+        --tasks N はタスクキューモード: セルで定義した work(start, end) に [0, N) を小さな範囲に分けて
+        空いたノードから順に渡し (性能の違うノードが混在しても遅いノードを待たない)、
+        結果 (1件ずつのリスト) を --as の変数 (既定 task_results) に届いた順に書き込む
+        使用例:
+        %%colab_train --nodes 2 --epochs 10 --min-gpu-mem 8 --priority 1 --include utils.py,data/
+        import torch
+        # 学習コード
+
+        %%colab_train --nodes 4 --data train.jsonl
+        for record in shard:
+            ...
+
+        %%colab_train --tasks 10000 --as scores --range-seconds 2 --range-timeout 600
+        model = load_model()  # 各ノードで1回だけ実行
+        def work(start, end):
+            return [score(model, i) for i in range(start, end)]
+        """
+        args = self._parse_args(line)
+        node_count = int(args.get('nodes', 1))
+        epochs = int(args.get('epochs', 10))
+        min_gpu_mem = float(args.get('min-gpu-mem', 0))
+        priority = int(args.get('priority', 0))
+        include = args.get('include')
+        
+        try:
+            files, blobs = self._collect_blobs(include.split(',') if isinstance(include, str) else [])
+        except OSError as e:
+            print(f"❌ --include の読み込み失敗: {str(e)}")
+            return
+        
+        if not self.colab_nodes:
+            print("❌ Colabノードが接続されていません")
+            return
+        
+        if 'tasks' in args:
+            if 'data' in args:
+                print("❌ --tasks と --data は併用できません (範囲は work(start, end) の中で読み込んでください)")
+                return
+            self._run_task_queue(args, cell, files, blobs)
+            return
+        
+        if len(self.colab_nodes) < node_count:
+            print(f"⚠️  要求ノード数: {node_count}, 利用可能: {len(self.colab_nodes)}")
+            node_count = len(self.colab_nodes)
+        
+        data = None
+        if isinstance(args.get('data'), str):
+            try:
+                data = self._load_dataset(args['data'], node_count)
+            except (OSError, ValueError, ImportError) as e:
+                print(f"❌ --data の読み込み失敗: {str(e)}")
+                return
+        
+        job_id = self._new_job_id()
+        self.active_jobs[job_id] = {
+            'nodes': [],
+            'start_time': time.time(),
+            'status': 'queued',
+            'priority': priority
+        }
+        job = self.scheduler.new_job(job_id, node_count, epochs, cell, min_gpu_mem, priority, files, blobs, data)
+        
+        if not self.scheduler.submit(job):
+            position = self.scheduler.queue_position(job_id)
+            print(f"⏳ Job {job_id}: 空きノード待ち (キュー {position} 番目)")
+            print(f"   必要ノード数: {node_count}, 最小GPUメモリ: {min_gpu_mem}GB, 優先度: {priority}")
+            print(f"💡 空きが出たら自動で投入されます: %colab_job_status {job_id}")
+    
+    def _new_job_id(self) -> str:
+        job_id = f"job_{int(time.time())}"
+        while job_id in self.active_jobs:
+            job_id += "_"
+        return job_id
+    
+    def _run_task_queue(self, args: Dict[str, Any], code: str, files: Dict[str, str], blobs: Dict[str, bytes]) -> None:
+        """--tasks: 応答するノード全体 (--nodes で上限) で範囲を動的に配布し、結果を集める"""
+        try:
+            total = int(args['tasks']) if isinstance(args['tasks'], str) else 0
+            if total <= 0:
+                raise ValueError(args['tasks'])
+            min_size = int(args.get('min-range', 1))
+            target_seconds = float(args.get('range-seconds', 2.0))
+            range_timeout = float(args.get('range-timeout', 600))
+        except (TypeError, ValueError):
+            print("❌ Usage: %%colab_train --tasks N [--as NAME] [--nodes N] [--min-range 1] "
+                  "[--range-seconds 2] [--range-timeout 600]")
+            return
+        name = args['as'] if isinstance(args.get('as'), str) else 'task_results'
+        
+        # 実行中ジョブの少ないノードから使う (サーキットが開いているノードは除外)
+        nodes = sorted(
+            ((node_id, url) for node_id, url in self.colab_nodes.items() if self.node_client.available(node_id)),
+            key=lambda item: self.scheduler.running_jobs(item[0])
+        )
+        if isinstance(args.get('nodes'), str):
+            nodes = nodes[:int(args['nodes'])]
+        if not nodes:
+            print("❌ 応答するColabノードがありません")
+            return
+        
+        job_id = self._new_job_id()
+        self.active_jobs[job_id] = {'nodes': [], 'start_time': time.time(), 'status': 'queued', 'priority': 0}
+        job = self.scheduler.new_job(job_id, len(nodes), 0, code, files=files, blobs=blobs, tasks=total)
+        if not self._dispatch_job(job, nodes):
+            return
+        nodes = self.active_jobs[job_id]['nodes']
+        
+        results: List[Any] = [None] * total
+        self.shell.user_ns[name] = results
+        work = WorkQueue(total, min_size, target_seconds)
+        coordinator = TaskCoordinator(self.node_client, job_id, nodes, work, range_timeout=range_timeout)
+        start = time.time()
+        last_report = start
+        
+        def on_result(task: TaskRange, value: Optional[List[Any]]) -> None:
+            nonlocal last_report
+            if value is not None:
+                results[task.start:task.end] = value
+            if time.time() - last_report >= 5.0:
+                last_report = time.time()
+                elapsed = last_report - start
+                print(f"📦 {work.completed}/{total} ({work.completed / total:.0%}) "
+                      f"{work.completed / elapsed:.1f} 件/s, 経過 {elapsed:.0f}s")
+        
+        print(f"💡 結果は届いた順に {name} に書き込まれます")
+        status = 'completed'
+        try:
+            coordinator.run(on_result)
+        except RuntimeError as e:
+            print(f"❌ タスクキュー中断: {str(e)}")
+            status = 'error'
+        except KeyboardInterrupt:
+            print("⏹  タスクキューを中断しました")
+            status = 'cancelled'
+        
+        # 完了時は受け取り済みの範囲を終えてから、中断時は即座にワーカーを止める
+        path = f"/job/{job_id}/drain" if status == 'completed' else f"/job/{job_id}/cancel"
+        self.node_client.fan_out(nodes, 'POST', path, timeout=10, adaptive=False)
+        self.active_jobs[job_id]['status'] = status
+        
+        elapsed = time.time() - start
+        print("-" * 40)
+        print(f"{'✅' if status == 'completed' else '⚠️ '} {work.completed}/{total} 件 ({elapsed:.1f}s, "
+              f"{work.completed / max(elapsed, 1e-6):.1f} 件/s)")
+        for node_id, _ in nodes:
+            speed = work.throughput.get(node_id)
+            if speed is None:
+                continue
+            note = f" - {coordinator.retired[node_id]}" if node_id in coordinator.retired else ''
+            print(f"   {node_id}: {speed.items} 件 ({speed.items / total:.0%}), 範囲 {speed.ranges}, "
+                  f"{speed.rate:.1f} 件/s, 失敗 {speed.failures}{note}")
+        if work.retries or work.duplicates:
+            print(f"   再配布 {work.retries} 範囲, 重複実行 {work.duplicates} 範囲")
+    
+    def _dispatch_job(self, job: QueuedJob, nodes: List[Tuple[str, str]]) -> bool:
+        """
+        スケジューラが選んだノードにタスクを配布
+        コード・データを送れなかったノードは外し、残りのノードで node_index / total_nodes と
+        --data のシャードを振り直す。/train を受け付けないノードがあれば、シャードや担当分が
+        欠けたまま走らないよう受け付けたノードのジョブも止める (タスクキューモードはそのまま続行)
+        """
+        print(f"🚀 分散学習開始")
+        print(f"   Job ID: {job.job_id}")
+        print(f"   ノード数: {len(nodes)} ({', '.join(node_id for node_id, _ in nodes)})")
+        if job.tasks is not None:
+            print(f"   タスク数: {job.tasks} (work(start, end) に範囲を動的に配布)")
+        else:
+            print(f"   エポック数: {job.epochs}")
+        print("-" * 40)
+        
+        # コードと --include ファイルを各ノードに不足分だけ送信 (失敗したノードを除いて振り直す)
+        targets = list(nodes)
+        while True:
+            code_hash, inline_nodes, failed = self._sync_blobs(job, targets)
+            if job.data is not None:
+                self._sync_dataset(job, targets, inline_nodes, failed)
+            for node_id, error in failed.items():
+                print(f"❌ Node {node_id}: 失敗 - {error}")
+            targets = [(node_id, url) for node_id, url in targets if node_id not in failed]
+            if not failed or not targets:
+                break
+            print(f"🔁 残りの {len(targets)} ノードで担当を振り直します")
+            if job.data is not None:
+                job.data = self._load_dataset(job.data.path, len(targets))
+        
+        if not targets:
+            self.active_jobs[job.job_id]['status'] = 'error'
+            return False
+        
+        # 各ノードにタスク配布 (並列送信)
+        task_configs = {}
+        for idx, (node_id, url) in enumerate(targets):
+            task_configs[node_id] = {
+                'job_id': job.job_id,
+                'node_id': node_id,
+                'node_index': idx,
+                'total_nodes': len(targets),
+                'epochs': job.epochs
+            }
+            if job.tasks is not None:
+                task_configs[node_id]['tasks'] = job.tasks
+            if node_id in inline_nodes:
+                # blob ストア非対応のサーバーにはコードを直接送る
+                task_configs[node_id]['code'] = job.code
+            else:
+                task_configs[node_id]['code_hash'] = code_hash
+                task_configs[node_id]['files'] = job.files
+                if job.data is not None:
+                    task_configs[node_id]['data'] = job.data.manifest(idx)
+        
+        accepted = []
+        # /train は再送できない (タイムアウトしてもノード側では開始している) ので適応タイムアウトを使わない
+        responses = self.node_client.fan_out(targets, 'POST', '/train', task_configs, timeout=30, adaptive=False)
+        for (node_id, url), res in zip(targets, responses):
+            if res.ok:
+                print(f"✅ Node {res.node_id}: 学習開始")
+                accepted.append((node_id, url))
+            else:
+                print(f"❌ Node {res.node_id}: 失敗 - {res.error}")
+        
+        if accepted and len(accepted) < len(targets) and job.tasks is None:
+            print(f"⏹  {len(targets) - len(accepted)} ノードが開始できなかったため、担当分が欠けないよう全体を中止します")
+            self.node_client.fan_out(accepted, 'POST', f"/job/{job.job_id}/cancel", timeout=10, adaptive=False)
+            accepted = []
+        
+        if not accepted:
+            self.active_jobs[job.job_id]['status'] = 'error'
+            return False
+        
+        self.active_jobs[job.job_id].update({
+            'nodes': accepted,
+            'start_time': time.time(),
+            'status': 'running'
+        })
+        print(f"\n💡 進捗確認: %colab_job_status {job.job_id}")
+        return True
+    
+    @line_magic
+    def colab_job_status(self, line: str) -> None:
+        """
+        学習ジョブの状況確認
+        使用例: %colab_job_status job_1234567890
+               %colab_job_status job_1234567890 --follow  (進捗をライブ表示)
+        """
+        parts = line.split()
+        job_id = parts[0] if parts and not parts[0].startswith('--') else ''
+        follow = '--follow' in parts
+        if not job_id:
+            self._print_cluster_jobs()
+            return
+        
+        if job_id not in self.active_jobs:
+            print(f"❌ ジョブ {job_id} が見つかりません")
+            return
+        
+        job_info = self.active_jobs[job_id]
+        if job_info['status'] == 'queued':
+            position = self.scheduler.queue_position(job_id)
+            print(f"⏳ Job {job_id}: 空きノード待ち (キュー {position} 番目)")
+            return
+        
+        if follow:
+            self._follow_job(job_id, job_info)
+            return
+        
+        print(f"📊 Job Status: {job_id}")
+        print("-" * 40)
+        
+        for res in self.node_client.fan_out(job_info['nodes'], 'GET', f"/job/{job_id}/status", timeout=5):
+            if not res.ok:
+                print(f"Node {res.node_id}: ❌ エラー - {res.error}")
+                print()
+                continue
+            
+            status = res.data
+            print(f"Node {res.node_id}:")
+            print(f"  Status: {status.get('status', 'unknown')}")
+            print(f"  Epoch: {status.get('current_epoch', 0)}/{status.get('total_epochs', 0)}")
+            print(f"  Loss: {status.get('current_loss', 'N/A')}")
+            startup = status.get('startup') or {}
+            if 'total' in startup:
+                compile_info = 'cached' if startup.get('cache_hit') else f"{startup.get('compile_time', 0):.3f}s"
+                print(f"  Startup: {startup['total']:.2f}s ({'warm' if startup.get('warm') else 'cold'}, "
+                      f"import {startup.get('import_time', 0):.2f}s, compile {compile_info})")
+            print()
+    
+    def _collect_blobs(self, paths: List[str]) -> Tuple[Dict[str, str], Dict[str, bytes]]:
+        """
+        --include のファイル/ディレクトリを読み込み、内容の sha256 で索引付け
+        戻り値: (相対パス -> sha256, sha256 -> 内容)
+        """
+        files, blobs = {}, {}
+        for path in (p.strip() for p in paths):
+            if not path:
+                continue
+            path = os.path.normpath(path)
+            if os.path.isdir(path):
+                base = os.path.dirname(os.path.abspath(path))
+                targets = [
+                    os.path.join(root, name)
+                    for root, _, names in os.walk(path) for name in sorted(names)
+                ]
+            else:
+                base = os.path.dirname(os.path.abspath(path))
+                targets = [path]
             
-        except Exception as e:
-            print(f"❌ Colab接続失敗: {str(e)}")
+            for target in targets:
+                with open(target, 'rb') as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()
+                relative = os.path.relpath(os.path.abspath(target), base).replace(os.sep, '/')
+                files[relative] = digest
+                blobs[digest] = data
+        return files, blobs
     
-    @line_magic
-    def colab_status(self, line: str) -> None:
+    def _sync_blobs(self, job: QueuedJob, nodes: List[Tuple[str, str]]) -> Tuple[str, set, Dict[str, str]]:
         """
-        接続中の Colab ノード状況を表示
-        使用例: %colab_status
+        コードと添付ファイルを content-addressed に送信 (各ノードに無いものだけ)
+        戻り値: (コードの sha256, blob 非対応ノード, 失敗ノード -> エラー)
         """
-        if not self.colab_nodes:
-            print("📭 接続中のColabノードはありません")
-            return
+        code_bytes = job.code.encode('utf-8')
+        code_hash = hashlib.sha256(code_bytes).hexdigest()
+        blobs = dict(job.blobs)
+        blobs[code_hash] = code_bytes
         
-        print(f"🖥️  接続中のColabノード ({len(self.colab_nodes)}個):")
-        print("-" * 60)
+        inline_nodes, failed = set(), {}
+        uploads = []
+        responses = self.node_client.fan_out(
+            nodes, 'POST', '/blobs/missing',
+            {node_id: {'hashes': list(blobs)} for node_id, _ in nodes}, timeout=10
+        )
+        for res in responses:
+            if res.status == 404:
+                inline_nodes.add(res.node_id)
+            elif not res.ok:
+                failed[res.node_id] = res.error
+            else:
+                for digest in res.data.get('missing', []):
+                    uploads.append((res.node_id, res.url, 'PUT', f"/blobs/{digest}", blobs[digest]))
         
-        for node_id, url in self.colab_nodes.items():
-            try:
-                response = requests.get(f"{url}/resources", timeout=5)
-                resources = response.json()
-                
-                gpu = resources.get('gpu', [{}])[0]
-                memory = resources.get('memory', {})
-                
-                print(f"Node: {node_id}")
-                print(f"  URL: {url}")
-                print(f"  GPU: {gpu.get('name', 'N/A')} ({gpu.get('utilization', 0):.1f}%)")
-                print(f"  Memory: {memory.get('percent', 0):.1f}% used")
-                print()
-                
-            except Exception as e:
-                print(f"Node: {node_id} - ❌ エラー: {str(e)}")
-                print()
+        sent: Dict[str, int] = {}
+        for (node_id, _, _, _, data), res in zip(uploads, self.node_client.batch(uploads, timeout=120)):
+            if not res.ok:
+                failed.setdefault(node_id, f"アップロード失敗 - {res.error}")
+            sent[node_id] = sent.get(node_id, 0) + len(data)
+        
+        for node_id, _ in nodes:
+            if node_id not in failed and node_id not in inline_nodes:
+                print(f"📦 Node {node_id}: {sent.get(node_id, 0) / 1024:.1f} KB 送信")
+        return code_hash, inline_nodes, failed
     
-    @cell_magic
-    def colab_train(self, line: str, cell: str) -> None:
+    def _load_dataset(self, path: str, node_count: int) -> DatasetShards:
+        """--data のデータセットをシャードに分割 (ファイルが変わっていなければ前回の分割を再利用)"""
+        key = (DatasetShards.signature(path), node_count)
+        data = self.dataset_cache.get(key)
+        if data is None:
+            start = time.time()
+            data = DatasetShards(path, node_count)
+            self.dataset_cache[key] = data
+            print(f"📚 データ分割: {path} ({data.format}, {time.time() - start:.1f}s)")
+        
+        sizes = [data.shard_bytes(index) / 1024 ** 2 for index in range(node_count)]
+        print(f"   {node_count} シャード: {min(sizes):.1f} - {max(sizes):.1f} MB / ノード")
+        return data
+    
+    def _sync_dataset(self, job: QueuedJob, nodes: List[Tuple[str, str]], inline_nodes: set,
+                      failed: Dict[str, str]) -> None:
         """
-        Colab クラスタで分散学習実行
-        使用例:
-        %%colab_train --nodes 2 --epochs 10
-        import torch
-        # 学習コード
+        各ノードに自分のシャードのチャンクのうち、まだ持っていないものだけを送る
+        全ノードへ交互に並行送信し、同時に読み込むのは同時接続数分のチャンクだけなのでメモリは一定
         """
-        args = self._parse_args(line)
-        node_count = int(args.get('nodes', 1))
-        epochs = int(args.get('epochs', 10))
+        for node_id in inline_nodes:
+            failed.setdefault(node_id, "blob ストア非対応のサーバーには --data を送れません")
+        targets = [(index, node_id, url) for index, (node_id, url) in enumerate(nodes) if node_id not in failed]
+        shards = {node_id: {chunk.digest: chunk for chunk in job.data.chunks[index]} for index, node_id, _ in targets}
         
-        if not self.colab_nodes:
-            print("❌ Colabノードが接続されていません")
-            return
+        responses = self.node_client.fan_out(
+            [(node_id, url) for _, node_id, url in targets], 'POST', '/blobs/missing',
+            # pin: 送信中に同じシャードの先に送ったチャンクが容量上限で消されないよう /train まで保持させる
+            {node_id: {'hashes': list(shards[node_id]), 'pin': job.job_id} for _, node_id, _ in targets}, timeout=30
+        )
+        queues = []
+        for res in responses:
+            if not res.ok:
+                failed[res.node_id] = f"データ送信失敗 - {res.error}"
+                continue
+            queues.append([(res.node_id, res.url, shards[res.node_id][digest]) for digest in res.data.get('missing', [])])
+        uploads = [item for group in itertools.zip_longest(*queues) for item in group if item]
         
-        available_nodes = list(self.colab_nodes.items())[:node_count]
+        sent: Dict[str, int] = {}
+        wave = self.node_client.max_concurrency
+        for start in range(0, len(uploads), wave):
+            calls = [
+                (node_id, url, 'PUT', f"/blobs/{chunk.digest}", chunk.read())
+                for node_id, url, chunk in uploads[start:start + wave] if node_id not in failed
+            ]
+            for (node_id, _, _, _, body), res in zip(calls, self.node_client.batch(calls, timeout=120)):
+                if res.ok:
+                    sent[node_id] = sent.get(node_id, 0) + len(body)
+                else:
+                    failed.setdefault(node_id, f"データ送信失敗 - {res.error}")
         
-        if len(available_nodes) < node_count:
-            print(f"⚠️  要求ノード数: {node_count}, 利用可能: {len(available_nodes)}")
+        for index, node_id, _ in targets:
+            if node_id not in failed:
+                total = job.data.shard_bytes(index)
+                print(f"📚 Node {node_id}: シャード {index} ({total / 1024 ** 2:.1f} MB) のうち "
+                      f"{sent.get(node_id, 0) / 1024 ** 2:.1f} MB 送信")
+    
+    @line_magic
+    def colab_job_metrics(self, line: str) -> Optional[Dict[str, Dict[str, Dict[str, Any]]]]:
+        """
+        ジョブのメトリクス時系列を全ノードから取得 (プロット用の配列で返す)
+        使用例: metrics = %colab_job_metrics job_1234567890 --names loss,acc --points 200
+        戻り値: {node_id: {metric: {'steps': array, 'values': array}}}
+        """
+        parts = line.split()
+        job_id = parts[0] if parts and not parts[0].startswith('--') else ''
+        args = self._parse_args(line)
+        if not job_id:
+            print("❌ Usage: %colab_job_metrics <job_id> [--names loss,acc] [--points 200]")
+            return None
         
-        job_id = f"job_{int(time.time())}"
+        if job_id not in self.active_jobs or not self.active_jobs[job_id]['nodes']:
+            print(f"❌ ジョブ {job_id} が見つかりません")
+            return None
         
-        print(f"🚀 分散学習開始")
-        print(f"   Job ID: {job_id}")
-        print(f"   ノード数: {len(available_nodes)}")
-        print(f"   エポック数: {epochs}")
-        print("-" * 40)
+        query = f"points={int(args.get('points', 200))}"
+        if isinstance(args.get('names'), str):
+            query += f"&names={args['names']}"
         
-        # 各ノードにタスク配布
-        results = []
-        for idx, (node_id, url) in enumerate(available_nodes):
-            task_config = {
-                'job_id': job_id,
-                'node_id': node_id,
-                'node_index': idx,
-                'total_nodes': len(available_nodes),
-                'epochs': epochs,
-                'code': cell
-            }
-            
-            try:
-                response = requests.post(
-                    f"{url}/train", 
-                    json=task_config,
-                    timeout=30
-                )
-                response.raise_for_status()
-                result = response.json()
-                
-                print(f"✅ Node {node_id}: 学習開始")
-                results.append(result)
-                
-            except Exception as e:
-                print(f"❌ Node {node_id}: 失敗 - {str(e)}")
+        try:
+            import numpy as np
+            to_array = lambda values: np.asarray(values, dtype=float)
+        except ImportError:
+            to_array = list
         
-        if results:
-            self.active_jobs[job_id] = {
-                'nodes': available_nodes,
-                'start_time': time.time(),
-                'status': 'running'
+        result = {}
+        for res in self.node_client.fan_out(self.active_jobs[job_id]['nodes'], 'GET', f"/job/{job_id}/metrics?{query}"):
+            if not res.ok:
+                print(f"❌ Node {res.node_id}: {res.error}")
+                continue
+            result[res.node_id] = {
+                name: {'steps': to_array(series['steps']), 'values': to_array(series['values'])}
+                for name, series in res.data.get('metrics', {}).items()
             }
-            print(f"\n💡 進捗確認: %colab_job_status {job_id}")
+        return result
     
     @line_magic
-    def colab_job_status(self, line: str) -> None:
+    def colab_job_cancel(self, line: str) -> None:
         """
-        学習ジョブの状況確認
-        使用例: %colab_job_status job_1234567890
+        学習ジョブのキャンセル
+        使用例: %colab_job_cancel job_1234567890
         """
         job_id = line.strip()
         if not job_id:
-            # 全ジョブの状況表示
-            if not self.active_jobs:
-                print("📭 実行中のジョブはありません")
-                return
-            
-            print("📊 実行中のジョブ:")
-            for jid, job_info in self.active_jobs.items():
-                elapsed = time.time() - job_info['start_time']
-                print(f"  {jid}: {job_info['status']} ({elapsed:.0f}s)")
+            print("❌ Usage: %colab_job_cancel <job_id>")
             return
         
         if job_id not in self.active_jobs:
@@ -185,23 +3148,212 @@ class AIDevMagics(Magics):
             return
         
         job_info = self.active_jobs[job_id]
-        print(f"📊 Job Status: {job_id}")
-        print("-" * 40)
+        if self.scheduler.cancel(job_id):
+            job_info['status'] = 'cancelled'
+            print(f"🛑 Job {job_id}: キューから削除しました")
+            return
         
-        for node_id, url in job_info['nodes']:
-            try:
-                response = requests.get(f"{url}/job/{job_id}/status", timeout=5)
-                status = response.json()
-                
-                print(f"Node {node_id}:")
-                print(f"  Status: {status.get('status', 'unknown')}")
-                print(f"  Epoch: {status.get('current_epoch', 0)}/{status.get('total_epochs', 0)}")
-                print(f"  Loss: {status.get('current_loss', 'N/A')}")
-                print()
-                
-            except Exception as e:
-                print(f"Node {node_id}: ❌ エラー - {str(e)}")
-                print()
+        for res in self.node_client.fan_out(job_info['nodes'], 'POST', f"/job/{job_id}/cancel", timeout=10, adaptive=False):
+            if res.ok:
+                print(f"🛑 Node {res.node_id}: {res.data.get('status', 'cancelled')}")
+            else:
+                print(f"❌ Node {res.node_id}: キャンセル失敗 - {res.error}")
+        job_info['status'] = 'cancelled'
+    
+    @line_magic
+    def colab_pull(self, line: str) -> None:
+        """
+        ジョブの成果物 (ジョブの作業ディレクトリに書き出したチェックポイントなど) をダウンロード
+        中断しても再実行すれば続きから取得し、複数ノードの成果物は並列に取得する
+        使用例: %colab_pull job_1234567890
+               %colab_pull job_1234567890 --dest ./ckpt --files model.pt,logs/ --chunk-mb 64 --workers 8
+               %colab_pull job_1234567890 --node colab_1712345678
+        """
+        parts = line.split()
+        if not parts or parts[0].startswith('--'):
+            print("❌ Usage: %colab_pull <job_id> [--dest DIR] [--files a,b/] [--node NODE_ID] "
+                  "[--chunk-mb 32] [--workers 8]")
+            return
+        
+        job_id = parts[0]
+        args = self._parse_args(line)
+        job_info = self.active_jobs.get(job_id)
+        nodes = job_info['nodes'] if job_info and job_info['nodes'] else list(self.colab_nodes.items())
+        if isinstance(args.get('node'), str):
+            nodes = [(node_id, url) for node_id, url in nodes if node_id == args['node']]
+        if not nodes:
+            print("❌ Colabノードが接続されていません")
+            return
+        
+        dest = args['dest'] if isinstance(args.get('dest'), str) else os.path.join('artifacts', job_id)
+        selectors = [item.rstrip('/') for item in args['files'].split(',')] if isinstance(args.get('files'), str) else []
+        
+        # 一覧取得はチェックサム計算 (初回のみ) で時間が読めないため適応タイムアウトを使わない
+        sources = []
+        for res in self.node_client.fan_out(nodes, 'GET', f"/job/{job_id}/artifacts?checksum=1",
+                                            timeout=600, adaptive=False):
+            if not res.ok:
+                print(f"⚠️  {res.node_id}: 成果物一覧を取得できません - {res.error}")
+                continue
+            for entry in res.data['files']:
+                if selectors and not any(
+                    entry['path'] == item or entry['path'].startswith(item + '/') for item in selectors
+                ):
+                    continue
+                # 複数ノードの成果物はノードごとのディレクトリに分ける
+                relative = entry['path'] if len(nodes) == 1 else f"{res.node_id}/{entry['path']}"
+                sources.append((res.node_id, res.url, job_id, entry, relative))
+        
+        if not sources:
+            print(f"📭 Job {job_id}: 取得する成果物がありません")
+            return
+        
+        total = sum(source[3]['size'] for source in sources)
+        print(f"📥 成果物ダウンロード開始: Job {job_id}")
+        print(f"   ファイル: {len(sources)} 件 ({total / 1024 ** 2:.1f} MB, {len(nodes)} ノード)")
+        print(f"   保存先: {os.path.abspath(dest)}")
+        
+        puller = ArtifactPuller(
+            dest, part_size=int(float(args.get('chunk-mb', 32)) * 1024 ** 2),
+            workers=int(args.get('workers', 8)), stats=self.stats
+        )
+        start = time.time()
+        result = puller.pull(sources, on_done=lambda relative, size: print(
+            f"   ✅ {relative} ({size / 1024 ** 2:.1f} MB)"
+        ))
+        elapsed = time.time() - start
+        
+        speed = puller.bytes_downloaded / 1024 ** 2 / elapsed if elapsed > 0 else 0.0
+        print(f"{'✅' if not result['failed'] else '⚠️ '} ダウンロード{'完了' if not result['failed'] else '終了'}")
+        print(f"   ファイル: {len(result['completed'])} 件取得 / {len(result['skipped'])} 件は取得済み")
+        print(f"   転送量: {puller.bytes_downloaded / 1024 ** 2:.1f} MB ({speed:.1f} MB/s)")
+        for relative, error in result['failed'].items():
+            print(f"   ❌ {relative}: {error}")
+        if result['failed']:
+            print("   再実行すると取得済みの部分から再開します")
+    
+    def _print_cluster_jobs(self) -> None:
+        """クラスタ全体のジョブ状況を表示 (ノードごとに /jobs を1回だけ呼ぶ)"""
+        cluster = self._fetch_cluster_jobs() if self.colab_nodes else {}
+        queued = [jid for jid, info in self.active_jobs.items() if info['status'] == 'queued']
+        
+        if not cluster and not queued:
+            print("📭 実行中のジョブはありません")
+            return
+        
+        print(f"📊 クラスタ全体のジョブ ({len(self.colab_nodes)} ノード):")
+        for jid, job in sorted(cluster.items(), key=lambda item: item[1]['start_time'] or 0):
+            loss = f"{job['loss']:.4f}" if job['loss'] is not None else 'N/A'
+            print(f"  {jid}: {job['status']}  epoch {job['epoch']}/{job['total_epochs']}  "
+                  f"loss {loss}  ({len(job['nodes'])} nodes, {job['elapsed']:.0f}s)")
+            if jid in self.active_jobs and self.active_jobs[jid]['status'] != 'queued':
+                self.active_jobs[jid]['status'] = job['status']
+        for jid in queued:
+            print(f"  {jid}: queued (キュー {self.scheduler.queue_position(jid)} 番目)")
+    
+    def _fetch_cluster_jobs(self) -> Dict[str, Dict]:
+        """
+        全ノードの /jobs を差分取得してキャッシュに反映し、ジョブごとに集約
+        戻り値: {job_id: {'status', 'epoch', 'total_epochs', 'loss', 'elapsed', 'start_time', 'nodes'}}
+        """
+        calls = [
+            (node_id, url, 'GET', f"/jobs?since={self._jobs_cursor.get(node_id, 0)}", None)
+            for node_id, url in self.colab_nodes.items()
+        ]
+        for res in self.node_client.batch(calls, timeout=10):
+            if not res.ok:
+                print(f"⚠️  Node {res.node_id}: {res.error}")
+                continue
+            self.cluster_jobs.setdefault(res.node_id, {}).update(res.data.get('jobs', {}))
+            self._jobs_cursor[res.node_id] = res.data.get('timestamp', 0)
+        
+        per_job: Dict[str, Dict[str, Dict]] = {}
+        for node_id, jobs in self.cluster_jobs.items():
+            if node_id not in self.colab_nodes:
+                continue
+            for jid, summary in jobs.items():
+                per_job.setdefault(jid, {})[node_id] = summary
+        return {jid: self._aggregate_job(nodes) for jid, nodes in per_job.items()}
+    
+    @staticmethod
+    def _aggregate_job(nodes: Dict[str, Dict]) -> Dict:
+        """ノードごとの概要を1ジョブ分に集約 (進捗は最も遅いノード、loss は平均)"""
+        summaries = list(nodes.values())
+        statuses = {summary.get('status') for summary in summaries}
+        status = next(
+            (state for state in ('error', 'running', 'queued', 'cancelled', 'completed') if state in statuses),
+            'unknown'
+        )
+        losses = [
+            summary['current_loss'] for summary in summaries
+            if isinstance(summary.get('current_loss'), (int, float))
+        ]
+        return {
+            'status': status,
+            'epoch': min(summary.get('current_epoch', 0) for summary in summaries),
+            'total_epochs': max(summary.get('total_epochs', 0) for summary in summaries),
+            'loss': sum(losses) / len(losses) if losses else None,
+            'elapsed': max(summary.get('elapsed_time', 0) for summary in summaries),
+            'start_time': min(summary.get('start_time', 0) for summary in summaries),
+            'nodes': nodes
+        }
+    
+    def _follow_job(self, job_id: str, job_info: Dict) -> None:
+        """全ノードの進捗イベントを1つのライブ表示に集約"""
+        from IPython.display import display, HTML
+        rows = {
+            node_id: {'status': 'running', 'epoch': 0, 'total_epochs': '?', 'loss': None}
+            for node_id, _ in job_info['nodes']
+        }
+        handle = display(HTML(self._render_job_progress(job_id, rows)), display_id=True)
+        
+        try:
+            for res in self.node_client.follow(job_info['nodes'], f"/job/{job_id}/events"):
+                row = rows[res.node_id]
+                if not res.ok:
+                    row['status'] = f"❌ {res.error}"
+                else:
+                    for event in res.data['events']:
+                        self._apply_job_event(row, event)
+                handle.update(HTML(self._render_job_progress(job_id, rows)))
+        except KeyboardInterrupt:
+            print("⏹  追跡を停止しました")
+            return
+        
+        statuses = {row['status'] for row in rows.values()}
+        if statuses == {'completed'}:
+            job_info['status'] = 'completed'
+        elif 'error' in statuses:
+            job_info['status'] = 'error'
+    
+    def _apply_job_event(self, row: Dict, event: Dict) -> None:
+        """進捗イベントを表示用の行に反映"""
+        kind = event.get('type')
+        if kind == 'started':
+            row['total_epochs'] = event.get('total_epochs', row['total_epochs'])
+        elif kind == 'progress':
+            row['epoch'] = event.get('epoch', row['epoch'])
+            row['loss'] = event.get('loss', row['loss'])
+        elif kind in ('completed', 'error', 'cancelled'):
+            row['status'] = kind
+            if event.get('error'):
+                row['error'] = event['error']
+    
+    def _render_job_progress(self, job_id: str, rows: Dict[str, Dict]) -> str:
+        """ライブ表示用の HTML テーブル"""
+        body = ""
+        for node_id, row in rows.items():
+            loss = f"{row['loss']:.4f}" if isinstance(row['loss'], (int, float)) else 'N/A'
+            status = row['status'] + (f" ({row['error']})" if row.get('error') else '')
+            body += (
+                f"<tr><td>{node_id}</td><td>{status}</td>"
+                f"<td>{row['epoch']}/{row['total_epochs']}</td><td>{loss}</td></tr>"
+            )
+        return (
+            f"<b>📊 Job Status: {job_id}</b>"
+            "<table><tr><th>Node</th><th>Status</th><th>Epoch</th><th>Loss</th></tr>"
+            f"{body}</table>"
+        )
     
     # =========================================================================
     # HUGGINGFACE MAGIC COMMANDS
@@ -236,78 +3388,290 @@ class AIDevMagics(Magics):
     @line_magic
     def hf_push(self, line: str) -> None:
         """
-        モデルを HuggingFace Hub にプッシュ
+        モデルを HuggingFace Hub にプッシュ (並列・再開可能)
         使用例: %hf_push model_name --private
+               %hf_push org/model --path ./checkpoints/best --workers 16 --message "epoch 10"
+               %hf_push org/model --endpoint http://localhost:9000  (Hub 互換のスタンドインに送信)
+        --path を省略すると ./model、なければ user_ns の model / tokenizer を保存してアップロード
+        中断した場合は同じコマンドを再実行すると完了済みのチャンクを飛ばして再開する
         """
-        args = line.split()
-        if not args:
-            print("❌ Usage: %hf_push <model_name> [--private]")
+        parts = self._split_line(line)
+        args = self._parse_args(line)
+        missing = [f"--{key}" for key in ('path', 'revision', 'message', 'workers', 'endpoint') if args.get(key) is True]
+        if not parts or parts[0].startswith('--') or missing:
+            if missing:
+                print(f"❌ 値が指定されていません: {', '.join(missing)}")
+            print("❌ Usage: %hf_push <model_name> [--private] [--path DIR] [--revision REV] "
+                  "[--message MSG] [--workers N] [--endpoint URL]")
             return
         
-        model_name = args[0]
-        is_private = '--private' in args
+        model_name = parts[0]
+        is_private = 'private' in args
+        revision = args.get('revision', 'main')
+        message = args.get('message', f"Upload {model_name}")
+        folder = args.get('path', './model')
         
         try:
-            from huggingface_hub import HfApi, Repository
+            if not os.path.isdir(folder):
+                folder = self._save_model_for_push(model_name)
             
-            api = HfApi()
-            
-            # モデルリポジトリ作成
-            api.create_repo(
-                repo_id=model_name,
-                repo_type="model",
-                private=is_private
+            uploader = HubUploader(
+                model_name, revision,
+                endpoint=args.get('endpoint'),
+                workers=int(args.get('workers', 8)),
+                stats=self.stats
             )
             
             print(f"📤 モデルアップロード開始: {model_name}")
+            print(f"   フォルダ: {folder}")
             print(f"   プライベート: {is_private}")
             
-            # 実際のアップロード処理（モデルファイルパスは要調整）
-            # api.upload_folder(folder_path="./model", repo_id=model_name)
+            start = time.time()
+            
+            def on_done(obj: Dict) -> None:
+                print(f"   ✅ {obj['path']} ({obj['size'] / 1024 ** 2:.1f} MB)")
+            
+            result = uploader.push(folder, message, private=is_private, on_done=on_done)
+            elapsed = time.time() - start
+            stats = uploader.stats
+            
+            if result['commit'] is None:
+                print(f"✅ 変更なし: {result['files']} ファイルすべてリモートと同一です")
+                return
             
             print(f"✅ アップロード完了!")
-            print(f"   URL: https://huggingface.co/{model_name}")
+            print(f"   ファイル: {result['changed']} 件更新 / {stats['skipped']} 件は変更なし")
+            print(f"   転送量: {stats['uploaded_bytes'] / 1024 ** 2:.1f} MB "
+                  f"({stats['uploaded_bytes'] / 1024 ** 2 / max(elapsed, 1e-6):.1f} MB/s)")
+            if stats['resumed_parts']:
+                print(f"   再開: {stats['resumed_parts']} チャンクは前回アップロード済み")
+            print(f"   URL: {result['commit'].get('commitUrl') or f'{uploader.endpoint}/{model_name}'}")
             
-        except ImportError:
-            print("❌ huggingface_hub がインストールされていません")
         except Exception as e:
             print(f"❌ アップロード失敗: {str(e)}")
+            print("   同じコマンドを再実行すると続きから再開します")
+    
+    def _save_model_for_push(self, model_name: str) -> str:
+        """user_ns の model / tokenizer をアップロード用ディレクトリに保存"""
+        model = self.shell.user_ns.get('model')
+        if model is None or not hasattr(model, 'save_pretrained'):
+            raise FileNotFoundError("--path のフォルダも user_ns の model も見つかりません")
+        folder = os.path.expanduser(os.path.join('~/.labflow/uploads/staging', model_name.replace('/', '--')))
+        model.save_pretrained(folder)
+        tokenizer = self.shell.user_ns.get('tokenizer')
+        if tokenizer is not None and hasattr(tokenizer, 'save_pretrained'):
+            tokenizer.save_pretrained(folder)
+        return folder
     
     @line_magic
     def hf_download(self, line: str) -> None:
         """
-        HuggingFace Hub からモデルダウンロード
+        HuggingFace Hub からモデルダウンロード (ローカルキャッシュ経由)
         使用例: %hf_download bert-base-uncased
+               %hf_download bert-base-uncased --revision main --verify
+               %hf_download org/model --source /data/hub_mirror  (ローカルディレクトリを Hub として使用)
+               %hf_download org/model --lazy --dtype bf16 --layers 0-5  (必要な重みだけメモリマップで読み込み)
+               %hf_download gpt2 --as gpt2  (user_ns の gpt2 / gpt2_tokenizer に設定、読み込み済みなら再利用)
         """
-        if not line.strip():
-            print("❌ Usage: %hf_download <model_name>")
+        parts = line.split()
+        args = self._parse_args(line)
+        missing = [f"--{key}" for key in ('revision', 'source', 'dtype', 'layers', 'as') if args.get(key) is True]
+        if not parts or parts[0].startswith('--') or missing:
+            if missing:
+                print(f"❌ 値が指定されていません: {', '.join(missing)}")
+            print("❌ Usage: %hf_download <model_name> [--revision REV] [--source DIR] [--verify] [--refresh] "
+                  "[--lazy] [--dtype DTYPE] [--layers 0-5] [--as NAME]")
             return
         
-        model_name = line.strip()
+        model_name = parts[0]
+        revision = args.get('revision', 'main')
+        source = args.get('source') or os.environ.get('LABFLOW_HF_SOURCE')
+        alias = args['as'] if isinstance(args.get('as'), str) else None
+        registry_key = ModelRegistry.key(
+            model_name, revision,
+            args['dtype'] if isinstance(args.get('dtype'), str) else None,
+            args['layers'] if isinstance(args.get('layers'), str) else None
+        )
+        
+        # 読み込み済みなら同じインスタンスを返す
+        entry = None if 'refresh' in args else self.model_registry.get(registry_key)
+        if entry is not None:
+            print(f"♻️  読み込み済みモデルを再利用: {registry_key} ({entry.memory_bytes() / 1024 ** 2:.1f} MB)")
+            self._bind_model(entry, alias)
+            self._evict_models(keep=registry_key)
+            return
         
         try:
             from transformers import AutoModel, AutoTokenizer
             
             print(f"📥 モデルダウンロード開始: {model_name}")
             
-            # モデルとトークナイザーをダウンロード
-            model = AutoModel.from_pretrained(model_name)
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            # キャッシュにあればネットワークを使わずにローカルから読み込む
+            path, hit = self.model_cache.fetch(
+                model_name, revision, source=source,
+                refresh='refresh' in args, verify='verify' in args
+            )
+            print(f"   {'⚡ キャッシュヒット' if hit else '💾 キャッシュに保存'}: {path}")
+            
+            # モデルとトークナイザーを読み込み
+            load_start = time.perf_counter()
+            model, loader = self._load_model(AutoModel, path, args)
+            tokenizer = AutoTokenizer.from_pretrained(path)
             
             print(f"✅ ダウンロード完了!")
             print(f"   モデル: {type(model).__name__}")
             print(f"   トークナイザー: {type(tokenizer).__name__}")
+            print(f"   読み込み時間: {time.perf_counter() - load_start:.1f}s")
             
-            # グローバル変数に設定
-            self.shell.user_ns['model'] = model
-            self.shell.user_ns['tokenizer'] = tokenizer
+            # レジストリに登録してグローバル変数に設定
+            self._unbind_model(self.model_registry.remove(registry_key))
+            entry = self.model_registry.put(registry_key, model, tokenizer, loader)
+            self._bind_model(entry, alias)
+            self._evict_models(keep=registry_key)
             
-        except ImportError:
-            print("❌ transformers がインストールされていません")
-            print("   pip install transformers")
+        except ImportError as e:
+            print(f"❌ {e.name or 'transformers'} がインストールされていません")
+            print(f"   pip install {e.name or 'transformers'}")
         except Exception as e:
             print(f"❌ ダウンロード失敗: {str(e)}")
     
+    def _load_model(self, model_class: Any, path: str, args: Dict[str, Any]) -> Tuple[Any, Optional[LazyModelLoader]]:
+        """
+        --lazy / --dtype / --layers に応じてモデルを読み込む
+        戻り値: (モデル, 遅延読み込み中ならそのローダー)
+        """
+        lazy = 'lazy' in args
+        dtype = args.get('dtype') if isinstance(args.get('dtype'), str) else None
+        layers = LazyModelLoader.parse_layers(args['layers']) if isinstance(args.get('layers'), str) else None
+        
+        if not (lazy or dtype or layers is not None):
+            return model_class.from_pretrained(path), None
+        
+        try:
+            loader = LazyModelLoader(path, dtype, layers)
+        except FileNotFoundError as e:
+            # .bin 形式のみのモデルはメモリマップできないため通常読み込み
+            print(f"⚠️  {str(e)} - 通常の読み込みに切り替えます")
+            return model_class.from_pretrained(path, torch_dtype=dtype or 'auto'), None
+        
+        model = loader.build(model_class, lazy=lazy)
+        if layers is not None:
+            print(f"   レイヤー: {', '.join(map(str, layers))} のみ")
+        if lazy:
+            print("   🦥 遅延読み込み: 重みは各モジュールの初回実行時に読み込まれます")
+            return model, loader
+        print(f"   読み込んだ重み: {loader.loaded_bytes / 1024 ** 2:.1f} MB")
+        loader.close()  # 全て読み込んだのでシャードのメモリマップは不要
+        return model, None
+    
+    def _bind_model(self, entry: LoadedModel, alias: Optional[str]) -> None:
+        """model / tokenizer (--as 指定時は <NAME> / <NAME>_tokenizer) に設定"""
+        model_var, tokenizer_var = (alias, f"{alias}_tokenizer") if alias else ('model', 'tokenizer')
+        self.shell.user_ns[model_var] = entry.model
+        self.shell.user_ns[tokenizer_var] = entry.tokenizer
+        if alias and alias not in entry.aliases:
+            entry.aliases.append(alias)
+    
+    def _unbind_model(self, entry: Optional[LoadedModel]) -> None:
+        """エントリを参照している user_ns の変数を削除 (参照が残るとメモリが解放されない)"""
+        if entry is None:
+            return
+        for name, value in list(self.shell.user_ns.items()):
+            if value is entry.model or value is entry.tokenizer:
+                del self.shell.user_ns[name]
+    
+    def _evict_models(self, keep: Optional[str] = None) -> None:
+        evicted = self.model_registry.enforce_budget(keep)
+        for entry in evicted:
+            self._unbind_model(entry)
+            print(f"🗑️  メモリ上限のためモデルを解放: {entry.key}")
+        if evicted:
+            gc.collect()
+    
+    @line_magic
+    def hf_models(self, line: str) -> None:
+        """
+        カーネル内に常駐しているモデルの一覧と管理
+        使用例: %hf_models
+               %hf_models evict gpt2[@main]  (キーまたは --as の別名)
+               %hf_models --budget-gb 12
+        """
+        parts = line.split()
+        registry = self.model_registry
+        args = self._parse_args(line)
+        
+        if 'budget-gb' in args:
+            registry.max_bytes = int(float(args['budget-gb']) * 1024 ** 3)
+            self._evict_models()
+        
+        if parts and parts[0] == 'evict':
+            entry = registry.find(parts[1]) if len(parts) > 1 else None
+            if entry is None:
+                print(f"❌ 読み込み済みモデルに {parts[1] if len(parts) > 1 else '(未指定)'} がありません")
+                return
+            self._unbind_model(registry.remove(entry.key))
+            gc.collect()
+            print(f"🗑️  解放: {entry.key}")
+            return
+        
+        if not registry.entries:
+            print("📭 読み込み済みのモデルはありません")
+            return
+        
+        print(f"🧠 読み込み済みモデル: {registry.total_bytes() / 1024 ** 3:.2f} GB / "
+              f"{registry.max_bytes / 1024 ** 3:.2f} GB")
+        print("-" * 60)
+        # 最近使ったものから表示 (末尾が次の解放対象)
+        for entry in reversed(registry.entries.values()):
+            last_used = time.strftime('%H:%M:%S', time.localtime(entry.last_used))
+            aliases = f"  as {', '.join(entry.aliases)}" if entry.aliases else ''
+            print(f"  {entry.key}  {entry.memory_bytes() / 1024 ** 2:.1f} MB  "
+                  f"{type(entry.model).__name__}{aliases}  (最終使用 {last_used})")
+    
+    @line_magic
+    def hf_cache(self, line: str) -> None:
+        """
+        モデルキャッシュの管理
+        使用例: %hf_cache list
+               %hf_cache prune [--max-gb 20]
+               %hf_cache pin bert-base-uncased[@main]
+               %hf_cache unpin bert-base-uncased[@main]
+        """
+        parts = line.split()
+        command = parts[0] if parts else 'list'
+        cache = self.model_cache
+        
+        if command == 'list':
+            if not cache.index:
+                print(f"📭 キャッシュは空です ({cache.root})")
+                return
+            print(f"🗄️  モデルキャッシュ: {cache.root}")
+            print(f"   使用量: {cache.total_bytes() / 1024 ** 3:.2f} GB / {cache.max_bytes / 1024 ** 3:.2f} GB")
+            print("-" * 60)
+            for key, entry in sorted(cache.index.items(), key=lambda item: -item[1]['last_access']):
+                last_access = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_access']))
+                pin_mark = '📌' if entry.get('pinned') else '  '
+                print(f"{pin_mark} {key}  {entry['size'] / 1024 ** 2:.1f} MB  "
+                      f"{len(entry['files'])} files  (最終アクセス {last_access})")
+        
+        elif command == 'prune':
+            args = self._parse_args(line)
+            max_bytes = int(float(args['max-gb']) * 1024 ** 3) if 'max-gb' in args else None
+            removed = cache.prune(max_bytes)
+            for key in removed:
+                print(f"🗑️  削除: {key}")
+            print(f"✅ 使用量: {cache.total_bytes() / 1024 ** 3:.2f} GB ({len(removed)} 件削除)")
+        
+        elif command in ('pin', 'unpin') and len(parts) > 1:
+            key = parts[1] if '@' in parts[1] else ModelCache.key(parts[1], 'main')
+            if cache.pin(key, command == 'pin'):
+                print(f"{'📌' if command == 'pin' else '✅'} {key}: {command}")
+            else:
+                print(f"❌ キャッシュに {key} がありません")
+        
+        else:
+            print("❌ Usage: %hf_cache list | prune [--max-gb N] | pin <repo>[@rev] | unpin <repo>[@rev]")
+    
     # =========================================================================
     # CLAUDE MAGIC COMMANDS  
     # =========================================================================
@@ -317,26 +3681,41 @@ class AIDevMagics(Magics):
         """
         Claude AI に質問
         使用例: %claude "このコードを最適化して"
+               %claude "..." --no-cache  (キャッシュを使わない) / --refresh (再取得してキャッシュを更新)
+               handle = %claude "..." --background  (カーネルを塞がずに実行、handle.result() で全文)
+               %claude "..." --no-stream  (完了まで待ってからまとめて表示)
         """
-        if not line.strip():
-            print("❌ Usage: %claude \"<message>\"")
+        words = line.split()
+        options = self._cache_options(line)
+        message = ' '.join(word for word in words if word not in self.CLAUDE_FLAGS)
+        message = message.strip().strip('"\'')
+        if not message:
+            print("❌ Usage: %claude \"<message>\" [--no-cache] [--refresh] [--background] [--no-stream]")
             return
         
-        message = line.strip().strip('"\'')
+        def add_to_session(response: str) -> None:
+            # セッション履歴に追加
+            self.claude_session.append({'role': 'user', 'content': message})
+            self.claude_session.append({'role': 'assistant', 'content': response})
+        
+        # 直近の会話と古い会話の要約を文脈として渡す (予算内に収まる)
+        options.update(self.claude_session.context())
         
         try:
+            if '--no-stream' not in words:
+                stream = self._stream_claude_api(message, "🤖 Claude AI", add_to_session,
+                                                 background='--background' in words, **options)
+                return stream if '--background' in words else stream.result()
+            
             # Claude API 呼び出し
-            response = self._call_claude_api(message)
+            response = self._call_claude_api(message, **options)
             
             print("🤖 Claude AI:")
             print("-" * 40)
             print(response)
             print("-" * 40)
             
-            # セッション履歴に追加
-            self.claude_session.append({'role': 'user', 'content': message})
-            self.claude_session.append({'role': 'assistant', 'content': response})
-            
+            add_to_session(response)
             return response
             
         except Exception as e:
@@ -346,9 +3725,9 @@ class AIDevMagics(Magics):
     @cell_magic
     def claude_analyze(self, line: str, cell: str) -> str:
         """
-        セルのコードを Claude AI で分析
+        セルのコードを Claude AI で分析 (同じセルの再実行はキャッシュから即座に返す)
         使用例:
-        %%claude_analyze
+        %%claude_analyze [--no-cache] [--refresh] [--background] [--no-stream]
         import pandas as pd
         df = pd.read_csv('data.csv')
         """
@@ -366,8 +3745,14 @@ class AIDevMagics(Magics):
 4. 最適化の提案
 """
         
+        words = line.split()
         try:
-            response = self._call_claude_api(analysis_prompt)
+            if '--no-stream' not in words:
+                stream = self._stream_claude_api(analysis_prompt, "🔍 Claude コード分析結果",
+                                                 background='--background' in words, **self._cache_options(line))
+                return stream if '--background' in words else stream.result()
+            
+            response = self._call_claude_api(analysis_prompt, **self._cache_options(line))
             
             print("🔍 Claude コード分析結果:")
             print("=" * 50)
@@ -384,7 +3769,7 @@ class AIDevMagics(Magics):
     def claude_optimize(self, line: str) -> None:
         """
         直前のセルのコードを Claude AI で最適化
-        使用例: %claude_optimize
+        使用例: %claude_optimize [--no-cache] [--refresh]
         """
         # 直前のセルの内容を取得
         if hasattr(self.shell, 'history_manager'):
@@ -403,7 +3788,7 @@ class AIDevMagics(Magics):
 """
                 
                 try:
-                    response = self._call_claude_api(optimize_prompt)
+                    response = self._call_claude_api(optimize_prompt, **self._cache_options(line))
                     
                     print("⚡ Claude 最適化提案:")
                     print("=" * 50)
@@ -415,16 +3800,393 @@ class AIDevMagics(Magics):
             else:
                 print("❌ 直前のセルが見つかりません")
         else:
-            print("❌ 履歴機能が利用できません")
+            print("❌ 履歴機能が利用できません")
+    
+    @line_magic
+    def claude_analyze_notebook(self, line: str) -> List[Dict]:
+        """
+        ノートブック全体 (または範囲) のセルをまとめて Claude AI で分析
+        小さいセルはバッチにまとめ、トークンバケットでレート制限しながら並列にリクエストする
+        使用例: %claude_analyze_notebook                     (このセッションの全セル)
+               %claude_analyze_notebook --range 5-20
+               %claude_analyze_notebook --file analysis.ipynb --concurrency 8 --tpm 80000
+               %claude_analyze_notebook --batch-tokens 2000 --refresh
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from IPython.display import display, HTML
+        args = self._parse_args(line)
+        concurrency = int(args.get('concurrency', 4))
+        tokens_per_minute = int(args.get('tpm', os.environ.get('LABFLOW_CLAUDE_TPM', 40000)))
+        batch_tokens = int(args.get('batch-tokens', 1500))
+        
+        try:
+            cells = self._notebook_cells(args)
+        except Exception as e:
+            print(f"❌ セルの取得に失敗: {str(e)}")
+            return []
+        if not cells:
+            print("❌ 分析対象のセルがありません")
+            return []
+        
+        batches = self._batch_cells(cells, batch_tokens)
+        bucket = TokenBucket(tokens_per_minute)
+        options = self._cache_options(line)
+        report: Dict[int, Dict] = {}
+        
+        print(f"🔍 {len(cells)} セルを {len(batches)} バッチで分析 "
+              f"(並列 {concurrency}, {tokens_per_minute} tokens/min)")
+        handle = display(HTML(f"<small>⏳ 0/{len(batches)} バッチ完了</small>"), display_id=True)
+        start = time.time()
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(self._analyze_batch, batch, bucket, options) for batch in batches]
+            for finished, future in enumerate(as_completed(futures), 1):
+                for row in future.result():
+                    report[row['cell']] = row
+                if handle is not None:
+                    handle.update(HTML(f"<small>⏳ {finished}/{len(batches)} バッチ完了 "
+                                       f"({time.time() - start:.1f}s)</small>"))
+        
+        rows = [report[cell_id] for cell_id, _ in cells]
+        errors = sum(1 for row in rows if row['error'])
+        display(HTML(self._render_notebook_report(rows)))
+        print(f"✅ 分析完了: {len(rows)} セル / {time.time() - start:.1f}s "
+              f"(レート制限待ち 延べ {bucket.waited:.1f}s, エラー {errors} セル)")
+        return rows
+    
+    def _notebook_cells(self, args: Dict[str, Any]) -> List[Tuple[int, str]]:
+        """(セル番号, ソース) のリスト。--file があれば .ipynb、なければ履歴から取得"""
+        if isinstance(args.get('file'), str):
+            with open(args['file'], encoding='utf-8') as f:
+                notebook = json.load(f)
+            cells = [
+                (index, ''.join(cell['source']) if isinstance(cell['source'], list) else cell['source'])
+                for index, cell in enumerate(notebook.get('cells', []), 1)
+                if cell.get('cell_type') == 'code'
+            ]
+        else:
+            if not hasattr(self.shell, 'history_manager'):
+                raise RuntimeError("履歴機能が利用できません")
+            cells = [(number, source) for _, number, source in self.shell.history_manager.get_range()]
+        
+        if isinstance(args.get('range'), str):
+            low, _, high = args['range'].partition('-')
+            low, high = int(low or 1), int(high) if high else float('inf')
+            cells = [(number, source) for number, source in cells if low <= number <= high]
+        # 空のセルと Claude マジック自身は除外
+        return [
+            (number, source) for number, source in cells
+            if source.strip() and not source.lstrip().startswith(('%claude', '%%claude'))
+        ]
+    
+    @staticmethod
+    def _batch_cells(cells: List[Tuple[int, str]], batch_tokens: int, max_cells: int = 8) -> List[List[Tuple[int, str]]]:
+        """連続する小さいセルを batch_tokens 以内のバッチにまとめる (大きいセルは単独)"""
+        batches, current, current_tokens = [], [], 0
+        for cell in cells:
+            tokens = estimate_tokens(cell[1])
+            if current and (current_tokens + tokens > batch_tokens or len(current) >= max_cells):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(cell)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+    
+    def _analyze_batch(self, batch: List[Tuple[int, str]], bucket: TokenBucket,
+                       options: Dict[str, bool], retries: int = 4) -> List[Dict]:
+        """1バッチを分析してセルごとの結果に分ける (失敗時は指数バックオフで再試行)"""
+        sections = '\n\n'.join(f"### Cell {number}\n```python\n{source}\n```" for number, source in batch)
+        prompt = f"""
+以下のPythonコードのセルをそれぞれ分析し、改善点を提案してください。
+回答はセルごとに「### Cell <番号>」の見出しで区切ってください。
+
+{sections}
+
+特に以下の観点で分析してください:
+1. コードの効率性
+2. ベストプラクティスの適用
+3. 潜在的なエラー
+4. 最適化の提案
+"""
+        cache = self.response_cache
+        # ヒット/ミスは _call_claude_api の get で数えるので、ここでは数えずに確認するだけ
+        backend = self._claude_backend()
+        cached = options['use_cache'] and not options['refresh'] and backend is not None and \
+            cache.key(prompt, self.claude_model, {}, backend) in cache
+        
+        start = time.time()
+        response, error, attempts = '', None, 0
+        for attempts in range(1, retries + 1):
+            if not cached:
+                # 入力と出力 (セルあたり約300トークン) の見込み分を予約
+                bucket.acquire(estimate_tokens(prompt) + 300 * len(batch))
+            try:
+                response = self._call_claude_api(prompt, quiet=True, **options)
+                error = None
+                break
+            except Exception as e:
+                error = str(e)
+                if attempts < retries:
+                    time.sleep(min(2 ** attempts, 30) * (0.5 + random.random()))
+        
+        per_cell = self._split_cell_sections(response, [number for number, _ in batch])
+        return [
+            {
+                'cell': number,
+                'source': source,
+                'analysis': per_cell.get(number, ''),
+                'error': error,
+                'attempts': attempts,
+                'cached': cached,
+                'elapsed': time.time() - start,
+                'batch_size': len(batch)
+            }
+            for number, source in batch
+        ]
+    
+    @staticmethod
+    def _split_cell_sections(response: str, numbers: List[int]) -> Dict[int, str]:
+        """「### Cell N」見出しで応答を分割 (見出しがなければ全セルに全文を割り当て)"""
+        parts = re.split(r'^#{1,4}\s*Cell\s+(\d+)\s*$', response, flags=re.MULTILINE)
+        sections = {int(parts[i]): parts[i + 1].strip() for i in range(1, len(parts) - 1, 2)}
+        if not sections:
+            return {number: response.strip() for number in numbers}
+        return sections
+    
+    def _render_notebook_report(self, rows: List[Dict]) -> str:
+        """セルごとの分析結果の HTML テーブル"""
+        body = ""
+        for row in rows:
+            first_line = row['source'].strip().splitlines()[0][:60]
+            result = f"❌ {row['error']}" if row['error'] else row['analysis'] or '(応答にこのセルの見出しがありません)'
+            note = '⚡' if row['cached'] else f"{row['elapsed']:.1f}s"
+            body += (
+                f"<tr><td>{row['cell']}</td><td><code>{html.escape(first_line)}</code></td>"
+                f"<td style='white-space: pre-wrap; text-align: left'>{html.escape(result)}</td><td>{note}</td></tr>"
+            )
+        return (
+            "<b>🔍 Notebook Analysis</b>"
+            "<table><tr><th>Cell</th><th>Code</th><th>Analysis</th><th>Time</th></tr>"
+            f"{body}</table>"
+        )
+    
+    @line_magic('claude_session')
+    def claude_session_magic(self, line: str) -> None:
+        """
+        %claude の会話履歴の確認と管理
+        使用例: %claude_session              (履歴・要約・トークン数を表示)
+               %claude_session trim 4       (直近4メッセージ以外を要約に移す)
+               %claude_session reset
+               %claude_session --budget 4000
+        """
+        session = self.claude_session
+        parts = line.split()
+        args = self._parse_args(line)
+        
+        if 'budget' in args:
+            session.budget_tokens = int(args['budget'])
+            session.trim(len(session.turns))
+            print(f"✅ トークン予算: {session.budget_tokens}")
+        
+        if parts and parts[0] == 'reset':
+            session.reset()
+            print("🗑️  会話履歴をリセットしました")
+        elif parts and parts[0] == 'trim':
+            session.trim(int(parts[1]) if len(parts) > 1 else 2)
+            print(f"✂️  直近 {len(session.turns)} メッセージを残して要約しました")
+        elif parts and not parts[0].startswith('--'):
+            print("❌ Usage: %claude_session [trim N | reset] [--budget TOKENS]")
+            return
+        
+        print(f"💬 会話履歴: {len(session)} メッセージ "
+              f"(保持 {len(session.turns)} / 要約済み {session.compacted})")
+        print(f"   トークン: {session.tokens()} / {session.budget_tokens}")
+        if session.summary:
+            print("📝 要約:")
+            for summary_line in session.summary_text().splitlines()[-10:]:
+                print(f"   {summary_line}")
+        for turn in session.turns:
+            speaker = '👤' if turn.role == 'user' else '🤖'
+            stored = ' 💾' if turn.path else ''
+            print(f"{speaker} [{turn.tokens} tokens{stored}] {turn.preview}")
+    
+    @line_magic
+    def claude_cache(self, line: str) -> None:
+        """
+        Claude 応答キャッシュの統計と管理
+        使用例: %claude_cache
+               %claude_cache clear
+               %claude_cache prune
+        """
+        cache = self.response_cache
+        command = line.strip() or 'stats'
+        
+        if command == 'clear':
+            cache.clear()
+            print("🗑️  Claude 応答キャッシュを削除しました")
+        elif command == 'prune':
+            print(f"🗑️  {cache.prune()} 件削除")
+        elif command == 'stats':
+            stats = cache.stats
+            lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+            hit_rate = (stats['memory_hits'] + stats['disk_hits']) / lookups * 100 if lookups else 0.0
+            print(f"🧠 Claude 応答キャッシュ: {cache.root}")
+            print(f"   ヒット: メモリ {stats['memory_hits']} / ディスク {stats['disk_hits']}  "
+                  f"ミス: {stats['misses']}  バイパス: {stats['bypassed']}  (ヒット率 {hit_rate:.1f}%)")
+            print(f"   メモリ: {len(cache.memory)}/{cache.max_entries} 件  "
+                  f"ディスク: {cache.disk_bytes() / 1024 ** 2:.1f} MB / {cache.max_bytes / 1024 ** 2:.1f} MB")
+        else:
+            print("❌ Usage: %claude_cache [stats | clear | prune]")
+    
+    # =========================================================================
+    # INSTRUMENTATION MAGIC COMMANDS
+    # =========================================================================
+    
+    @line_magic
+    def aidev_stats(self, line: str) -> None:
+        """
+        外部呼び出しとマジック実行のレイテンシ統計
+        使用例: %aidev_stats
+               %aidev_stats --node colab_1712345678 --endpoint /job/<id>/status
+               %aidev_stats --export stats.json   (.csv も可)
+               %aidev_stats --server
+               %aidev_stats --reset
+        """
+        args = self._parse_args(line)
+        
+        if args.get('reset'):
+            self.stats.reset()
+            print("🗑️  計測値をリセットしました")
+            return
+        
+        if args.get('server'):
+            self._print_server_metrics()
+            return
+        
+        data = self.stats.to_dict()
+        if isinstance(args.get('node'), str):
+            data['calls'] = [row for row in data['calls'] if row['node'] == args['node']]
+        if isinstance(args.get('endpoint'), str):
+            data['calls'] = [row for row in data['calls'] if row['endpoint'].startswith(args['endpoint'])]
+        
+        if isinstance(args.get('export'), str):
+            self._export_stats(data, args['export'])
+            return
+        
+        elapsed = data['exported_at'] - data['started_at']
+        print(f"📊 計測値 (直近 {elapsed / 60:.1f} 分, レイテンシは ms)")
+        if data['calls']:
+            print(f"   {'node':<22} {'endpoint':<28} {'n':>6} {'err':>4} {'p50':>8} {'p90':>8} "
+                  f"{'p99':>8} {'max':>8} {'conn':>7} {'ttfb':>8} {'KB':>9}")
+            for row in data['calls']:
+                total = row['total']
+                kilobytes = (row['bytes_sent'] + row['bytes_received']) / 1024
+                errors = sum(count for outcome, count in row['outcomes'].items() if outcome != 'ok')
+                print(f"   {row['node'][:22]:<22} {row['endpoint'][:28]:<28} {total['count']:>6} {errors:>4} "
+                      f"{total['p50_ms']:>8.1f} {total['p90_ms']:>8.1f} {total['p99_ms']:>8.1f} "
+                      f"{total['max_ms']:>8.1f} {self._format_ms(row['connect'], 7)} {self._format_ms(row['ttfb'], 8)} "
+                      f"{kilobytes:>9.1f}")
+        else:
+            print("   外部呼び出しの記録はありません")
+        
+        if data['magics'] and not (args.get('node') or args.get('endpoint')):
+            print(f"\n   {'magic':<51} {'n':>6} {'err':>4} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+            for row in data['magics']:
+                total = row['total']
+                errors = sum(count for outcome, count in row['outcomes'].items() if outcome != 'ok')
+                print(f"   {row['magic']:<51} {total['count']:>6} {errors:>4} {total['p50_ms']:>8.1f} "
+                      f"{total['p90_ms']:>8.1f} {total['p99_ms']:>8.1f} {total['max_ms']:>8.1f}")
+    
+    @staticmethod
+    def _format_ms(summary: Dict[str, float], width: int) -> str:
+        """p50 を右寄せで整形 (記録なし = 再利用接続などは '-')"""
+        return f"{summary['p50_ms']:>{width}.1f}" if summary['count'] else f"{'-':>{width}}"
+    
+    def _export_stats(self, data: Dict[str, Any], path: str) -> None:
+        """計測値を JSON (拡張子 .csv なら1行1キーの CSV) で書き出す"""
+        if path.endswith('.csv'):
+            import csv
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['kind', 'node', 'endpoint', 'count', 'errors', 'mean_ms', 'p50_ms', 'p90_ms',
+                                 'p99_ms', 'max_ms', 'connect_p50_ms', 'ttfb_p50_ms', 'bytes_sent', 'bytes_received'])
+                rows = [('call', row['node'], row['endpoint'], row) for row in data['calls']]
+                rows += [('magic', '', row['magic'], row) for row in data['magics']]
+                for kind, node, endpoint, row in rows:
+                    total = row['total']
+                    errors = sum(count for outcome, count in row['outcomes'].items() if outcome != 'ok')
+                    writer.writerow([
+                        kind, node, endpoint, total['count'], errors, round(total['mean_ms'], 3),
+                        round(total['p50_ms'], 3), round(total['p90_ms'], 3), round(total['p99_ms'], 3),
+                        round(total['max_ms'], 3), round(row['connect']['p50_ms'], 3),
+                        round(row['ttfb']['p50_ms'], 3), row['bytes_sent'], row['bytes_received']
+                    ])
+        else:
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2)
+        print(f"💾 {len(data['calls'])} 件の呼び出し統計と {len(data['magics'])} 件のマジック統計を書き出しました: {path}")
+    
+    def _print_server_metrics(self) -> None:
+        """各ノードの /metrics (サーバー側ハンドラーの処理時間) を表示"""
+        if not self.colab_nodes:
+            print("❌ Colabノードが接続されていません")
+            return
+        
+        for res in self.node_client.fan_out(list(self.colab_nodes.items()), 'GET', '/metrics', timeout=10):
+            if not res.ok:
+                print(f"❌ {res.node_id}: {res.error}")
+                continue
+            metrics = res.data
+            sampler = metrics['sampler']
+            age = f"{sampler['last_sample_age']:.1f}s 前" if sampler['last_sample_age'] is not None else "なし"
+            print(f"🖥️  {res.node_id}  (稼働 {metrics['uptime'] / 60:.1f} 分, "
+                  f"リソースサンプル {sampler['samples']} 件 / 最新 {age}, "
+                  f"実行待ち {metrics['jobs']['queued']} / 実行中プロセス {metrics['jobs']['processes']})")
+            print(f"   {'handler':<40} {'n':>6} {'err':>4} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+            for handler, row in sorted(metrics['handlers'].items()):
+                print(f"   {handler[:40]:<40} {row['count']:>6} {row['errors']:>4} {row['p50_ms']:>8.1f} "
+                      f"{row['p90_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}")
     
     # =========================================================================
     # UTILITY METHODS
     # =========================================================================
     
+    def _timed_magic(self, name: str, func):
+        """マジックの実行時間と結果 (ok / 例外名) を self.stats に記録するラッパー"""
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'ok'
+            try:
+                return func(*args, **kwargs)
+            except BaseException as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                self.stats.record_magic(name, time.perf_counter() - start, outcome)
+        return timed
+    
+    @staticmethod
+    def _split_line(line: str) -> List[str]:
+        """
+        引数を空白で分割 (引用符で囲んだ値は1つにまとめる: --message "epoch 10")
+        バックスラッシュはエスケープとして扱わない (Windows のパス用)。引用符が閉じていなければ空白で分割
+        """
+        import shlex
+        lexer = shlex.shlex(line, posix=True)
+        lexer.whitespace_split = True
+        lexer.escape = ''
+        try:
+            return list(lexer)
+        except ValueError:
+            return line.split()
+    
     def _parse_args(self, line: str) -> Dict[str, str]:
-        """コマンドライン引数をパース"""
+        """コマンドライン引数をパース (値のないフラグは True)"""
         args = {}
-        parts = line.split()
+        parts = self._split_line(line)
         
         i = 0
         while i < len(parts):
@@ -441,12 +4203,145 @@ class AIDevMagics(Magics):
         
         return args
     
-    def _call_claude_api(self, message: str) -> str:
-        """Claude API 呼び出し"""
+    CLAUDE_FLAGS = ('--no-cache', '--refresh', '--background', '--no-stream')
+    
+    def _cache_options(self, line: str) -> Dict[str, bool]:
+        """--no-cache / --refresh を _call_claude_api の引数に変換"""
+        words = line.split()
+        return {'use_cache': '--no-cache' not in words, 'refresh': '--refresh' in words}
+    
+    def _call_claude_api(self, message: str, use_cache: bool = True, refresh: bool = False,
+                         model: Optional[str] = None, quiet: bool = False, **params) -> str:
+        """
+        Claude API 呼び出し (応答はプロンプト・モデル・パラメータ・エンドポイントをキーにキャッシュ)
+        API 未設定時の模擬応答はキャッシュしない (API キーを設定した後に模擬応答が返らないように)
+        """
+        model = model or self.claude_model
+        backend = self._claude_backend()
+        if not use_cache or backend is None:
+            self.response_cache.stats['bypassed'] += 1
+            return self._request_claude(message, model, **params)
+        
+        key = self.response_cache.key(message, model, params, backend)
+        if not refresh:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                if not quiet:
+                    print("⚡ キャッシュ済みの応答 (--refresh で再取得)")
+                return cached
+        
+        response = self._request_claude(message, model, **params)
+        self.response_cache.put(key, response)
+        return response
+    
+    def _stream_claude_api(self, message: str, title: str, on_complete=None, background: bool = False,
+                           use_cache: bool = True, refresh: bool = False, **params) -> ClaudeStream:
+        """
+        応答をストリーミング表示する (キャッシュヒット時は即座に全文を表示)
+        background=True なら別スレッドで受信し、すぐにハンドルを返す
+        """
+        model = self.claude_model
+        cache = self.response_cache
+        backend = self._claude_backend()
+        use_cache = use_cache and backend is not None  # 模擬応答はキャッシュしない
+        key = cache.key(message, model, params, backend or '')
+        cached = cache.get(key) if use_cache and not refresh else None
+        if not use_cache:
+            cache.stats['bypassed'] += 1
+        
+        def finish(response: str) -> None:
+            if use_cache and cached is None:
+                cache.put(key, response)
+            if on_complete:
+                on_complete(response)
+        
+        chunks = iter([cached]) if cached is not None else self._stream_claude(message, model, **params)
+        stream = ClaudeStream(chunks, title + (" ⚡ (キャッシュ)" if cached is not None else ''), finish)
+        if background:
+            return stream.start()
+        stream.run()
+        return stream
+    
+    @staticmethod
+    def _claude_backend() -> Optional[str]:
+        """応答を返すエンドポイント (API キーも ANTHROPIC_BASE_URL も未設定なら None = 模擬応答)"""
+        base_url = os.environ.get('ANTHROPIC_BASE_URL')
+        if not os.environ.get('ANTHROPIC_API_KEY') and not base_url:
+            return None
+        return (base_url or 'https://api.anthropic.com').rstrip('/')
+    
+    def _request_claude(self, message: str, model: str, **params) -> str:
+        """Claude API への実際のリクエスト"""
+        try:
+            return ''.join(self._stream_claude(message, model, **params))
+        except Exception as e:
+            raise Exception(f"Claude API call failed: {str(e)}")
+    
+    def _stream_claude(self, message: str, model: str, history: Optional[List[Dict]] = None,
+                       system: Optional[str] = None, **params) -> Iterator[str]:
+        """
+        Messages API (stream: true) の SSE からテキスト差分を順に返す
+        ANTHROPIC_BASE_URL でモックサーバーなど任意のエンドポイントに向けられる。
+        API キーもエンドポイントも未設定なら模擬応答を返す
+        """
+        import requests
+        api_key = os.environ.get('ANTHROPIC_API_KEY')
+        backend = self._claude_backend()
+        if backend is None:
+            yield from self._mock_claude_response()
+            return
+        
+        payload = {
+            'model': model,
+            'max_tokens': params.pop('max_tokens', 4096),
+            'messages': (history or []) + [{'role': 'user', 'content': message}],
+            'stream': True,
+            **params
+        }
+        if system:
+            payload['system'] = system
+        headers = {'anthropic-version': '2023-06-01', 'content-type': 'application/json'}
+        if api_key:
+            headers['x-api-key'] = api_key
+        
+        from urllib.parse import urlparse
+        url = f"{backend}/v1/messages"
+        body = json.dumps(payload).encode()
+        start = time.perf_counter()
+        ttfb, received, outcome = None, 0, 'ok'
+        try:
+            with requests.post(url, data=body, headers=headers, stream=True, timeout=(10, 300)) as response:
+                ttfb = time.perf_counter() - start
+                if response.status_code != 200:
+                    outcome = f"http_{response.status_code}"
+                    raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+                for line in response.iter_lines(decode_unicode=True):
+                    received += len(line) + 1
+                    if not line or not line.startswith('data:'):
+                        continue
+                    event = json.loads(line[5:])
+                    if event.get('type') == 'content_block_delta' and event['delta'].get('type') == 'text_delta':
+                        yield event['delta']['text']
+                    elif event.get('type') == 'error':
+                        raise RuntimeError(event['error'].get('message', 'stream error'))
+                    elif event.get('type') == 'message_stop':
+                        return
+        except GeneratorExit:
+            outcome = 'cancelled'  # ClaudeStream.cancel() などで読み出しを打ち切った
+            raise
+        except BaseException as e:
+            if outcome == 'ok':
+                outcome = type(e).__name__
+            raise
+        finally:
+            self.stats.record_call(
+                urlparse(url).netloc, '/v1/messages', time.perf_counter() - start,
+                ttfb=ttfb, sent=len(body), received=received, outcome=outcome
+            )
+    
+    def _mock_claude_response(self) -> Iterator[str]:
+        """API 未設定時の模擬応答"""
         try:
-            # JupyterLab Extension経由でClaude APIを呼び出し
-            # 実際の実装では適切なAPI呼び出しを行う
-            
             # 模擬応答（実際の実装ではClaude APIを使用）
             responses = [
                 "コードを分析しました。以下の改善点があります：\n1. 変数名をより明確に\n2. エラーハンドリングの追加\n3. コメントの追加",
@@ -454,8 +4349,9 @@ class AIDevMagics(Magics):
                 "良いコードです！以下の点でさらに改善できます：\n1. 型ヒントの追加\n2. docstringの追加"
             ]
             
-            import random
-            return random.choice(responses)
+            response = random.choice(responses)
+            for start in range(0, len(response), 16):
+                yield response[start:start + 16]
             
         except Exception as e:
             raise Exception(f"Claude API call failed: {str(e)}")
@@ -473,12 +4369,15 @@ class AIDevMagics(Magics):
 # Magic Commands を IPython に登録
 def load_ipython_extension(ipython):
     """IPython Extension として登録"""
-    ipython.register_magic_function(AIDevMagics)
+    ipython.register_magics(AIDevMagics)
     print("🚀 AI-Dev Magic Commands loaded!")
     print("Available commands:")
     print("  %colab_connect, %colab_status, %%colab_train")
-    print("  %hf_login, %hf_push, %hf_download")
-    print("  %claude, %%claude_analyze, %claude_optimize")
+    print("  %colab_job_status, %colab_job_metrics, %colab_job_cancel, %colab_pull")
+    print("  %hf_login, %hf_push, %hf_download, %hf_models, %hf_cache")
+    print("  %claude, %%claude_analyze, %claude_analyze_notebook, %claude_optimize")
+    print("  %claude_session, %claude_cache")
+    print("  %aidev_stats")
 
 
 # =============================================================================
@@ -494,12 +4393,23 @@ def load_ipython_extension(ipython):
 !pip install flask flask-cors pyngrok psutil py3nvml
 
 import os
+import re
+import sys
 import json
 import time
+import shutil
+import base64
+import hashlib
+import marshal
+import math
+import bisect
+import sqlite3
 import threading
 import psutil
 import subprocess
-from flask import Flask, request, jsonify
+from array import array
+from collections import deque, OrderedDict
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 from pyngrok import ngrok
 import torch
@@ -509,13 +4419,414 @@ app = Flask(__name__)
 CORS(app)
 
 # グローバル変数
-current_jobs = {}
 system_info = {}
 
+# ジョブストア設定 (current_jobs は下の JobStore)
+JOB_STORE_PATH = '/tmp/labflow/jobs.sqlite'  # Google Drive 上にすると VM 再割り当て後も履歴が残る
+JOB_STORE_MAX_IN_MEMORY = 100                # メモリに保持するジョブ数 (超過分は終了済みから退避)
+JOB_STORE_METRIC_POINTS = 512                # 退避時に保存するメトリクスの点数
+JOB_SUMMARY_FIELDS = (
+    'status', 'current_epoch', 'total_epochs', 'current_loss', 'latest_metrics',
+    'start_time', 'end_time', 'updated_at', 'error', 'startup'
+)
+
+# リソースサンプラー設定
+RESOURCE_SAMPLE_INTERVAL = 2.0  # サンプリング間隔 (秒)
+RESOURCE_HISTORY_SIZE = 300     # リングバッファ長 (2秒間隔で約10分)
+resource_history = deque(maxlen=RESOURCE_HISTORY_SIZE)
+resource_lock = threading.Lock()
+
+# ジョブ進捗イベント (ロングポーリング配信用)
+JOB_EVENT_LIMIT = 1000        # ジョブごとに保持するイベント数
+JOB_EVENT_MAX_WAIT = 60.0     # ロングポーリングの最大待機秒数
+JOB_FINAL_EVENTS = ('completed', 'error', 'cancelled')
+job_events = {}               # job_id -> deque of {'seq', 'type', 'timestamp', ...}
+job_events_cond = threading.Condition()
+
+# ジョブのメトリクス時系列
+METRIC_SERIES_CAPACITY = 2048   # 1系列あたりの最大点数 (超えたら古い点を間引く)
+METRICS_PER_JOB = 32            # 1ジョブあたりの最大メトリクス数
+job_metrics = {}                # job_id -> {metric_name: MetricSeries}
+metrics_lock = threading.Lock()
+
+# ハンドラーごとの処理時間 (/metrics)
+server_started_at = time.time()
+handler_stats = {}              # "GET /job/<job_id>/status" -> HandlerStats
+handler_stats_lock = threading.Lock()
+
+# ジョブ実行エンジン設定
+EXECUTION_MODE = 'process'    # 'process': ワーカープロセスで実行 / 'thread': サーバープロセス内のスレッドで実行
+MAX_CONCURRENT_JOBS = 2       # 同時実行ジョブ数の上限 (超過分は待機キューへ)
+job_queue = deque()           # 実行待ちの job_id
+job_processes = {}            # job_id -> subprocess.Popen (起動中は None で枠だけ確保)
+job_slots_lock = threading.Lock()
+
+# ウォームワーカー設定
+WARM_WORKERS = 1              # import 済みで待機させておくワーカー数 (0 で無効)
+PRELOAD_MODULES = ['torch']   # ワーカー起動時に import しておくモジュール
+warm_workers = deque()        # (subprocess.Popen, import_time) の待機列
+warming_count = 0             # 起動中のウォームワーカー数
+warm_lock = threading.Lock()
+
+# コンパイル済みコードのキャッシュ (ソースの sha256 -> marshal 済みコード)
+CODE_CACHE_SIZE = 128
+code_cache = OrderedDict()
+code_cache_lock = threading.Lock()
+
+# content-addressed blob ストア (コードと --include ファイル)
+BLOB_CACHE_DIR = '/tmp/labflow/blobs'
+BLOB_CACHE_MAX_BYTES = 2 * 1024 ** 3   # 超えたら最終アクセスの古い順に削除
+JOB_WORKDIR_ROOT = '/tmp/labflow/jobs'  # ジョブごとの作業ディレクトリ
+BLOB_DIGEST_PATTERN = re.compile('^[0-9a-f]{64}$')
+BLOB_UPLOAD_PIN_SECONDS = 3600          # /blobs/missing で保持したチャンクを /train が来なくても解放するまでの時間
+blob_lock = threading.Lock()
+blob_cache_bytes = None                 # blob ストアの合計サイズ (書き込みごとに加算、整理のたびに数え直す)
+blob_prune_at = BLOB_CACHE_MAX_BYTES    # 合計がこれを超えたら整理する
+
+# --data のシャード (チャンクは blob ストアに置き、実行中ジョブのチャンクは削除対象から外す)
+DATA_ROOT = '/tmp/labflow/data'   # ディレクトリ形式のシャードを復元する場所
+pinned_blobs = {}                 # job_id -> データチャンクの digest
+upload_pins = {}                  # job_id -> (期限, 送信中のデータチャンクの digest)
+
+# ジョブ成果物のチェックサム (ファイルパスと etag ごとにキャッシュ)
+ARTIFACT_CHECKSUM_CACHE_SIZE = 1024
+artifact_checksums = OrderedDict()  # (path, etag) -> sha256
+artifact_lock = threading.Lock()
+
+# タスクキューモード (--tasks) のジョブに渡した範囲の結果待ち
+RANGE_WAIT_TIMEOUT = 600           # 1範囲の結果を待つ上限 (秒、クライアントが timeout を送ればそちらを使う)
+pending_ranges = {}                # (job_id, range_id) -> {'event': Event, 'message': dict}
+range_lock = threading.Lock()
+
+# 学習コードに shard として渡す --data のイテレータ (ワーカープロセスとスレッド実行で共用)
+DATA_SHARD_SOURCE = '''
+import os
+import json
+import shutil
+
+class DataShard:
+    \"\"\"
+    このノードに割り当てられた --data のシャード (blob ストアのチャンクを順に読む)
+    for record in shard: JSONL は1行ごとの値、NPY は1行ごとの配列、ディレクトリはファイルパス
+    shard.chunks() はチャンク単位 (JSONL: list / NPY: mmap した ndarray / ディレクトリ: ファイルパス)
+    \"\"\"
+    
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.format = manifest['format']
+        self.name = manifest['name']
+        self.records = manifest['records']
+        self.bytes = manifest['bytes']
+        self.node_index = manifest['node_index']
+        self.total_nodes = manifest['total_nodes']
+    
+    def __len__(self):
+        return self.records
+    
+    def __repr__(self):
+        return (f"DataShard({self.name!r}, format={self.format!r}, "
+                f"node={self.node_index}/{self.total_nodes}, records={self.records})")
+    
+    def __iter__(self):
+        for chunk in self.chunks():
+            if self.format == 'files':
+                yield chunk
+            else:
+                yield from chunk
+    
+    def _blob(self, digest):
+        return os.path.join(self.manifest['blob_dir'], digest)
+    
+    def chunks(self):
+        if self.format == 'files':
+            for entry in self.manifest['files']:
+                yield self._materialize(entry)
+        elif self.format == 'jsonl':
+            for digest in self.manifest['chunks']:
+                with open(self._blob(digest), 'rb') as f:
+                    yield [json.loads(line) for line in f if line.strip()]
+        else:
+            import numpy
+            for digest in self.manifest['chunks']:
+                yield numpy.load(self._blob(digest), mmap_mode='r')
+    
+    def _materialize(self, entry):
+        \"\"\"チャンクを連結してファイルを復元 (初回アクセス時のみ)\"\"\"
+        target = os.path.join(self.manifest['data_dir'], entry['path'])
+        if not os.path.exists(target) or os.path.getsize(target) != entry['size']:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target + '.tmp', 'wb') as out:
+                for digest in entry['chunks']:
+                    with open(self._blob(digest), 'rb') as f:
+                        shutil.copyfileobj(f, out)
+            os.replace(target + '.tmp', target)
+        return target
+'''
+exec(DATA_SHARD_SOURCE)  # スレッド実行用に、このプロセスにも DataShard を定義
+
+# ワーカープロセスで実行するコード
+# 起動時に PRELOAD_MODULES を import して ready を通知し、stdin でタスクを受け取る
+# 進捗は stdout に JSON 行で返す (ユーザーコードの print は stderr へ)
+JOB_WORKER_SOURCE = DATA_SHARD_SOURCE + '''
+import os
+import sys
+import json
+import time
+import base64
+import marshal
+import importlib
+
+protocol = sys.stdout
+sys.stdout = sys.stderr
+
+def send(message):
+    print(json.dumps(message), file=protocol, flush=True)
+
+# モジュールの事前 import (ウォームワーカーではジョブ到着前に完了している)
+import_start = time.perf_counter()
+preloaded = {}
+for name in json.loads(sys.argv[1]):
+    try:
+        preloaded[name.split('.')[0]] = importlib.import_module(name.split('.')[0])
+        importlib.import_module(name)
+    except ImportError:
+        pass
+send({'type': 'ready', 'import_time': time.perf_counter() - import_start})
+
+line = sys.stdin.readline()
+if not line:
+    sys.exit(0)  # ジョブを受け取らずに破棄された
+
+def update_progress(epoch, loss=None, step=None, **metrics):
+    send({'type': 'progress', 'epoch': epoch, 'loss': loss, 'step': step, 'metrics': metrics})
+
+task = json.loads(line)
+config = task['config']
+if config.get('workdir'):
+    # --include のファイルを相対パスで参照・import でき、相対パスで保存した成果物も作業ディレクトリに残る
+    os.chdir(config['workdir'])
+    sys.path.insert(0, config['workdir'])
+
+exec_globals = {
+    '__builtins__': __builtins__,
+    'job_id': task['job_id'],
+    'config': config,
+    'workdir': config.get('workdir'),
+    'shard': DataShard(config['data']) if config.get('data') else None,
+    'update_progress': update_progress
+}
+exec_globals.update(preloaded)
+if 'torch' not in exec_globals:
+    try:
+        import torch
+        exec_globals['torch'] = torch
+    except ImportError:
+        pass
+
+def serve_ranges(work):
+    # タスクキューモード: stdin が閉じられるまで範囲を受け取り、1範囲ずつ結果を返す
+    for line in sys.stdin:
+        item = json.loads(line)
+        range_start = time.perf_counter()
+        try:
+            value = work(item['start'], item['end'])
+            if value is not None:
+                value = list(value)
+                if len(value) != item['end'] - item['start']:
+                    raise ValueError(f"work() は範囲の要素数 ({item['end'] - item['start']}) の結果を返してください (実際: {len(value)})")
+            send({'type': 'result', 'range_id': item['range_id'], 'value': value,
+                  'seconds': time.perf_counter() - range_start})
+        except Exception as e:
+            send({'type': 'range_error', 'range_id': item['range_id'], 'error': f"{type(e).__name__}: {e}"})
+
+try:
+    code = marshal.loads(base64.b64decode(task['code_blob']))
+    send({'type': 'started'})
+    exec(code, exec_globals)
+    if config.get('tasks'):
+        if not callable(exec_globals.get('work')):
+            raise NameError('タスクキューモードではセルで work(start, end) を定義してください')
+        serve_ranges(exec_globals['work'])
+    send({'type': 'completed'})
+except BaseException as e:
+    send({'type': 'error', 'error': str(e)})
+'''
+
+class JobStore:
+    \"\"\"
+    ジョブ情報のストア (dict と同じ書き方で使える)
+    メモリ上は最大 max_in_memory 件で、超えたら終了済みジョブから SQLite に退避する
+    作成時と終了時に SQLite へ書き込むため、サーバー再起動後も履歴を参照できる
+    \"\"\"
+    
+    def __init__(self, path: str, max_in_memory: int):
+        self.max_in_memory = max_in_memory
+        self._jobs = OrderedDict()
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'job_id TEXT PRIMARY KEY, status TEXT, updated REAL, data TEXT, metrics TEXT)'
+        )
+        self._db.commit()
+        self._load()
+    
+    def _load(self):
+        \"\"\"起動時に直近のジョブを読み込む (前回実行中だったジョブは中断扱い)\"\"\"
+        rows = self._db.execute(
+            'SELECT job_id, data FROM jobs ORDER BY updated DESC LIMIT ?', (self.max_in_memory,)
+        ).fetchall()
+        for job_id, data in reversed(rows):
+            self._jobs[job_id] = json.loads(data)
+        
+        for job_id, job in self._jobs.items():
+            if job['status'] not in JOB_FINAL_EVENTS:
+                job.update({'status': 'error', 'error': 'サーバー再起動により中断されました', 'end_time': time.time()})
+                self.persist(job_id)
+    
+    def __contains__(self, job_id: str) -> bool:
+        with self._lock:
+            if job_id in self._jobs:
+                return True
+            return self._db.execute('SELECT 1 FROM jobs WHERE job_id = ?', (job_id,)).fetchone() is not None
+    
+    def __getitem__(self, job_id: str) -> dict:
+        \"\"\"
+        メモリになければ SQLite から読み込んでメモリに戻す
+        (返した dict への書き込みは他のジョブと同じく persist / finish で保存される)
+        \"\"\"
+        with self._lock:
+            if job_id in self._jobs:
+                return self._jobs[job_id]
+            row = self._db.execute('SELECT data FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                raise KeyError(job_id)
+            job = self._jobs[job_id] = json.loads(row[0])
+            evicted = self._evict(keep=job_id)
+        self._forget_events(evicted)
+        return job
+    
+    def __setitem__(self, job_id: str, job: dict):
+        with self._lock:
+            self._jobs[job_id] = job
+            self.persist(job_id)
+            evicted = self._evict()
+        self._forget_events(evicted)
+    
+    def __len__(self) -> int:
+        return len(self._jobs)
+    
+    def items(self):
+        \"\"\"メモリ上のジョブ (job_id, info) のスナップショット\"\"\"
+        with self._lock:
+            return list(self._jobs.items())
+    
+    def persist(self, job_id: str, metrics: dict = None):
+        \"\"\"ジョブ情報を SQLite に書き込む\"\"\"
+        with self._lock:
+            job = self._jobs[job_id]
+            self._db.execute(
+                'INSERT INTO jobs (job_id, status, updated, data, metrics) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(job_id) DO UPDATE SET status = excluded.status, updated = excluded.updated, '
+                'data = excluded.data, metrics = COALESCE(excluded.metrics, jobs.metrics)',
+                (job_id, job['status'], time.time(), json.dumps(job, default=str),
+                 json.dumps(metrics) if metrics is not None else None)
+            )
+            self._db.commit()
+    
+    def finish(self, job_id: str):
+        \"\"\"終了したジョブからコード本体を外して保存し、必要なら退避\"\"\"
+        with self._lock:
+            config = self._jobs[job_id].get('config', {})
+            if 'code' in config:
+                config['code_size'] = len(config.pop('code'))
+            self.persist(job_id)
+            evicted = self._evict()
+        self._forget_events(evicted)
+    
+    def stored_metrics(self, job_id: str) -> dict:
+        \"\"\"退避時に保存したメトリクスのスナップショット\"\"\"
+        with self._lock:
+            row = self._db.execute('SELECT metrics FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+    
+    def _evict(self, keep: str = None) -> list:
+        \"\"\"
+        上限を超えた分を終了済みの古いジョブから退避 (実行中のジョブと keep は残す)
+        退避した job_id を返す (イベント履歴は _lock を離してから _forget_events で消す)
+        \"\"\"
+        overflow = len(self._jobs) - self.max_in_memory
+        if overflow <= 0:
+            return []
+        finished = [
+            job_id for job_id, job in self._jobs.items()
+            if job['status'] in JOB_FINAL_EVENTS and job_id != keep
+        ]
+        for job_id in finished[:overflow]:
+            with metrics_lock:
+                series = job_metrics.pop(job_id, {})
+                snapshot = {name: s.query(JOB_STORE_METRIC_POINTS) for name, s in series.items()}
+            # 読み戻したジョブはメトリクスを持たないので、前回退避時のスナップショットを残す
+            self.persist(job_id, snapshot or None)
+            del self._jobs[job_id]
+        return finished[:overflow]
+    
+    @staticmethod
+    def _forget_events(job_ids: list):
+        \"\"\"退避したジョブのイベント履歴を消す (job_events_cond の中で current_jobs を触る処理と逆順にならないよう _lock の外で呼ぶ)\"\"\"
+        if not job_ids:
+            return
+        with job_events_cond:
+            for job_id in job_ids:
+                job_events.pop(job_id, None)
+
+current_jobs = JobStore(JOB_STORE_PATH, JOB_STORE_MAX_IN_MEMORY)
+
+@app.before_request
+def start_request_timer():
+    request.environ['labflow.start'] = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    \"\"\"ルートのテンプレート単位で処理時間を集計 (job_id ごとにキーは増えない)\"\"\"
+    start = request.environ.get('labflow.start')
+    if start is not None:
+        rule = request.url_rule.rule if request.url_rule else '(unmatched)'
+        key = f"{request.method} {rule}"
+        with handler_stats_lock:
+            stats = handler_stats.get(key)
+            if stats is None:
+                stats = handler_stats[key] = HandlerStats()
+            stats.add(time.perf_counter() - start, response.status_code >= 500)
+    return response
+
 @app.route('/health')
 def health_check():
     return jsonify({'status': 'healthy', 'timestamp': time.time()})
 
+@app.route('/metrics')
+def get_metrics():
+    \"\"\"ハンドラーごとの処理時間とサンプラー・ジョブキューの状態 (%aidev_stats --server)\"\"\"
+    with handler_stats_lock:
+        handlers = {key: stats.summary() for key, stats in handler_stats.items()}
+    with resource_lock:
+        samples = len(resource_history)
+        last_sample = resource_history[-1]['timestamp'] if resource_history else None
+    with job_slots_lock:
+        queued, processes = len(job_queue), len(job_processes)
+    
+    return jsonify({
+        'uptime': time.time() - server_started_at,
+        'handlers': handlers,
+        'sampler': {
+            'samples': samples,
+            'interval': RESOURCE_SAMPLE_INTERVAL,
+            'last_sample_age': time.time() - last_sample if last_sample is not None else None
+        },
+        'jobs': {'queued': queued, 'processes': processes}
+    })
+
 @app.route('/info')
 def get_info():
     \"\"\"Colab インスタンス情報\"\"\"
@@ -540,54 +4851,69 @@ def get_info():
 
 @app.route('/resources')
 def get_resources():
-    \"\"\"システムリソース情報\"\"\"
+    \"\"\"システムリソース情報 (サンプラーの最新スナップショット)\"\"\"
     try:
-        resources = {
-            'timestamp': time.time(),
-            'cpu': {
-                'count': psutil.cpu_count(),
-                'usage': psutil.cpu_percent(interval=1)
-            },
-            'memory': {
-                'total': psutil.virtual_memory().total,
-                'used': psutil.virtual_memory().used,
-                'percent': psutil.virtual_memory().percent
-            },
-            'disk': {
-                'total': psutil.disk_usage('/').total,
-                'used': psutil.disk_usage('/').used,
-                'free': psutil.disk_usage('/').free
-            },
-            'gpu': []
-        }
+        with resource_lock:
+            latest = resource_history[-1] if resource_history else None
         
-        # GPU 情報
-        if torch.cuda.is_available():
-            for i in range(torch.cuda.device_count()):
-                gpu_memory = torch.cuda.get_device_properties(i).total_memory
-                gpu_memory_used = torch.cuda.memory_allocated(i)
-                
-                resources['gpu'].append({
-                    'id': i,
-                    'name': torch.cuda.get_device_name(i),
-                    'memory_total': gpu_memory,
-                    'memory_used': gpu_memory_used,
-                    'memory_free': gpu_memory - gpu_memory_used,
-                    'utilization': torch.cuda.utilization() if hasattr(torch.cuda, 'utilization') else 0,
-                    'temperature': 0  # 実際の実装では nvidia-ml-py を使用
-                })
-        
-        return jsonify(resources)
+        if latest is None:
+            # サンプラー起動直後のみ、ブロックせずにその場で取得
+            latest = collect_resources()
+        
+        return jsonify(latest)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/resources/history')
+def get_resource_history():
+    \"\"\"指定時刻より新しいリソースサンプルのみ返す (差分取得用)\"\"\"
+    since = request.args.get('since', default=0.0, type=float)
+    
+    samples = []
+    with resource_lock:
+        for sample in reversed(resource_history):
+            if sample['timestamp'] <= since:
+                break
+            samples.append(sample)
+    samples.reverse()
+    
+    return jsonify({
+        'samples': samples,
+        'latest_timestamp': samples[-1]['timestamp'] if samples else since,
+        'interval': RESOURCE_SAMPLE_INTERVAL
+    })
+
 @app.route('/train', methods=['POST'])
 def start_training():
     \"\"\"学習タスクの開始\"\"\"
     try:
         task_config = request.get_json()
         job_id = task_config['job_id']
+        if task_config.get('tasks') and EXECUTION_MODE == 'thread':
+            return jsonify({'error': 'タスクキューモードはワーカープロセス実行 (EXECUTION_MODE = process) でのみ使えます'}), 400
+        
+        if 'code_hash' in task_config:
+            # content-addressed 送信: コードと添付ファイルを blob ストアから解決
+            files = task_config.get('files', {})
+            data_chunks = data_chunk_digests(task_config.get('data'))
+            missing = [
+                digest for digest in [task_config['code_hash'], *files.values(), *data_chunks]
+                if not has_blob(digest)
+            ]
+            if missing:
+                return jsonify({'error': 'Missing blobs', 'missing': missing}), 409
+            task_config['code'] = read_blob(task_config['code_hash']).decode('utf-8')
+            if files:
+                task_config['workdir'] = materialize_job_files(job_id, files)
+            if data_chunks:
+                task_config['data'].update(blob_dir=BLOB_CACHE_DIR, data_dir=os.path.join(DATA_ROOT, job_id))
+                with blob_lock:
+                    pinned_blobs[job_id] = data_chunks
+                    upload_pins.pop(job_id, None)
+        
+        # 成果物 (チェックポイントなど) は作業ディレクトリに書き出す (/job/<id>/artifacts で取得)
+        task_config.setdefault('workdir', materialize_job_files(job_id, {}))
         code = task_config['code']
         
         print(f"🚀 学習開始: Job {job_id}")
@@ -595,27 +4921,183 @@ def start_training():
         # ジョブ情報を保存
         current_jobs[job_id] = {
             'start_time': time.time(),
-            'status': 'running',
+            'status': 'queued',
             'config': task_config,
             'current_epoch': 0,
             'total_epochs': task_config.get('epochs', 10),
             'current_loss': None
         }
         
-        # バックグラウンドで実行
-        thread = threading.Thread(target=execute_training_code, args=(job_id, code, task_config))
-        thread.daemon = True
-        thread.start()
+        publish_job_event(job_id, 'started', total_epochs=current_jobs[job_id]['total_epochs'])
+        
+        if EXECUTION_MODE == 'thread':
+            # サーバープロセス内のスレッドで実行
+            current_jobs[job_id]['status'] = 'running'
+            thread = threading.Thread(target=execute_training_code, args=(job_id, code, task_config, time.time()))
+            thread.daemon = True
+            thread.start()
+        else:
+            # ワーカープロセスで実行 (上限を超えた分は待機)
+            with job_slots_lock:
+                job_queue.append(job_id)
+            schedule_jobs()
         
+        with job_slots_lock:
+            queued = job_id in job_queue
         return jsonify({
-            'status': 'started',
+            'status': 'queued' if queued else 'started',
             'job_id': job_id,
-            'message': '学習を開始しました'
+            'message': '実行待ちキューに追加しました' if queued else '学習を開始しました'
         })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/job/<job_id>/metrics')
+def get_job_metrics(job_id):
+    \"\"\"
+    ジョブのメトリクス時系列を指定点数以下にダウンサンプリングして返す
+    ?names=loss,acc&points=200&start=<step>&end=<step>
+    \"\"\"
+    if job_id not in current_jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    points = max(request.args.get('points', default=200, type=int), 1)
+    start = request.args.get('start', default=None, type=float)
+    end = request.args.get('end', default=None, type=float)
+    names = request.args.get('names', default='', type=str)
+    
+    with metrics_lock:
+        series = job_metrics.get(job_id)
+    if series is None:
+        # 退避済みのジョブは保存したスナップショットから返す
+        series = {
+            name: MetricSeries.from_snapshot(snapshot)
+            for name, snapshot in current_jobs.stored_metrics(job_id).items()
+        }
+    
+    with metrics_lock:
+        selected = [name for name in names.split(',') if name in series] if names else list(series)
+        result = {name: series[name].query(points, start, end) for name in selected}
+    
+    return jsonify({'job_id': job_id, 'metrics': result})
+
+@app.route('/job/<job_id>/artifacts')
+def list_job_artifacts(job_id):
+    \"\"\"
+    ジョブの作業ディレクトリにある成果物の一覧 (--include で配置した入力ファイルは除く)
+    ?checksum=1 で sha256 も返す (更新時刻とサイズが変わらない限り再計算しない)
+    \"\"\"
+    if job_id not in current_jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    job = current_jobs[job_id]
+    workdir = os.path.join(JOB_WORKDIR_ROOT, job_id)
+    inputs = {os.path.normpath(relative) for relative in job.get('config', {}).get('files', {})}
+    with_checksum = request.args.get('checksum', default=0, type=int)
+    
+    files = []
+    for root, _, names in os.walk(workdir):
+        for name in names:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, workdir)
+            if relative in inputs:
+                continue
+            try:
+                stat = os.stat(path)
+                entry = {
+                    'path': relative.replace(os.sep, '/'),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'etag': artifact_etag(stat)
+                }
+                if with_checksum:
+                    entry['sha256'] = artifact_checksum(path, entry['etag'])
+            except FileNotFoundError:
+                continue  # 一覧作成中にジョブが削除した一時ファイル
+            files.append(entry)
+    
+    files.sort(key=lambda entry: entry['path'])
+    return jsonify({'job_id': job_id, 'status': job['status'], 'files': files})
+
+@app.route('/job/<job_id>/artifacts/<path:relative>')
+def get_job_artifact(job_id, relative):
+    \"\"\"
+    成果物ファイルを返す (Range / If-Range 対応で、ファイル全体をメモリに載せずに送信)
+    チェックサム計算済みなら X-Checksum-Sha256 ヘッダーを付ける
+    \"\"\"
+    if job_id not in current_jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    workdir = os.path.join(JOB_WORKDIR_ROOT, job_id)
+    path = os.path.normpath(os.path.join(workdir, relative))
+    if not path.startswith(workdir + os.sep) or not os.path.isfile(path):
+        return jsonify({'error': 'Artifact not found'}), 404
+    
+    etag = artifact_etag(os.stat(path))
+    response = send_file(path, conditional=True, etag=etag, max_age=0)
+    response.headers['Accept-Ranges'] = 'bytes'
+    with artifact_lock:
+        checksum = artifact_checksums.get((path, etag))
+    if checksum:
+        response.headers['X-Checksum-Sha256'] = checksum
+    return response
+
+@app.route('/blobs/missing', methods=['POST'])
+def get_missing_blobs():
+    \"\"\"
+    指定ハッシュのうち、このノードにまだ無いものを返す
+    pin (job_id) を付けると、そのジョブの /train まで指定ハッシュを容量上限による削除の対象から外す
+    \"\"\"
+    body = request.get_json()
+    hashes = body.get('hashes', [])
+    if body.get('pin'):
+        with blob_lock:
+            upload_pins[body['pin']] = (time.time() + BLOB_UPLOAD_PIN_SECONDS, set(hashes))
+    return jsonify({'missing': [digest for digest in hashes if not has_blob(digest)]})
+
+@app.route('/blobs/<digest>', methods=['PUT'])
+def put_blob(digest):
+    \"\"\"blob のアップロード (内容の sha256 がキーと一致するものだけ受け付ける)\"\"\"
+    if not BLOB_DIGEST_PATTERN.match(digest):
+        return jsonify({'error': 'Invalid digest'}), 400
+    
+    data = request.get_data()
+    if hashlib.sha256(data).hexdigest() != digest:
+        return jsonify({'error': 'Digest mismatch'}), 400
+    
+    store_blob(digest, data)
+    return jsonify({'stored': digest, 'size': len(data)})
+
+@app.route('/jobs')
+def list_jobs():
+    \"\"\"
+    複数ジョブの状況を一括取得
+    ?ids=job_a,job_b (指定ジョブのみ) / ?active=1 (終了済みを除く) / ?since=<timestamp> (以降に更新された分のみ)
+    応答の timestamp を次回の since に渡すと差分だけ取得できる
+    \"\"\"
+    ids = request.args.get('ids', default='', type=str)
+    active = request.args.get('active', default=0, type=int)
+    since = request.args.get('since', default=0.0, type=float)
+    now = time.time()
+    
+    if ids:
+        jobs = [(job_id, current_jobs[job_id]) for job_id in ids.split(',') if job_id in current_jobs]
+    else:
+        jobs = current_jobs.items()
+    
+    result = {}
+    for job_id, job in jobs:
+        if active and job['status'] in JOB_FINAL_EVENTS:
+            continue
+        if job.get('updated_at', job['start_time']) <= since:
+            continue
+        result[job_id] = summarize_job(job, now)
+    
+    return jsonify({'jobs': result, 'timestamp': now})
+
 @app.route('/job/<job_id>/status')
 def get_job_status(job_id):
     \"\"\"ジョブ状況確認\"\"\"
@@ -627,51 +5109,719 @@ def get_job_status(job_id):
     
     return jsonify(job_info)
 
+@app.route('/job/<job_id>/events')
+def get_job_events(job_id):
+    \"\"\"
+    ジョブ進捗イベントのロングポーリング
+    cursor より新しいイベントが発生するか wait 秒経過するまで応答を保留する
+    \"\"\"
+    if job_id not in current_jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    cursor = request.args.get('cursor', default=0, type=int)
+    wait = min(request.args.get('wait', default=25.0, type=float), JOB_EVENT_MAX_WAIT)
+    deadline = time.time() + wait
+    # job_events_cond の中では current_jobs に触れない (退避と逆順にロックを取るとデッドロックする)
+    # 実行中のジョブが終了すれば終了イベントが届くので、待つ前の状態で判定して構わない
+    finished = current_jobs[job_id]['status'] in JOB_FINAL_EVENTS
+    
+    with job_events_cond:
+        while True:
+            history = job_events.get(job_id, ())
+            events = [event for event in history if event['seq'] > cursor]
+            remaining = deadline - time.time()
+            if events or remaining <= 0 or (not history and finished):
+                break
+            job_events_cond.wait(remaining)
+        
+        new_cursor = events[-1]['seq'] if events else cursor
+        # 終了イベントまで受け取り済みなら done
+        done = bool(history) and history[-1]['type'] in JOB_FINAL_EVENTS and new_cursor >= history[-1]['seq']
+    
+    job = current_jobs[job_id]
+    if not history and job['status'] in JOB_FINAL_EVENTS:
+        # 退避済み・再起動前のジョブはイベント履歴がないため終了イベントだけ返す
+        final = {'seq': cursor + 1, 'type': job['status'], 'timestamp': job.get('end_time'), 'error': job.get('error')}
+        events, new_cursor, done = [final], cursor + 1, True
+    
+    return jsonify({'events': events, 'cursor': new_cursor, 'done': done})
+
+@app.route('/job/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    \"\"\"ジョブのキャンセル (待機中はキューから除外、実行中はワーカーを停止)\"\"\"
+    if job_id not in current_jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    status = current_jobs[job_id]['status']
+    if status in JOB_FINAL_EVENTS:
+        return jsonify({'status': status, 'job_id': job_id, 'message': 'ジョブは既に終了しています'})
+    
+    with job_slots_lock:
+        queued = job_id in job_queue
+        if queued:
+            job_queue.remove(job_id)
+        launching = job_id in job_processes
+        proc = job_processes.get(job_id)
+    
+    if not queued and not launching:
+        return jsonify({'error': 'スレッド実行モードのジョブはキャンセルできません'}), 409
+    
+    # 先に状態を確定させ、モニタースレッドが異常終了と誤判定しないようにする
+    # (起動中でまだ proc がなければ、launch_job_process が状態を見て停止する)
+    finish_job(job_id, 'cancelled')
+    if proc is not None:
+        proc.terminate()
+        threading.Timer(5.0, lambda: proc.poll() is None and proc.kill()).start()
+    
+    return jsonify({'status': 'cancelled', 'job_id': job_id})
+
+@app.route('/job/<job_id>/range', methods=['POST'])
+def run_job_range(job_id):
+    \"\"\"
+    タスクキューモードのジョブに範囲 [start, end) を渡し、work(start, end) の結果を返す
+    ワーカーは届いた順に1範囲ずつ実行するので、クライアントは次の範囲を先に送って往復時間を隠せる
+    409: まだ起動していない (待機中) / 410: ワーカーが終了した / 422: work() が例外を出した
+    \"\"\"
+    if job_id not in current_jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    job = current_jobs[job_id]
+    if not job.get('config', {}).get('tasks'):
+        return jsonify({'error': 'タスクキューモードのジョブではありません'}), 400
+    
+    with job_slots_lock:
+        status = job['status']
+        proc = job_processes.get(job_id)
+    if status == 'queued':
+        return jsonify({'error': 'ジョブは実行待ちです', 'status': status}), 409
+    if status in JOB_FINAL_EVENTS or proc is None:
+        return jsonify({'error': f"ジョブは終了しています ({status})", 'status': status}), 410
+    
+    item = request.get_json()
+    key = (job_id, item['range_id'])
+    wait_timeout = float(item.get('timeout') or RANGE_WAIT_TIMEOUT)
+    waiter = {'event': threading.Event(), 'message': None}
+    with range_lock:
+        pending_ranges[key] = waiter
+        try:
+            proc.stdin.write(json.dumps({'range_id': item['range_id'], 'start': item['start'], 'end': item['end']}) + "\\n")
+            proc.stdin.flush()
+        except (OSError, ValueError):
+            pending_ranges.pop(key, None)
+            return jsonify({'error': 'ワーカーは範囲の受け付けを終了しています'}), 410
+    
+    if not waiter['event'].wait(wait_timeout):
+        with range_lock:
+            pending_ranges.pop(key, None)
+        return jsonify({'error': f"範囲の結果が {wait_timeout:g}s 以内に返りませんでした"}), 504
+    
+    message = waiter['message']
+    if message is None:
+        return jsonify({'error': current_jobs[job_id].get('error') or 'ワーカーが終了しました'}), 410
+    if message['type'] == 'range_error':
+        return jsonify({'error': message['error'], 'range_id': item['range_id']}), 422
+    return jsonify({'range_id': item['range_id'], 'value': message['value'], 'seconds': message['seconds']})
+
+@app.route('/job/<job_id>/drain', methods=['POST'])
+def drain_job_ranges(job_id):
+    \"\"\"タスクキューモードのジョブに配布終了を伝える (受け取り済みの範囲を終えたらワーカーが完了する)\"\"\"
+    if job_id not in current_jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    with job_slots_lock:
+        queued = job_id in job_queue
+        if queued:
+            job_queue.remove(job_id)
+        started = job_id in job_processes
+        proc = job_processes.get(job_id)
+    if queued or (started and current_jobs[job_id]['status'] == 'queued'):
+        # 一度も範囲を受け取らなかった (他ノードだけで全範囲を終えた)
+        finish_job(job_id, 'cancelled')
+        if proc is not None:
+            proc.terminate()
+    elif proc is not None:
+        with range_lock:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+    return jsonify({'job_id': job_id, 'status': current_jobs[job_id]['status']})
+
 @app.route('/shutdown', methods=['POST'])
 def shutdown_server():
     \"\"\"サーバー停止\"\"\"
     print("🔌 サーバーを停止しています...")
     return jsonify({'status': 'shutting down'})
 
-def execute_training_code(job_id: str, code: str, config: dict):
+def execute_training_code(job_id: str, code: str, config: dict, launch_time: float):
     \"\"\"学習コードの実行\"\"\"
     try:
         print(f"📊 Job {job_id}: コード実行開始")
         
+        blob, compile_time, cache_hit = get_compiled_code(code)
+        compiled = marshal.loads(blob)
+        current_jobs[job_id]['startup'] = {
+            'total': time.time() - launch_time,
+            'warm': True,
+            'import_time': 0.0,
+            'compile_time': compile_time,
+            'cache_hit': cache_hit
+        }
+        
         # 安全なコード実行環境
         exec_globals = {
             '__builtins__': __builtins__,
             'torch': torch,
             'job_id': job_id,
             'config': config,
-            'update_progress': lambda epoch, loss: update_job_progress(job_id, epoch, loss)
+            'workdir': config.get('workdir'),
+            'shard': DataShard(config['data']) if config.get('data') else None,
+            'update_progress': lambda epoch, loss=None, step=None, **metrics: update_job_progress(
+                job_id, epoch, loss, step, **metrics
+            )
         }
         
+        # スレッド実行では chdir できないため import パスのみ追加
+        if config.get('workdir') and config['workdir'] not in sys.path:
+            sys.path.insert(0, config['workdir'])
+        
         # コード実行
-        exec(code, exec_globals)
+        exec(compiled, exec_globals)
         
         # ジョブ完了
-        current_jobs[job_id]['status'] = 'completed'
-        current_jobs[job_id]['end_time'] = time.time()
+        finish_job(job_id, 'completed')
         
-        print(f"✅ Job {job_id}: 実行完了")
+    except Exception as e:
+        finish_job(job_id, 'error', str(e))
+
+def schedule_jobs():
+    \"\"\"
+    空きスロットがあれば待機中のジョブをワーカープロセスで起動
+    ロック中は枠の確保だけ行い、起動はロックの外で行う (キャンセルや /range を待たせない)
+    \"\"\"
+    while True:
+        with job_slots_lock:
+            launches = []
+            while job_queue and len(job_processes) < MAX_CONCURRENT_JOBS:
+                job_id = job_queue.popleft()
+                job_processes[job_id] = None
+                launches.append(job_id)
+        if not launches:
+            return
+        for job_id in launches:
+            try:
+                launch_job_process(job_id)
+            except Exception as e:
+                with job_slots_lock:
+                    job_processes.pop(job_id, None)
+                finish_job(job_id, 'error', f"ジョブ起動失敗: {str(e)}")
+
+def has_blob(digest: str) -> bool:
+    \"\"\"blob の有無を確認 (存在すれば最終アクセス時刻を更新)\"\"\"
+    if not BLOB_DIGEST_PATTERN.match(digest):
+        return False
+    path = os.path.join(BLOB_CACHE_DIR, digest)
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+def read_blob(digest: str) -> bytes:
+    with open(os.path.join(BLOB_CACHE_DIR, digest), 'rb') as f:
+        return f.read()
+
+def store_blob(digest: str, data: bytes):
+    \"\"\"blob を書き込み、合計が容量上限を超えたら古い順に削除\"\"\"
+    global blob_cache_bytes
+    os.makedirs(BLOB_CACHE_DIR, exist_ok=True)
+    path = os.path.join(BLOB_CACHE_DIR, digest)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    with blob_lock:
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        if blob_cache_bytes is not None:
+            blob_cache_bytes += len(data) - replaced
+        due = blob_cache_bytes is None or blob_cache_bytes > blob_prune_at
+    if due:
+        prune_blob_cache()
+
+def prune_blob_cache():
+    \"\"\"
+    blob ストアを BLOB_CACHE_MAX_BYTES の 9 割まで減らす (LRU、実行中・送信中のジョブのチャンクは残す)
+    次の整理は上限を超えたとき (残したチャンクだけで超える場合は上限の 1/10 だけ書き込まれたとき)
+    \"\"\"
+    global blob_cache_bytes, blob_prune_at
+    with blob_lock:
+        now = time.time()
+        for job_id in [job_id for job_id, (expires, _) in upload_pins.items() if expires < now]:
+            del upload_pins[job_id]
+        pinned = set().union(*pinned_blobs.values(), *(digests for _, digests in upload_pins.values()))
+        entries, total = [], 0
+        for name in os.listdir(BLOB_CACHE_DIR):
+            if BLOB_DIGEST_PATTERN.match(name):
+                stat = os.stat(os.path.join(BLOB_CACHE_DIR, name))
+                total += stat.st_size
+                if name not in pinned:
+                    entries.append((stat.st_mtime, stat.st_size, name))
         
+        for _, size, name in sorted(entries):
+            if total <= BLOB_CACHE_MAX_BYTES * 9 // 10:
+                break
+            os.remove(os.path.join(BLOB_CACHE_DIR, name))
+            total -= size
+        blob_cache_bytes = total
+        blob_prune_at = max(BLOB_CACHE_MAX_BYTES, total + BLOB_CACHE_MAX_BYTES // 10)
+
+def data_chunk_digests(manifest) -> set:
+    \"\"\"--data のシャードが参照するチャンクの digest\"\"\"
+    if not manifest:
+        return set()
+    if manifest['format'] == 'files':
+        return {digest for entry in manifest['files'] for digest in entry['chunks']}
+    return set(manifest['chunks'])
+
+def materialize_job_files(job_id: str, files: dict) -> str:
+    \"\"\"blob をジョブの作業ディレクトリに展開してパスを返す\"\"\"
+    workdir = os.path.join(JOB_WORKDIR_ROOT, job_id)
+    os.makedirs(workdir, exist_ok=True)
+    for relative, digest in files.items():
+        target = os.path.normpath(os.path.join(workdir, relative))
+        if not target.startswith(workdir + os.sep):
+            raise ValueError(f"不正なファイルパス: {relative}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(os.path.join(BLOB_CACHE_DIR, digest), target)
+    return workdir
+
+def artifact_etag(stat) -> str:
+    \"\"\"成果物の ETag (更新時刻とサイズから作るので一覧と送信で同じ値になる)\"\"\"
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def artifact_checksum(path: str, etag: str) -> str:
+    \"\"\"成果物の sha256 (1MB ずつ読むので大きなチェックポイントでもメモリは一定)\"\"\"
+    with artifact_lock:
+        checksum = artifact_checksums.get((path, etag))
+    if checksum is None:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        checksum = digest.hexdigest()
+        with artifact_lock:
+            artifact_checksums[(path, etag)] = checksum
+            while len(artifact_checksums) > ARTIFACT_CHECKSUM_CACHE_SIZE:
+                artifact_checksums.popitem(last=False)
+    return checksum
+
+def get_compiled_code(source: str):
+    \"\"\"
+    ソースの sha256 をキーにコンパイル済みコードを取得 (LRU)
+    戻り値: (marshal 済みコード, コンパイル時間, キャッシュヒット)
+    \"\"\"
+    key = hashlib.sha256(source.encode()).hexdigest()
+    with code_cache_lock:
+        blob = code_cache.get(key)
+        if blob is not None:
+            code_cache.move_to_end(key)
+            return blob, 0.0, True
+    
+    compile_start = time.perf_counter()
+    blob = marshal.dumps(compile(source, f"<job:{key[:12]}>", 'exec'))
+    compile_time = time.perf_counter() - compile_start
+    
+    with code_cache_lock:
+        code_cache[key] = blob
+        while len(code_cache) > CODE_CACHE_SIZE:
+            code_cache.popitem(last=False)
+    return blob, compile_time, False
+
+def spawn_worker() -> subprocess.Popen:
+    \"\"\"ワーカープロセスを起動 (PRELOAD_MODULES の import から始まる)\"\"\"
+    return subprocess.Popen(
+        [sys.executable, '-c', JOB_WORKER_SOURCE, json.dumps(PRELOAD_MODULES)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True
+    )
+
+def warm_up_worker():
+    \"\"\"ワーカーを起動し、import 完了 (ready) を待ってから待機列に入れる\"\"\"
+    global warming_count
+    proc = None
+    try:
+        proc = spawn_worker()
+        ready = json.loads(proc.stdout.readline())
+        with warm_lock:
+            warm_workers.append((proc, ready.get('import_time', 0.0)))
     except Exception as e:
-        current_jobs[job_id]['status'] = 'error'
-        current_jobs[job_id]['error'] = str(e)
-        print(f"❌ Job {job_id}: エラー - {str(e)}")
+        print(f"⚠️  ウォームワーカー起動失敗: {str(e)}")
+        if proc is not None:
+            proc.kill()
+    finally:
+        with warm_lock:
+            warming_count -= 1
+
+def replenish_warm_workers():
+    \"\"\"待機ワーカーを WARM_WORKERS 個までバックグラウンドで補充\"\"\"
+    global warming_count
+    with warm_lock:
+        missing = max(WARM_WORKERS - len(warm_workers) - warming_count, 0)
+        warming_count += missing
+    for _ in range(missing):
+        threading.Thread(target=warm_up_worker, daemon=True).start()
+
+def take_warm_worker():
+    \"\"\"生きているウォームワーカーを1つ取り出す (なければ None)\"\"\"
+    with warm_lock:
+        while warm_workers:
+            proc, _ = warm_workers.popleft()
+            if proc.poll() is None:
+                return proc
+    return None
+
+def launch_job_process(job_id: str) -> subprocess.Popen:
+    \"\"\"
+    ワーカープロセスを用意して確保済みの枠に登録し、進捗監視スレッドを付ける
+    ジョブの受け渡しは監視スレッドが行う (起動直後のワーカーは import 中で stdin を読まないため)
+    \"\"\"
+    print(f"📊 Job {job_id}: コード実行開始")
+    launch_time = time.time()
+    config = current_jobs[job_id]['config']
+    blob, compile_time, cache_hit = get_compiled_code(config['code'])
+    
+    proc = take_warm_worker()
+    warm = proc is not None
+    if not warm:
+        proc = spawn_worker()
+    replenish_warm_workers()
+    
+    with job_slots_lock:
+        job_processes[job_id] = proc
+    if current_jobs[job_id]['status'] in JOB_FINAL_EVENTS:
+        proc.terminate()  # 起動中にキャンセルされた (監視スレッドが枠を解放する)
+    
+    task = {'job_id': job_id, 'config': config, 'code_blob': base64.b64encode(blob).decode()}
+    current_jobs[job_id]['pid'] = proc.pid
+    current_jobs[job_id]['startup'] = {
+        'warm': warm,
+        'import_time': 0.0,
+        'compile_time': compile_time,
+        'cache_hit': cache_hit
+    }
+    
+    monitor = threading.Thread(target=monitor_job_process, args=(job_id, proc, task, launch_time))
+    monitor.daemon = True
+    monitor.start()
+    return proc
+
+def monitor_job_process(job_id: str, proc: subprocess.Popen, task: dict, launch_time: float):
+    \"\"\"ジョブをワーカーに渡し、ワーカーから届く進捗メッセージを current_jobs に反映\"\"\"
+    startup = current_jobs[job_id]['startup']
+    try:
+        proc.stdin.write(json.dumps(task) + "\\n")
+        if task['config'].get('tasks'):
+            proc.stdin.flush()  # タスクキューモードは /job/<id>/drain まで範囲を書き足す
+        else:
+            proc.stdin.close()
+        # 範囲 (/range) はジョブの後に書き込む必要があるので、渡し終えてから running にする
+        if current_jobs[job_id]['status'] not in JOB_FINAL_EVENTS:
+            current_jobs[job_id]['status'] = 'running'
+    except (OSError, ValueError):
+        proc.kill()  # 起動中のキャンセル、またはワーカーが異常終了した (下の proc.wait() 以降で処理)
+    
+    for line in proc.stdout:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        
+        if message['type'] == 'ready':
+            # コールドスタート時のみ届く (import 時間がジョブの起動時間に含まれる)
+            startup['import_time'] = message['import_time']
+        elif message['type'] == 'started':
+            startup['total'] = time.time() - launch_time
+            print(f"⏱  Job {job_id}: 起動 {startup['total']:.2f}s ({'warm' if startup['warm'] else 'cold'})")
+        elif message['type'] == 'progress':
+            update_job_progress(
+                job_id, message['epoch'], message.get('loss'), message.get('step'),
+                **message.get('metrics', {})
+            )
+        elif message['type'] in ('result', 'range_error'):
+            resolve_range(job_id, message['range_id'], message)
+        elif message['type'] in ('completed', 'error'):
+            finish_job(job_id, message['type'], message.get('error'))
+    
+    proc.wait()
+    if current_jobs[job_id]['status'] not in JOB_FINAL_EVENTS:
+        finish_job(job_id, 'error', f"ワーカープロセスが異常終了しました (exit code {proc.returncode})")
+    release_ranges(job_id)
+    
+    with job_slots_lock:
+        job_processes.pop(job_id, None)
+    schedule_jobs()
+
+def resolve_range(job_id: str, range_id, message: dict):
+    \"\"\"範囲の結果を待っているリクエストに渡す\"\"\"
+    with range_lock:
+        waiter = pending_ranges.pop((job_id, range_id), None)
+    if waiter is not None:
+        waiter['message'] = message
+        waiter['event'].set()
+
+def release_ranges(job_id: str):
+    \"\"\"ワーカー終了時に結果待ちのリクエストを解放 (message なし = 410 を返す)\"\"\"
+    with range_lock:
+        keys = [key for key in pending_ranges if key[0] == job_id]
+        waiters = [pending_ranges.pop(key) for key in keys]
+    for waiter in waiters:
+        waiter['event'].set()
+
+def finish_job(job_id: str, status: str, error: str = None):
+    \"\"\"ジョブを終了状態にしてイベントを発行\"\"\"
+    job = current_jobs[job_id]
+    if job['status'] in JOB_FINAL_EVENTS:
+        return
+    
+    job['status'] = status
+    job['end_time'] = time.time()
+    if error:
+        job['error'] = error
+        publish_job_event(job_id, status, error=error)
+        print(f"❌ Job {job_id}: {status} - {error}")
+    else:
+        publish_job_event(job_id, status)
+        print(f"✅ Job {job_id}: {status}")
+    
+    current_jobs.finish(job_id)
+    with blob_lock:
+        pinned_blobs.pop(job_id, None)
+        upload_pins.pop(job_id, None)
+
+def collect_resources(cpu_interval=None) -> dict:
+    \"\"\"システムリソースのスナップショットを1回取得\"\"\"
+    cpu_usage = psutil.cpu_percent(interval=cpu_interval)
+    memory = psutil.virtual_memory()
+    disk = psutil.disk_usage('/')
+    
+    resources = {
+        'timestamp': time.time(),
+        'cpu': {
+            'count': psutil.cpu_count(),
+            'usage': cpu_usage
+        },
+        'memory': {
+            'total': memory.total,
+            'used': memory.used,
+            'percent': memory.percent
+        },
+        'disk': {
+            'total': disk.total,
+            'used': disk.used,
+            'free': disk.free
+        },
+        'gpu': []
+    }
+    
+    # GPU 情報
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            gpu_memory = torch.cuda.get_device_properties(i).total_memory
+            gpu_memory_used = torch.cuda.memory_allocated(i)
+            
+            resources['gpu'].append({
+                'id': i,
+                'name': torch.cuda.get_device_name(i),
+                'memory_total': gpu_memory,
+                'memory_used': gpu_memory_used,
+                'memory_free': gpu_memory - gpu_memory_used,
+                'utilization': torch.cuda.utilization() if hasattr(torch.cuda, 'utilization') else 0,
+                'temperature': 0  # 実際の実装では nvidia-ml-py を使用
+            })
+    
+    return resources
+
+def resource_sampler_loop():
+    \"\"\"バックグラウンドでリソースを定期サンプリングしリングバッファに格納\"\"\"
+    while True:
+        try:
+            # cpu_percent の計測区間がそのままサンプリング間隔になる
+            snapshot = collect_resources(cpu_interval=RESOURCE_SAMPLE_INTERVAL)
+            with resource_lock:
+                resource_history.append(snapshot)
+        except Exception as e:
+            print(f"⚠️  リソース取得失敗: {str(e)}")
+            time.sleep(RESOURCE_SAMPLE_INTERVAL)
+
+def publish_job_event(job_id: str, event_type: str, **data):
+    \"\"\"ジョブイベントを記録し、待機中のロングポーリングを起こす\"\"\"
+    now = time.time()
+    current_jobs[job_id]['updated_at'] = now  # /jobs?since= の差分判定用
+    with job_events_cond:
+        events = job_events.setdefault(job_id, deque(maxlen=JOB_EVENT_LIMIT))
+        seq = events[-1]['seq'] + 1 if events else 1
+        events.append({'seq': seq, 'type': event_type, 'timestamp': now, **data})
+        job_events_cond.notify_all()
 
-def update_job_progress(job_id: str, epoch: int, loss: float):
-    \"\"\"学習進捗の更新\"\"\"
+def summarize_job(job: dict, now: float) -> dict:
+    \"\"\"一覧用のジョブ概要 (config などの大きな項目は含めない)\"\"\"
+    summary = {field: job[field] for field in JOB_SUMMARY_FIELDS if field in job}
+    summary['node_index'] = job.get('config', {}).get('node_index')
+    summary['elapsed_time'] = (job.get('end_time') or now) - job['start_time']
+    return summary
+
+def update_job_progress(job_id: str, epoch: int, loss: float = None, step: float = None, **metrics):
+    \"\"\"学習進捗の更新 (loss 以外の任意のメトリクスも時系列として記録)\"\"\"
     if job_id in current_jobs:
         current_jobs[job_id]['current_epoch'] = epoch
-        current_jobs[job_id]['current_loss'] = loss
-        print(f"📈 Job {job_id}: Epoch {epoch}, Loss: {loss:.4f}")
+        if loss is not None:
+            current_jobs[job_id]['current_loss'] = loss
+            metrics['loss'] = loss
+        
+        record_metrics(job_id, epoch if step is None else step, metrics)
+        current_jobs[job_id].setdefault('latest_metrics', {}).update(metrics)
+        publish_job_event(job_id, 'progress', epoch=epoch, loss=loss, step=step, metrics=metrics)
+        
+        loss_text = f", Loss: {loss:.4f}" if isinstance(loss, (int, float)) else ""
+        print(f"📈 Job {job_id}: Epoch {epoch}{loss_text}")
+
+def record_metrics(job_id: str, step: float, metrics: dict):
+    \"\"\"数値メトリクスを系列に追加 (系列数は METRICS_PER_JOB まで)\"\"\"
+    with metrics_lock:
+        series = job_metrics.setdefault(job_id, {})
+        for name, value in metrics.items():
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if name not in series:
+                if len(series) >= METRICS_PER_JOB:
+                    continue
+                series[name] = MetricSeries()
+            series[name].append(float(step), value)
+
+class MetricSeries:
+    \"\"\"
+    固定容量の時系列 (array 'd' で保持)
+    容量に達したら古い半分を隣接2点の平均で半分に間引くため、
+    直近は生の解像度、古い区間ほど粗い解像度になる
+    \"\"\"
+    
+    def __init__(self, capacity: int = METRIC_SERIES_CAPACITY):
+        self.capacity = capacity
+        self.steps = array('d')
+        self.values = array('d')
+        self.total = 0  # これまでに記録された点数
+    
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> 'MetricSeries':
+        \"\"\"query() の結果から系列を復元\"\"\"
+        series = cls(capacity=max(len(snapshot['values']), 1))
+        series.steps.extend(snapshot['steps'])
+        series.values.extend(snapshot['values'])
+        series.total = snapshot.get('total', len(snapshot['values']))
+        return series
+    
+    def append(self, step: float, value: float):
+        if len(self.values) >= self.capacity:
+            self._compact()
+        self.steps.append(step)
+        self.values.append(value)
+        self.total += 1
+    
+    def _compact(self):
+        half = len(self.values) // 2
+        half -= half % 2
+        steps = array('d', ((self.steps[i] + self.steps[i + 1]) / 2 for i in range(0, half, 2)))
+        values = array('d', ((self.values[i] + self.values[i + 1]) / 2 for i in range(0, half, 2)))
+        steps.extend(self.steps[half:])
+        values.extend(self.values[half:])
+        self.steps, self.values = steps, values
+    
+    def query(self, points: int, start: float = None, end: float = None) -> dict:
+        \"\"\"[start, end] の区間を最大 points 点にバケット平均して返す\"\"\"
+        lo = 0 if start is None else bisect.bisect_left(self.steps, start)
+        hi = len(self.steps) if end is None else bisect.bisect_right(self.steps, end)
+        count = max(hi - lo, 0)
+        
+        if count <= points:
+            steps, values = self.steps[lo:hi].tolist(), self.values[lo:hi].tolist()
+        else:
+            # step 軸で等幅のバケットに分けて平均 (間引き済みの古い区間に偏らない)
+            steps, values = [], []
+            origin = self.steps[lo]
+            width = (self.steps[hi - 1] - origin) / points or 1.0
+            first = lo
+            for bucket in range(1, points + 1):
+                last = hi if bucket == points else bisect.bisect_left(self.steps, origin + bucket * width, first, hi)
+                if last > first:
+                    steps.append(sum(self.steps[first:last]) / (last - first))
+                    values.append(sum(self.values[first:last]) / (last - first))
+                first = last
+        
+        return {'steps': steps, 'values': values, 'stored': len(self.values), 'total': self.total}
+
+class HandlerStats:
+    \"\"\"
+    1ハンドラーの処理時間ヒストグラム (クライアント側 LatencyHistogram と同じ対数バケット)
+    0.1ms から 2^(1/4) 倍ずつの96バケットで、件数に関係なくメモリは一定
+    \"\"\"
+    
+    BASE = 1e-4
+    GROWTH = 2 ** 0.25
+    BUCKETS = 96
+    
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, seconds: float, error: bool = False):
+        if seconds <= self.BASE:
+            index = 0
+        else:
+            index = min(int(math.log(seconds / self.BASE, self.GROWTH)) + 1, self.BUCKETS)
+        self.counts[index] += 1
+        self.count += 1
+        self.errors += int(error)
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+    def percentile(self, q: float) -> float:
+        target = q * self.count
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if count and running >= target:
+                return min(self.BASE * self.GROWTH ** index, self.max)
+        return self.max
+    
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(0.50) * 1000,
+            'p90_ms': self.percentile(0.90) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'max_ms': self.max * 1000
+        }
 
 # サーバー起動
 def start_colab_server():
     print("🚀 Colab API サーバーを起動しています...")
     
+    # リソースサンプラー起動
+    sampler_thread = threading.Thread(target=resource_sampler_loop)
+    sampler_thread.daemon = True
+    sampler_thread.start()
+    
+    # ウォームワーカーを事前起動
+    if EXECUTION_MODE == 'process':
+        replenish_warm_workers()
+    
     # バックグラウンドでFlaskサーバー起動
     server_thread = threading.Thread(target=lambda: app.run(host='0.0.0.0', port=5000, debug=False))
     server_thread.daemon = True